@@ -0,0 +1,2 @@
+Computing the digest of advisories during sync and upload no longer copies every advisory into a
+temporary updateinfo document.
@@ -0,0 +1,2 @@
+PublishedArtifacts are now created in bounded batches with progress reporting, both when publishing
+and for "mirror_complete" syncs, instead of being collected in memory first.
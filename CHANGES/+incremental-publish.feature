@@ -0,0 +1 @@
+Added the `RPM_INCREMENTAL_PUBLISH` setting, which allows publications to reuse the package metadata of an earlier publication of the same repository and only generate metadata for the packages added since.
@@ -0,0 +1,2 @@
+Added the `RPM_METADATA_CACHE_DIR` and `RPM_METADATA_CACHE_SIZE` settings, which let workers cache
+downloaded repository metadata files, so that sync doesn't download unchanged files again.
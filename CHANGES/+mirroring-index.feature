@@ -0,0 +1,2 @@
+Reduced the memory used by "mirror_complete" syncs by keeping the package locations needed for
+the publication in an on-disk index of the sync task instead of in memory.
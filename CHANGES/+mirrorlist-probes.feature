@@ -0,0 +1,2 @@
+Added the `RPM_MIRRORLIST_PROBES` setting. When it is greater than 1, mirrors from a mirrorlist are
+probed concurrently and the fastest working one is used.
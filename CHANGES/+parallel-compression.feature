@@ -0,0 +1 @@
+Added the `RPM_PUBLISH_PARALLEL_COMPRESSION` setting, which writes and compresses the primary, filelists and other metadata of a publication in separate processes.
@@ -0,0 +1 @@
+Added the `RPM_PUBLISH_SUBREPO_WORKERS` setting, which allows the metadata of distribution tree sub-repositories to be generated concurrently in worker processes.
@@ -0,0 +1,2 @@
+Added the `RPM_SYNC_SUBREPO_WORKERS` setting, which allows the sub-repositories of a distribution
+tree to be synced concurrently.
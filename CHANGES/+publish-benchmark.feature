@@ -0,0 +1 @@
+Added the `rpm-publish-benchmark` management command, which times publishing synthetic repositories of configurable size without network access and reports the results as JSON.
@@ -0,0 +1 @@
+Improved the performance of publishing by selecting the packages to publish for duplicate NEVRAs in the database, once for both the package files and the metadata.
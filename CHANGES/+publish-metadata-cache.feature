@@ -0,0 +1 @@
+Added the `RPM_PUBLISH_METADATA_CACHE` setting, which allows publications of content which has already been published with the same options to reuse the existing repository metadata instead of generating it again.
@@ -0,0 +1 @@
+Added the `RPM_PUBLISH_PACKAGE_FRAGMENTS` setting, which stores the rendered metadata of packages so that publications only need to concatenate it.
@@ -0,0 +1 @@
+Publishing now streams only the package columns needed for the metadata from the database instead of instantiating full Package objects, reducing memory usage for large repositories.
@@ -0,0 +1,2 @@
+Publishing now writes comps.xml one element at a time and fetches all modular metadata with a
+single query, rather than building the whole comps document in memory.
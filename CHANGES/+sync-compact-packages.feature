@@ -0,0 +1 @@
+Added the `RPM_SYNC_COMPACT_PACKAGES` setting, which keeps the changelogs, files and dependencies of new packages compressed while they pass through the sync pipeline, and the `rpm-sync-memory-benchmark` management command to measure its effect on peak memory usage.
@@ -0,0 +1 @@
+Added the `RPM_SYNC_COPY_INSERT` setting, which inserts new packages and advisory collections, collection packages and references during sync with PostgreSQL `COPY`, and the `rpm-bulk-insert-benchmark` management command to compare it with the default inserts.
@@ -0,0 +1 @@
+Sync now decompresses primary.xml only once, even though it is parsed twice.
@@ -0,0 +1 @@
+Packages are now related to modulemds during sync with a single set-based insert, so the DeclarativeContents of modular packages are no longer kept in memory until the end of the sync.
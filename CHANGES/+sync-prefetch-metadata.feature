@@ -0,0 +1,2 @@
+Sync now downloads the repomd.xml and treeinfo files of all sub-repositories concurrently, and
+downloads each of them only once.
@@ -0,0 +1,2 @@
+Sync now updates the package and advisory parsing progress reports in batches, and shows the
+parsing rate as their suffix.
@@ -0,0 +1,3 @@
+Sync now looks up existing advisories in batches and doesn't build their collections and references
+again unless some of them are missing, and checks which advisories already have relations with a
+single query per relation and batch.
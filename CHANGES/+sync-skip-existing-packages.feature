@@ -0,0 +1,2 @@
+Sync no longer parses the filelists.xml and other.xml entries of packages which are already present
+in the latest repository version, nor builds complete package objects for them.
@@ -0,0 +1,2 @@
+Sync now parses updateinfo.xml a batch of advisories at a time, rather than holding all of them in
+memory at once.
@@ -0,0 +1 @@
+Mirrored publications now reference the already stored Artifacts of unchanged custom metadata files instead of storing them again, and regular publications no longer copy custom metadata files out of local storage.
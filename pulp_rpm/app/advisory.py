@@ -3,6 +3,9 @@ from collections import defaultdict
 from itertools import chain
 
 import hashlib
+import os
+import re
+import tempfile
 
 import createrepo_c as cr
 from datetime import datetime
@@ -26,6 +29,16 @@ from pulp_rpm.app.models import (
 )
 from pulp_rpm.app.shared_utils import is_previous_version
 
+# The number of advisories iter_updateinfo() parses at once
+UPDATEINFO_BATCH_SIZE = 500
+UPDATEINFO_READ_SIZE = 1024 * 1024
+UPDATE_END_TAG = re.compile(rb"</update\s*>")
+UPDATE_END_TAG_START = b"</update"
+# Starts CDATA sections, comments and document type declarations, whose text isn't escaped
+MARKUP_DECLARATION = b"<!"
+UPDATEINFO_XML_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n<updates>\n'
+UPDATEINFO_XML_FOOTER = b"</updates>\n"
+
 
 def resolve_advisories(version, previous_version):
     """
@@ -481,6 +494,144 @@ def hash_update_record(update):
         str: a hex digest representing the update record
 
     """
-    uinfo = cr.UpdateInfo()
-    uinfo.append(update)
-    return hashlib.sha256(uinfo.xml_dump().encode("utf-8")).hexdigest()
+    # Hash exactly what cr.UpdateInfo.xml_dump() returns for an UpdateInfo holding just this
+    # record, without copying the record into one.
+    digest = hashlib.sha256(UPDATEINFO_XML_HEADER)
+    digest.update(cr.xml_dump_updaterecord(update).encode("utf-8"))
+    digest.update(UPDATEINFO_XML_FOOTER)
+    return digest.hexdigest()
+
+
+def split_updateinfo(updateinfo_xml_path, batch_size=UPDATEINFO_BATCH_SIZE):
+    """
+    Split a decompressed updateinfo.xml into batches of <update> elements.
+
+    The file is split after every closing </update> tag (with optional whitespace before the
+    ">"). Text is escaped, so the tag can't appear anywhere else, unless the file contains CDATA
+    sections or comments, which `has_markup_declarations` detects.
+
+    Args:
+        updateinfo_xml_path(str): a path to a decompressed updateinfo.xml
+        batch_size(int): the number of <update> elements in a batch
+
+    Yields:
+        tuple: the beginning of the document up to and including the opening <updates> tag, and
+            the XML of the next batch of <update> elements
+
+    """
+    prologue = None
+    buffer = bytearray()
+    batch_end = 0
+    search_start = 0
+    updates = 0
+
+    with open(updateinfo_xml_path, "rb") as updateinfo_xml:
+        while chunk := updateinfo_xml.read(UPDATEINFO_READ_SIZE):
+            buffer += chunk
+
+            if prologue is None:
+                start = buffer.find(b"<updates")
+                end = buffer.find(b">", start) if start != -1 else -1
+                if end == -1:
+                    continue
+                prologue = bytes(buffer[: end + 1])
+                if prologue.endswith(b"/>"):
+                    # <updates/>
+                    return
+                del buffer[: end + 1]
+
+            while match := UPDATE_END_TAG.search(buffer, search_start):
+                batch_end = search_start = match.end()
+                updates += 1
+                if updates == batch_size:
+                    yield prologue, bytes(buffer[:batch_end])
+                    del buffer[:batch_end]
+                    batch_end = search_start = updates = 0
+            # the end tag may be split between two chunks
+            tag_start = buffer.rfind(UPDATE_END_TAG_START, search_start)
+            if tag_start != -1 and buffer.find(b">", tag_start) == -1:
+                search_start = tag_start
+            else:
+                search_start = max(batch_end, len(buffer) - len(UPDATE_END_TAG_START) + 1)
+
+    if updates:
+        yield prologue, bytes(buffer[:batch_end])
+
+
+def has_markup_declarations(updateinfo_xml_path):
+    """
+    Find out whether a decompressed updateinfo.xml contains CDATA sections or comments.
+
+    Their text isn't escaped, so it may contain </update> tags which don't end an <update>
+    element, and the file can't be split by `split_updateinfo`.
+
+    Args:
+        updateinfo_xml_path(str): a path to a decompressed updateinfo.xml
+
+    Returns:
+        bool: whether any CDATA sections, comments or document type declarations were found
+
+    """
+    previous_chunk_end = b""
+    with open(updateinfo_xml_path, "rb") as updateinfo_xml:
+        while chunk := updateinfo_xml.read(UPDATEINFO_READ_SIZE):
+            if MARKUP_DECLARATION in previous_chunk_end + chunk:
+                return True
+            previous_chunk_end = chunk[-len(MARKUP_DECLARATION) + 1 :]
+    return False
+
+
+def iter_updateinfo_batches(updateinfo_xml_path, batch_size=UPDATEINFO_BATCH_SIZE):
+    """
+    Parse updateinfo.xml a batch of update records at a time.
+
+    createrepo_c can only parse a whole updateinfo.xml at once, which keeps every update record
+    in memory. Instead, every batch is written to a small updateinfo.xml of its own and parsed
+    separately. Files which can't be split safely, see `has_markup_declarations`, are still
+    parsed at once.
+
+    Args:
+        updateinfo_xml_path(str): a path to a downloaded updateinfo.xml
+        batch_size(int): the number of update records parsed at once
+
+    Yields:
+        list: the parsed createrepo_c.UpdateRecord of the next batch
+
+    """
+    with tempfile.TemporaryDirectory(dir=".") as tmp_dir:
+        decompressed_path = os.path.join(tmp_dir, "updateinfo.xml")
+        cr.decompress_file(updateinfo_xml_path, decompressed_path, cr.AUTO_DETECT_COMPRESSION)
+        batch_path = os.path.join(tmp_dir, "batch.xml")
+
+        if has_markup_declarations(decompressed_path):
+            uinfo = cr.UpdateInfo()
+            cr.xml_parse_updateinfo(decompressed_path, uinfo)
+            updates = uinfo.updates
+            for start in range(0, len(updates), batch_size):
+                yield updates[start : start + batch_size]
+            return
+
+        for prologue, batch in split_updateinfo(decompressed_path, batch_size):
+            with open(batch_path, "wb") as batch_xml:
+                batch_xml.write(prologue)
+                batch_xml.write(batch)
+                batch_xml.write(b"\n</updates>\n")
+            uinfo = cr.UpdateInfo()
+            # TODO: handle parsing errors/warnings, warningcb callback can be used
+            cr.xml_parse_updateinfo(batch_path, uinfo)
+            yield uinfo.updates
+
+
+def iter_updateinfo(updateinfo_xml_path, batch_size=UPDATEINFO_BATCH_SIZE):
+    """
+    Parse updateinfo.xml an update record at a time.
+
+    Args:
+        updateinfo_xml_path(str): a path to a downloaded updateinfo.xml
+        batch_size(int): the number of update records parsed at once
+
+    Returns:
+        iterator: the parsed createrepo_c.UpdateRecord
+
+    """
+    return chain.from_iterable(iter_updateinfo_batches(updateinfo_xml_path, batch_size))
@@ -0,0 +1,163 @@
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+def copy_insert_enabled():
+    """
+    Whether rows are inserted with COPY rather than with bulk_create.
+
+    Returns:
+        bool: True if the RPM_SYNC_COPY_INSERT setting is enabled and the database supports it
+
+    """
+    return settings.RPM_SYNC_COPY_INSERT and connection.vendor == "postgresql"
+
+
+def _row(obj, fields):
+    return tuple(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+
+
+def _copy_to_staging_table(cursor, table, columns, rows):
+    """
+    Copy rows into a new temporary table shaped like the given table.
+
+    Args:
+        cursor: A database cursor
+        table (str): The table the staging table is created like
+        columns (list): The quoted names of the columns of the rows
+        rows (iterable): The rows to copy
+
+    Returns:
+        str: The quoted name of the staging table, which is dropped at the end of the transaction
+
+    """
+    quote_name = connection.ops.quote_name
+    staging_table = quote_name(f"staging_{uuid.uuid4().hex}")
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging_table} (LIKE {quote_name(table)} INCLUDING DEFAULTS) "
+        "ON COMMIT DROP"
+    )
+    with cursor.copy(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+    return staging_table
+
+
+def copy_insert(model, objs):
+    """
+    Insert model instances with COPY, skipping the ones which conflict with existing rows.
+
+    This is equivalent to `model.objects.bulk_create(objs, ignore_conflicts=True)`, but the rows
+    are copied into a staging table and inserted from there with a single
+    `INSERT ... ON CONFLICT DO NOTHING`, which is considerably faster for many rows. Only models
+    stored in a single table are supported, and the primary keys must be set in advance.
+
+    Args:
+        model (django.db.models.Model): The model of the instances
+        objs (list): The unsaved instances
+
+    """
+    if not objs:
+        return
+    quote_name = connection.ops.quote_name
+    fields = model._meta.local_concrete_fields
+    columns = [quote_name(field.column) for field in fields]
+    table = model._meta.db_table
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        staging_table = _copy_to_staging_table(
+            cursor, table, columns, (_row(obj, fields) for obj in objs)
+        )
+        cursor.execute(
+            f"INSERT INTO {quote_name(table)} ({', '.join(columns)}) "
+            f"SELECT {', '.join(columns)} FROM {staging_table} ON CONFLICT DO NOTHING"
+        )
+        cursor.execute(f"DROP TABLE {staging_table}")
+
+
+def copy_insert_content(model, objs):
+    """
+    Insert content units with COPY, skipping the ones which conflict with existing content.
+
+    The rows of the detail table are inserted first, and the rows of the parent tables only for
+    the content units which didn't conflict, within one transaction (the foreign keys of the
+    detail table are only checked when it is committed). The rows are inserted in the order of
+    the natural keys, like ContentSaver does, so that concurrent syncs of overlapping content
+    don't deadlock. The inserted instances are marked as saved, the other ones are left unsaved.
+
+    Args:
+        model (pulpcore.plugin.models.Content): The detail model of the content units
+        objs (list): The unsaved content units
+
+    Returns:
+        list: The inserted content units
+
+    """
+    if not objs:
+        return []
+    objs = sorted(objs, key=lambda obj: "".join(map(str, obj.natural_key())))
+    quote_name = connection.ops.quote_name
+    pk_column = quote_name(model._meta.pk.column)
+    parents = model._meta.get_parent_list()
+
+    for obj in objs:
+        # what MasterModel.save() and Model.save() do before saving the parents of a
+        # multi-table inherited model
+        if not obj.pulp_type:
+            obj.pulp_type = obj.get_pulp_type()
+        for parent, parent_link in model._meta.parents.items():
+            setattr(obj, parent_link.attname, getattr(obj, parent._meta.pk.attname))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        fields = model._meta.local_concrete_fields
+        columns = [quote_name(field.column) for field in fields]
+        table = model._meta.db_table
+        staging_table = _copy_to_staging_table(
+            cursor, table, columns, (_row(obj, fields) for obj in objs)
+        )
+        cursor.execute(
+            f"INSERT INTO {quote_name(table)} ({', '.join(columns)}) "
+            f"SELECT {', '.join(columns)} FROM {staging_table} ON CONFLICT DO NOTHING "
+            f"RETURNING {pk_column}"
+        )
+        inserted_pks = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"DROP TABLE {staging_table}")
+
+        inserted = [obj for obj in objs if obj.pk in inserted_pks]
+        for parent in parents:
+            fields = parent._meta.local_concrete_fields
+            columns = [quote_name(field.column) for field in fields]
+            table = parent._meta.db_table
+            staging_table = _copy_to_staging_table(
+                cursor, table, columns, (_row(obj, fields) for obj in inserted)
+            )
+            cursor.execute(
+                f"INSERT INTO {quote_name(table)} ({', '.join(columns)}) "
+                f"SELECT {', '.join(columns)} FROM {staging_table}"
+            )
+            cursor.execute(f"DROP TABLE {staging_table}")
+
+    for obj in inserted:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    return inserted
+
+
+def bulk_insert(model, objs):
+    """
+    Insert model instances, skipping the ones which conflict with existing rows.
+
+    The instances are inserted with COPY if RPM_SYNC_COPY_INSERT is enabled, and with
+    `bulk_create(ignore_conflicts=True)` otherwise.
+
+    Args:
+        model (django.db.models.Model): The model of the instances
+        objs (list): The unsaved instances
+
+    """
+    if copy_insert_enabled():
+        copy_insert(model, objs)
+    else:
+        model.objects.bulk_create(objs, ignore_conflicts=True)
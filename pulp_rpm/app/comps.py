@@ -73,3 +73,87 @@ def dict_digest(dict):
     str_prep_hash = [str(i) for i in prep_hash]
     str_prep_hash.sort()
     return hashlib.sha256("".join(str_prep_hash).encode("utf-8")).hexdigest()
+
+
+COMPS_XML_OPTIONS = {
+    "default_explicit": True,
+    "empty_groups": True,
+    "empty_packages": True,
+    "uservisible_explicit": True,
+}
+
+
+def comps_element_xml(comps):
+    """
+    Serialize the elements of a libcomps Comps object, without the surrounding document.
+
+    Args:
+        comps: a libcomps Comps
+
+    Returns:
+        str: the XML of the elements, empty if there is nothing to serialize
+
+    """
+    xml = comps.xml_str(xml_options=COMPS_XML_OPTIONS)
+    start = xml.find("<comps>\n")
+    if start == -1:
+        # an empty <comps/> element
+        return ""
+    return xml[start + len("<comps>\n") : xml.rindex("</comps>")]
+
+
+def write_comps_xml(path, groups, categories, environments, langpacks=None):
+    """
+    Write comps.xml one element at a time.
+
+    Each element is serialized by libcomps on its own, so the file is identical to the one
+    libcomps writes for a Comps object holding all of them, without holding them all in memory.
+
+    Args:
+        path: the path of the file to write
+        groups: an iterable of libcomps Group
+        categories: an iterable of libcomps Category
+        environments: an iterable of libcomps Environment
+        langpacks: a libcomps StrDict with the langpacks, or None
+
+    Returns:
+        bool: whether any group, category, environment or langpacks were given
+
+    """
+    empty_xml = libcomps.Comps().xml_str(xml_options=COMPS_XML_OPTIONS)
+    has_comps = False
+    written = False
+
+    with open(path, "w", encoding="utf-8") as comps_xml:
+        comps_xml.write(empty_xml[: empty_xml.rindex("<comps/>")])
+        comps_xml.write("<comps>\n")
+
+        for elements, attribute in (
+            (groups, "groups"),
+            (categories, "categories"),
+            (environments, "environments"),
+        ):
+            for element in elements:
+                comps = libcomps.Comps()
+                getattr(comps, attribute).append(element)
+                element_xml = comps_element_xml(comps)
+                comps_xml.write(element_xml)
+                written |= bool(element_xml)
+                has_comps = True
+
+        if langpacks is not None:
+            comps = libcomps.Comps()
+            comps.langpacks = langpacks
+            element_xml = comps_element_xml(comps)
+            comps_xml.write(element_xml)
+            written |= bool(element_xml)
+            has_comps = True
+
+        comps_xml.write("</comps>\n")
+
+    if not written:
+        # libcomps writes an empty element instead
+        with open(path, "w", encoding="utf-8") as comps_xml:
+            comps_xml.write(empty_xml)
+
+    return has_comps
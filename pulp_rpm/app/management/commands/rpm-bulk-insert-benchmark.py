@@ -0,0 +1,279 @@
+import hashlib
+import json
+import sys
+import time
+import uuid
+from gettext import gettext as _
+
+import createrepo_c as cr
+from django.core.management import BaseCommand, CommandError
+from django.db import IntegrityError, connection, transaction
+
+from pulp_rpm.app.bulk_insert import copy_insert, copy_insert_content
+from pulp_rpm.app.models import (
+    Package,
+    UpdateCollection,
+    UpdateCollectionPackage,
+    UpdateRecord,
+    UpdateReference,
+)
+
+METHODS = ("orm", "copy")
+
+
+def synthetic_package(token, index, files, changelogs):
+    """
+    Create a Package with synthetic data.
+
+    Args:
+        token (str): Makes the package unique.
+        index (int): The number of the package.
+        files (int): The number of files of the package.
+        changelogs (int): The number of changelogs of the package.
+
+    Returns:
+        pulp_rpm.app.models.Package: the unsaved package
+
+    """
+    pkg = cr.Package()
+    pkg.name = f"bulk-insert-benchmark-{index}"
+    pkg.epoch = "0"
+    pkg.version = "1.0"
+    pkg.release = "1"
+    pkg.arch = "x86_64"
+    pkg.pkgId = hashlib.sha256(f"{token}-{index}".encode()).hexdigest()
+    pkg.checksum_type = "sha256"
+    pkg.location_href = f"{pkg.name}-1.0-1.x86_64.rpm"
+    pkg.rpm_header_start = 4504
+    pkg.rpm_header_end = 8192
+    pkg.size_package = 10240
+    pkg.size_installed = 20480
+    pkg.size_archive = 20480
+    pkg.time_file = 1700000000
+    pkg.time_build = 1700000000
+    pkg.provides = [(pkg.name, "EQ", "0", "1.0", "1", False)]
+    pkg.requires = [("glibc", None, None, None, None, False)]
+    pkg.files = [("", f"/usr/share/{pkg.name}/", f"file-{number}") for number in range(files)]
+    pkg.changelogs = [
+        ("Pulp <pulp@example.com> - 1.0-1", 1700000000 + number, f"- change {number}")
+        for number in range(changelogs)
+    ]
+    return Package(**Package.createrepo_to_dict(pkg))
+
+
+def advisory_children(update_records, packages_per_advisory, references):
+    """
+    Create the collections, collection packages and references of some advisories.
+
+    Args:
+        update_records (list): The saved advisories.
+        packages_per_advisory (int): The number of packages in the collection of an advisory.
+        references (int): The number of references of an advisory.
+
+    Returns:
+        tuple: lists of unsaved UpdateCollections, UpdateCollectionPackages and UpdateReferences
+
+    """
+    collections = []
+    collection_packages = []
+    update_references = []
+    for update_record in update_records:
+        collection = UpdateCollection(
+            name="benchmark", shortname="benchmark", update_record=update_record
+        )
+        collections.append(collection)
+        for index in range(packages_per_advisory):
+            collection_packages.append(
+                UpdateCollectionPackage(
+                    arch="x86_64",
+                    epoch="0",
+                    filename=f"bulk-insert-benchmark-{index}-1.0-1.x86_64.rpm",
+                    name=f"bulk-insert-benchmark-{index}",
+                    release="1",
+                    src=f"bulk-insert-benchmark-{index}-1.0-1.src.rpm",
+                    sum=hashlib.sha256(f"{update_record.pk}-{index}".encode()).hexdigest(),
+                    sum_type=cr.SHA256,
+                    version="1.0",
+                    update_collection=collection,
+                )
+            )
+        for index in range(references):
+            update_references.append(
+                UpdateReference(
+                    href=f"https://example.com/{update_record.id}/{index}",
+                    ref_id=str(index),
+                    title=f"Reference {index}",
+                    ref_type="bugzilla",
+                    update_record=update_record,
+                )
+            )
+    return collections, collection_packages, update_references
+
+
+class Command(BaseCommand):
+    """
+    Django management command for comparing inserting synced content with the ORM and with COPY.
+
+    Synthetic packages and advisory collections, collection packages and references are
+    inserted the way RpmContentSaver inserts them, once with the ORM (packages one by one, like
+    the ContentSaver of pulpcore, and the advisory rows with bulk_create) and once with COPY, as
+    with the RPM_SYNC_COPY_INSERT setting. The time of each is written as JSON. All of the
+    inserted rows are deleted afterwards. Only PostgreSQL supports COPY.
+    """
+
+    help = _(__doc__)
+
+    def add_arguments(self, parser):
+        """Set up arguments."""
+        parser.add_argument(
+            "--packages", type=int, default=1000, help=_("Number of packages to insert.")
+        )
+        parser.add_argument("--files", type=int, default=10, help=_("Number of files per package."))
+        parser.add_argument(
+            "--changelogs", type=int, default=3, help=_("Number of changelogs per package.")
+        )
+        parser.add_argument(
+            "--advisories", type=int, default=1000, help=_("Number of advisories to generate.")
+        )
+        parser.add_argument(
+            "--packages-per-advisory",
+            type=int,
+            default=10,
+            help=_("Number of packages listed by the collection of each advisory."),
+        )
+        parser.add_argument(
+            "--references", type=int, default=2, help=_("Number of references per advisory.")
+        )
+        parser.add_argument(
+            "--runs", type=int, default=1, help=_("Number of times to repeat the measurements.")
+        )
+        parser.add_argument("--output", default="-", help=_("File to write the JSON results to."))
+
+    def handle(self, *args, **options):
+        """Implement the command."""
+        if connection.vendor != "postgresql":
+            raise CommandError(_("COPY is only supported by PostgreSQL."))
+
+        token = uuid.uuid4().hex[:12]
+        parameters = {
+            name: options[name]
+            for name in (
+                "packages",
+                "files",
+                "changelogs",
+                "advisories",
+                "packages_per_advisory",
+                "references",
+            )
+        }
+        results = {"parameters": parameters, "runs": []}
+        update_records = []
+
+        try:
+            with transaction.atomic():
+                for index in range(options["advisories"]):
+                    update_record = UpdateRecord(
+                        id=f"BENCHMARK-{token}-{index}",
+                        issued_date="2024-01-01 00:00:00",
+                        fromstr="pulp@example.com",
+                        status="final",
+                        title=f"Synthetic advisory {index}",
+                        summary=f"Synthetic advisory {index}",
+                        description=f"Synthetic advisory {index}",
+                        version="1",
+                        type="bugfix",
+                        severity="Low",
+                        solution="",
+                        release="1",
+                        rights="",
+                        pushcount="",
+                        digest=hashlib.sha256(f"{token}-{index}".encode()).hexdigest(),
+                    )
+                    update_record.save()
+                    update_records.append(update_record)
+
+            for run in range(options["runs"]):
+                self.stderr.write(_("Run {} of {}").format(run + 1, options["runs"]))
+                result = {}
+                for method in METHODS:
+                    result[method] = {
+                        "packages": self.insert_packages(
+                            f"{token}-{run}-{method}", options, method
+                        ),
+                        "advisories": self.insert_advisory_children(
+                            update_records, options, method
+                        ),
+                    }
+                results["runs"].append(result)
+        finally:
+            UpdateRecord.objects.filter(pk__in=[record.pk for record in update_records]).delete()
+
+        if options["output"] == "-":
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+
+    def insert_packages(self, token, options, method):
+        """
+        Measure inserting synthetic packages once.
+
+        Args:
+            token (str): Makes the packages unique.
+            options (dict): The command line options.
+            method (str): "orm" or "copy"
+
+        Returns:
+            float: the duration in seconds
+
+        """
+        packages = [
+            synthetic_package(token, index, options["files"], options["changelogs"])
+            for index in range(options["packages"])
+        ]
+        try:
+            start = time.perf_counter()
+            with transaction.atomic():
+                if method == "copy":
+                    copy_insert_content(Package, packages)
+                else:
+                    for package in packages:
+                        try:
+                            with transaction.atomic():
+                                package.save()
+                        except IntegrityError:
+                            pass
+            return round(time.perf_counter() - start, 3)
+        finally:
+            Package.objects.filter(pkgId__in=[package.pkgId for package in packages]).delete()
+
+    def insert_advisory_children(self, update_records, options, method):
+        """
+        Measure inserting the collections, collection packages and references of advisories once.
+
+        Args:
+            update_records (list): The saved advisories.
+            options (dict): The command line options.
+            method (str): "orm" or "copy"
+
+        Returns:
+            float: the duration in seconds
+
+        """
+        children = advisory_children(
+            update_records, options["packages_per_advisory"], options["references"]
+        )
+        models = (UpdateCollection, UpdateCollectionPackage, UpdateReference)
+        try:
+            start = time.perf_counter()
+            with transaction.atomic():
+                for model, objs in zip(models, children):
+                    if method == "copy":
+                        copy_insert(model, objs)
+                    else:
+                        model.objects.bulk_create(objs, ignore_conflicts=True)
+            return round(time.perf_counter() - start, 3)
+        finally:
+            UpdateCollection.objects.filter(update_record__in=update_records).delete()
+            UpdateReference.objects.filter(update_record__in=update_records).delete()
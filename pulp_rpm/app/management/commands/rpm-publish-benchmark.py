@@ -0,0 +1,471 @@
+import hashlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from gettext import gettext as _
+
+import createrepo_c as cr
+import libcomps
+import yaml
+from django.core.management import BaseCommand
+from django.db import transaction
+from pulpcore.app.util import current_task
+from pulpcore.plugin.constants import TASK_STATES
+from pulpcore.plugin.models import Content, ContentArtifact, Task
+
+from pulp_rpm.app.advisory import hash_update_record
+from pulp_rpm.app.comps import dict_digest
+from pulp_rpm.app.constants import COMPRESSION_TYPES, LAYOUT_TYPES
+from pulp_rpm.app.models import (
+    Modulemd,
+    Package,
+    PackageGroup,
+    RpmPublication,
+    RpmRepository,
+    UpdateCollection,
+    UpdateCollectionPackage,
+    UpdateRecord,
+)
+from pulp_rpm.app.modulemd import create_modulemd
+from pulp_rpm.app.tasks.publishing import PublicationData, generate_repo_metadata, publish
+
+MODULEMD_TEMPLATE = """---
+document: modulemd
+version: 2
+data:
+  name: {name}
+  stream: "1"
+  version: 1
+  context: benchmark
+  arch: x86_64
+  summary: Synthetic module {name}
+  description: Synthetic module {name} generated by rpm-publish-benchmark.
+  license:
+    module:
+    - MIT
+  artifacts:
+    rpms:
+{rpms}
+..."""
+
+
+def listed_packages(packages, index, count):
+    """
+    Pick the packages listed by the n-th advisory, module or group, cycling through all of them.
+    """
+    if not packages:
+        return []
+    start = index * count % len(packages)
+    return packages[start : start + count]
+
+
+@contextmanager
+def measure(trace_memory=False):
+    """
+    Measure the duration and memory usage of a block of code.
+
+    Args:
+        trace_memory (bool): Whether to trace the peak of memory allocated by Python, which
+            slows the measured code down considerably.
+
+    Yields:
+        dict: the results, filled in once the block has finished
+
+    """
+    result = {}
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        if trace_memory:
+            result["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # kilobytes on Linux
+        result["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def benchmark_task():
+    """
+    Run a block of code as part of a throwaway Task.
+
+    The publish code reports its progress, and ProgressReports can only be saved for a Task, so
+    one is created for the benchmark as a worker would do, and deleted along with its
+    ProgressReports afterwards.
+
+    Yields:
+        pulpcore.plugin.models.Task: the task
+
+    """
+    task = Task.objects.create(
+        name="rpm-publish-benchmark", state=TASK_STATES.RUNNING, logging_cid=uuid.uuid4().hex
+    )
+    token = current_task.set(task)
+    try:
+        yield task
+    finally:
+        current_task.reset(token)
+        task.delete()
+
+
+def synthetic_package(token, index, files, changelogs):
+    """
+    Create a createrepo_c package with synthetic data.
+
+    Args:
+        token (str): Makes the package unique to this benchmark run.
+        index (int): The number of the package.
+        files (int): The number of files of the package.
+        changelogs (int): The number of changelogs of the package.
+
+    Returns:
+        createrepo_c.Package: the package
+
+    """
+    pkg = cr.Package()
+    pkg.name = f"benchmark-{index}"
+    pkg.epoch = "0"
+    pkg.version = "1.0"
+    pkg.release = "1"
+    pkg.arch = "x86_64"
+    pkg.pkgId = hashlib.sha256(f"{token}-{index}".encode()).hexdigest()
+    pkg.checksum_type = "sha256"
+    pkg.summary = f"Synthetic package {index}"
+    pkg.description = f"Synthetic package {index} generated by rpm-publish-benchmark."
+    pkg.url = "https://example.com/"
+    pkg.location_href = f"{pkg.name}-1.0-1.x86_64.rpm"
+    pkg.rpm_license = "MIT"
+    pkg.rpm_vendor = "Pulp"
+    pkg.rpm_group = "Unspecified"
+    pkg.rpm_buildhost = "localhost"
+    pkg.rpm_sourcerpm = f"{pkg.name}-1.0-1.src.rpm"
+    pkg.rpm_packager = "Pulp"
+    pkg.rpm_header_start = 4504
+    pkg.rpm_header_end = 8192
+    pkg.size_package = 10240
+    pkg.size_installed = 20480
+    pkg.size_archive = 20480
+    pkg.time_file = 1700000000
+    pkg.time_build = 1700000000 + index
+    pkg.provides = [(pkg.name, "EQ", "0", "1.0", "1", False)]
+    pkg.requires = [("glibc", None, None, None, None, False)]
+    pkg.files = [("", f"/usr/share/{pkg.name}/", f"file-{number}") for number in range(files)]
+    pkg.changelogs = [
+        ("Pulp <pulp@example.com> - 1.0-1", 1700000000 + number, f"- change {number}")
+        for number in range(changelogs)
+    ]
+    return pkg
+
+
+def synthetic_update_record(token, index, packages):
+    """
+    Create a createrepo_c advisory with synthetic data.
+
+    Args:
+        token (str): Makes the advisory unique to this benchmark run.
+        index (int): The number of the advisory.
+        packages (list): createrepo_c packages the advisory lists.
+
+    Returns:
+        createrepo_c.UpdateRecord: the advisory
+
+    """
+    rec = cr.UpdateRecord()
+    rec.id = f"BENCHMARK-{token}-{index}"
+    rec.issued_date = datetime(2024, 1, 1)
+    rec.fromstr = "pulp@example.com"
+    rec.status = "final"
+    rec.title = f"Synthetic advisory {index}"
+    rec.summary = f"Synthetic advisory {index}"
+    rec.description = f"Synthetic advisory {index} generated by rpm-publish-benchmark."
+    rec.version = "1"
+    rec.type = "bugfix"
+    rec.severity = "Low"
+    rec.release = "1"
+
+    collection = cr.UpdateCollection()
+    collection.name = "benchmark"
+    collection.shortname = "benchmark"
+    for pkg in packages:
+        collection_package = cr.UpdateCollectionPackage()
+        collection_package.name = pkg.name
+        collection_package.epoch = pkg.epoch
+        collection_package.version = pkg.version
+        collection_package.release = pkg.release
+        collection_package.arch = pkg.arch
+        collection_package.filename = pkg.location_href
+        collection_package.sum = pkg.pkgId
+        collection_package.sum_type = cr.SHA256
+        collection.append(collection_package)
+    rec.append_collection(collection)
+    return rec
+
+
+def synthetic_group(index, packages):
+    """
+    Create a libcomps group with synthetic data.
+
+    Args:
+        index (int): The number of the group.
+        packages (list): createrepo_c packages the group lists.
+
+    Returns:
+        libcomps.Group: the group
+
+    """
+    group = libcomps.Group()
+    group.id = f"benchmark-{index}"
+    group.name = f"Synthetic group {index}"
+    group.desc = f"Synthetic group {index} generated by rpm-publish-benchmark."
+    for pkg in packages:
+        group.packages.append(libcomps.Package(pkg.name, libcomps.PACKAGE_TYPE_MANDATORY))
+    return group
+
+
+class Command(BaseCommand):
+    """
+    Django management command for benchmarking the publication of synthetic RPM repositories.
+
+    A repository is created with the requested amount of synthetic content, which is saved
+    directly to the database (packages are saved without Artifacts, as if they were synced
+    with the on_demand policy). Then PublicationData.populate(), generate_repo_metadata() and
+    the whole publish() are timed separately, as part of a throwaway Task, and the results are
+    written as JSON. The repository and its content are deleted afterwards unless --keep is
+    used.
+    """
+
+    help = _(__doc__)
+
+    def add_arguments(self, parser):
+        """Set up arguments."""
+        parser.add_argument(
+            "--packages", type=int, default=1000, help=_("Number of packages to generate.")
+        )
+        parser.add_argument("--files", type=int, default=10, help=_("Number of files per package."))
+        parser.add_argument(
+            "--changelogs", type=int, default=3, help=_("Number of changelogs per package.")
+        )
+        parser.add_argument(
+            "--advisories", type=int, default=100, help=_("Number of advisories to generate.")
+        )
+        parser.add_argument(
+            "--modules", type=int, default=10, help=_("Number of modules to generate.")
+        )
+        parser.add_argument(
+            "--groups", type=int, default=10, help=_("Number of package groups to generate.")
+        )
+        parser.add_argument(
+            "--packages-per-item",
+            type=int,
+            default=5,
+            help=_("Number of packages listed by each advisory, module and package group."),
+        )
+        parser.add_argument(
+            "--compression-type",
+            choices=[COMPRESSION_TYPES.GZ, COMPRESSION_TYPES.ZSTD],
+            default=COMPRESSION_TYPES.GZ,
+            help=_("Compression type of the metadata."),
+        )
+        parser.add_argument(
+            "--runs", type=int, default=1, help=_("Number of times to repeat the measurements.")
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help=_("Trace the peak memory allocated by Python, this slows publishing down."),
+        )
+        parser.add_argument("--output", default="-", help=_("File to write the JSON results to."))
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help=_("Keep the repository and its content after the benchmark."),
+        )
+
+    def handle(self, *args, **options):
+        """Implement the command."""
+        token = uuid.uuid4().hex[:12]
+        repository = RpmRepository.objects.create(name=f"rpm-publish-benchmark-{token}")
+        parameters = {
+            name: options[name]
+            for name in (
+                "packages",
+                "files",
+                "changelogs",
+                "advisories",
+                "modules",
+                "groups",
+                "packages_per_item",
+                "compression_type",
+                "trace_memory",
+            )
+        }
+        results = {"parameters": parameters, "repository": repository.name, "runs": []}
+        content_pks = []
+
+        try:
+            with measure() as results["generate_content"]:
+                content_pks = self.create_content(token, options)
+                with repository.new_version() as version:
+                    version.add_content(Content.objects.filter(pk__in=content_pks))
+            with benchmark_task():
+                for run in range(options["runs"]):
+                    self.stderr.write(_("Run {} of {}").format(run + 1, options["runs"]))
+                    results["runs"].append(self.run(version, options))
+        finally:
+            if not options["keep"]:
+                self.cleanup(repository, content_pks)
+
+        if options["output"] == "-":
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+
+    def create_content(self, token, options):
+        """
+        Save the synthetic content.
+
+        Args:
+            token (str): Makes the content unique to this benchmark run.
+            options (dict): The command line options.
+
+        Returns:
+            list: pks of the created content
+
+        """
+        content_pks = []
+        per_item = options["packages_per_item"]
+        packages = [
+            synthetic_package(token, index, options["files"], options["changelogs"])
+            for index in range(options["packages"])
+        ]
+
+        with transaction.atomic():
+            saved_packages = []
+            for pkg in packages:
+                package = Package(**Package.createrepo_to_dict(pkg))
+                package.save()
+                saved_packages.append(package)
+            ContentArtifact.objects.bulk_create(
+                [
+                    ContentArtifact(
+                        content=package, relative_path=package.location_href, artifact=None
+                    )
+                    for package in saved_packages
+                ],
+                batch_size=1000,
+            )
+            content_pks.extend(package.pk for package in saved_packages)
+
+            for index in range(options["advisories"]):
+                listed = listed_packages(packages, index, per_item)
+                update = synthetic_update_record(token, index, listed)
+                update_record = UpdateRecord(**UpdateRecord.createrepo_to_dict(update))
+                update_record.digest = hash_update_record(update)
+                update_record.save()
+                for collection in update.collections:
+                    coll = UpdateCollection(**UpdateCollection.createrepo_to_dict(collection))
+                    coll.update_record = update_record
+                    coll.save()
+                    UpdateCollectionPackage.objects.bulk_create(
+                        [
+                            UpdateCollectionPackage(
+                                **UpdateCollectionPackage.createrepo_to_dict(collection_package),
+                                update_collection=coll,
+                            )
+                            for collection_package in collection.packages
+                        ]
+                    )
+                content_pks.append(update_record.pk)
+
+            for index in range(options["modules"]):
+                listed = listed_packages(saved_packages, index, per_item)
+                rpms = "\n".join(f"    - {package.nevra}" for package in listed) or "    []"
+                snippet = MODULEMD_TEMPLATE.format(name=f"benchmark-{token}-{index}", rpms=rpms)
+                modulemd = Modulemd(**create_modulemd(yaml.safe_load(snippet), snippet))
+                modulemd.save()
+                modulemd.packages.set(listed)
+                content_pks.append(modulemd.pk)
+
+            for index in range(options["groups"]):
+                listed = listed_packages(packages, index, per_item)
+                group_dict = PackageGroup.libcomps_to_dict(synthetic_group(index, listed))
+                group_dict["id"] = f"benchmark-{token}-{index}"
+                group_dict["digest"] = dict_digest(group_dict)
+                group = PackageGroup(**group_dict)
+                group.save()
+                content_pks.append(group.pk)
+
+        return content_pks
+
+    def run(self, version, options):
+        """
+        Measure publishing the repository version once.
+
+        Args:
+            version (pulpcore.plugin.models.RepositoryVersion): The version to publish.
+            options (dict): The command line options.
+
+        Returns:
+            dict: the measurements of each phase
+
+        """
+        result = {}
+        trace_memory = options["trace_memory"]
+        compression_type = options["compression_type"]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as working_dir:
+            os.chdir(working_dir)
+            try:
+                with RpmPublication.create(version) as publication:
+                    publication.checksum_type = "sha256"
+                    publication.metadata_checksum_type = "sha256"
+                    publication.package_checksum_type = "sha256"
+                    publication.compression_type = compression_type
+                    publication.layout = LAYOUT_TYPES.NESTED_ALPHABETICALLY
+
+                    publication_data = PublicationData(publication, {})
+                    with measure(trace_memory) as result["populate"]:
+                        publication_data.populate()
+
+                    with measure(trace_memory) as result["generate_repo_metadata"]:
+                        generate_repo_metadata(
+                            version.content,
+                            publication,
+                            {},
+                            publication_data.repomdrecords,
+                            compression_type=compression_type,
+                            package_selection=publication_data.package_selection,
+                        )
+                publication.delete()
+
+                with measure(trace_memory) as result["publish"]:
+                    publication = publish(version.pk, compression_type=compression_type)
+                publication.delete()
+            finally:
+                os.chdir(cwd)
+        return result
+
+    def cleanup(self, repository, content_pks):
+        """
+        Delete the repository and its content.
+
+        Args:
+            repository (pulp_rpm.app.models.RpmRepository): The benchmark repository.
+            content_pks (list): pks of the created content.
+
+        """
+        repository.delete()
+        for model in (UpdateRecord, Modulemd, PackageGroup, Package):
+            model.objects.filter(pk__in=content_pks).delete()
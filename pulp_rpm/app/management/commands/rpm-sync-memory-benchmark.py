@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from collections import deque
+from gettext import gettext as _
+from types import SimpleNamespace
+
+import createrepo_c as cr
+from django.core.management import BaseCommand
+from django.db import connections
+
+from pulp_rpm.app.tasks.synchronizing import RpmFirstStage
+
+METHODS = ("full", "packed")
+
+
+def max_rss_bytes():
+    """The peak resident set size of the current process, in bytes."""
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synthetic_package(index, files, changelogs, dependencies):
+    """
+    Create a createrepo_c package with synthetic data.
+
+    Args:
+        index (int): The number of the package.
+        files (int): The number of files of the package.
+        changelogs (int): The number of changelogs of the package.
+        dependencies (int): The number of requires and of provides of the package.
+
+    Returns:
+        createrepo_c.Package: the package
+
+    """
+    pkg = cr.Package()
+    pkg.name = f"memory-benchmark-{index}"
+    pkg.epoch = "0"
+    pkg.version = "1.0"
+    pkg.release = "1"
+    pkg.arch = "x86_64"
+    pkg.pkgId = hashlib.sha256(str(index).encode()).hexdigest()
+    pkg.checksum_type = "sha256"
+    pkg.summary = f"Synthetic package {index}"
+    pkg.description = f"Synthetic package {index} generated by rpm-sync-memory-benchmark."
+    pkg.location_href = f"Packages/{pkg.name}-1.0-1.x86_64.rpm"
+    pkg.rpm_header_start = 4504
+    pkg.rpm_header_end = 8192
+    pkg.size_package = 10240
+    pkg.size_installed = 20480
+    pkg.size_archive = 20480
+    pkg.time_file = 1700000000
+    pkg.time_build = 1700000000
+    pkg.provides = [
+        (f"{pkg.name}-provide-{number}", "EQ", "0", "1.0", "1", False)
+        for number in range(dependencies)
+    ]
+    pkg.requires = [
+        (f"memory-benchmark-require-{number}", None, None, None, None, False)
+        for number in range(dependencies)
+    ]
+    pkg.files = [("", f"/usr/share/{pkg.name}/", f"file-{number}") for number in range(files)]
+    pkg.changelogs = [
+        ("Pulp <pulp@example.com> - 1.0-1", 1700000000 + number, f"- change {number}")
+        for number in range(changelogs)
+    ]
+    return pkg
+
+
+def simulate_sync(method, options, sender):
+    """
+    Pass synthetic packages through the first stage of a sync and hold them like the pipeline.
+
+    The last `in_flight` DeclarativeContents are kept. Each one dropped from them is unpacked,
+    as RpmContentSaver does before saving it.
+
+    Args:
+        method (str): "full" or "packed"
+        options (dict): The command line options.
+        sender (multiprocessing.connection.Connection): Where to send the results, as a dict
+
+    """
+    stage = RpmFirstStage(
+        SimpleNamespace(url="http://example.com/repo/"),
+        None,
+        deferred_download=True,
+        mirror_metadata=False,
+    )
+    stage.compact_packages = method == "packed"
+    in_flight = deque()
+
+    async def put(dc):
+        in_flight.append(dc)
+        if len(in_flight) > options["in_flight"]:
+            saved = in_flight.popleft()
+            packed_fields = saved.extra_data.pop("packed_fields", None)
+            if packed_fields is not None:
+                packed_fields.unpack_into(saved.content)
+
+    stage.put = put
+
+    async def run():
+        for index in range(options["packages"]):
+            pkg = synthetic_package(
+                index, options["files"], options["changelogs"], options["dependencies"]
+            )
+            package, packed_fields = stage.package_from_createrepo(pkg)
+            location_base = pkg.location_base
+            del pkg
+            await stage.put_package(package, location_base, packed_fields)
+
+    baseline = max_rss_bytes()
+    start = time.perf_counter()
+    asyncio.run(run())
+    sender.send(
+        {
+            "seconds": round(time.perf_counter() - start, 3),
+            "baseline_rss_bytes": baseline,
+            "max_rss_bytes": max_rss_bytes(),
+        }
+    )
+
+
+class Command(BaseCommand):
+    """
+    Django management command for measuring the memory used by packages in flight during sync.
+
+    Synthetic packages are converted into DeclarativeContents by the first stage of a sync, and
+    the number of them the sync pipeline holds at once is kept in memory, once with full Package
+    instances and once with their bulky fields packed, as with the RPM_SYNC_COMPACT_PACKAGES
+    setting. Each run happens in a separate process, and its peak RSS is written as JSON. Nothing
+    is saved to the database and no network access is needed.
+    """
+
+    help = _(__doc__)
+
+    def add_arguments(self, parser):
+        """Set up arguments."""
+        parser.add_argument(
+            "--packages", type=int, default=100000, help=_("Number of packages to sync.")
+        )
+        parser.add_argument("--files", type=int, default=30, help=_("Number of files per package."))
+        parser.add_argument(
+            "--changelogs", type=int, default=10, help=_("Number of changelogs per package.")
+        )
+        parser.add_argument(
+            "--dependencies",
+            type=int,
+            default=10,
+            help=_("Number of requires and of provides per package."),
+        )
+        parser.add_argument(
+            "--in-flight",
+            type=int,
+            default=2000,
+            help=_("Number of packages held by the sync pipeline at once."),
+        )
+        parser.add_argument("--output", default="-", help=_("File to write the JSON results to."))
+
+    def handle(self, *args, **options):
+        """Implement the command."""
+        parameters = {
+            name: options[name]
+            for name in ("packages", "files", "changelogs", "dependencies", "in_flight")
+        }
+        results = {"parameters": parameters}
+
+        # a fresh process per method, as the peak RSS of a process never decreases
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        for method in METHODS:
+            self.stderr.write(_("Measuring {}").format(method))
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=simulate_sync, args=(method, options, sender))
+            process.start()
+            sender.close()
+            results[method] = receiver.recv()
+            process.join()
+
+        if options["output"] == "-":
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import uuid
+
+from django.conf import settings
+
+
+class MetadataCache:
+    """
+    A worker-local cache of repository metadata files downloaded from remotes.
+
+    Files are stored by the type and checksum of their repomd.xml record, which identify their
+    content, so an unchanged upstream file is never downloaded again. The least recently used
+    files are evicted once the cache exceeds its maximum size.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        Args:
+            directory (str): The directory holding the cached files
+            max_size (int): The maximum total size of the cached files in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, record_type, checksum_type, checksum):
+        return os.path.join(self.directory, f"{record_type}-{checksum_type}-{checksum}")
+
+    def get(self, record_type, checksum_type, checksum, filename):
+        """
+        Get a cached metadata file.
+
+        The file is linked (or copied, if that isn't possible) into a new directory within the
+        current working directory, so it stays available even if it's evicted meanwhile.
+
+        Args:
+            record_type (str): The type of the repomd.xml record
+            checksum_type (str): The checksum type of the repomd.xml record
+            checksum (str): The checksum of the repomd.xml record
+            filename (str): The name of the file to create
+
+        Returns:
+            str: The path of the file, or None if it's not cached
+
+        """
+        cached_path = self._path(record_type, checksum_type, checksum)
+        if not os.path.exists(cached_path):
+            return None
+        path = os.path.join(tempfile.mkdtemp(dir="."), filename)
+        try:
+            os.link(cached_path, path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            shutil.copyfile(cached_path, path)
+        # the modification time orders the files for eviction
+        os.utime(cached_path)
+        return path
+
+    def add(self, record_type, checksum_type, checksum, path):
+        """
+        Add a downloaded metadata file to the cache and evict the least recently used files.
+
+        Args:
+            record_type (str): The type of the repomd.xml record
+            checksum_type (str): The checksum type of the repomd.xml record
+            checksum (str): The checksum of the repomd.xml record
+            path (str): The path of the downloaded file, which must have been validated against
+                the checksum
+
+        """
+        cached_path = self._path(record_type, checksum_type, checksum)
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4()}")
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache doesn't exceed its size."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _mtime, entry_size, _path in entries)
+        for _mtime, entry_size, entry_path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+def get_metadata_cache():
+    """
+    Get the metadata cache of this worker.
+
+    Returns:
+        MetadataCache: The cache, or None if it's disabled
+
+    """
+    if not settings.RPM_METADATA_CACHE_DIR:
+        return None
+    return MetadataCache(settings.RPM_METADATA_CACHE_DIR, settings.RPM_METADATA_CACHE_SIZE)
@@ -1,4 +1,5 @@
 from logging import getLogger
+from xml.sax.saxutils import escape
 
 import createrepo_c as cr
 
@@ -7,7 +8,7 @@ from django.db import models
 from django.db.models import Window, F
 from django.db.models.functions import RowNumber
 
-from pulpcore.plugin.models import Content, ContentManager
+from pulpcore.plugin.models import BaseModel, Content, ContentManager
 from pulpcore.plugin.util import get_domain_pk
 
 from pulp_rpm.app.constants import (
@@ -55,6 +56,21 @@ class PackageManager(ContentManager):
             )
         )
 
+    def with_build_rank(self):
+        """Provide a "build_rank" score for each Package object in the queryset.
+
+        Packages are partitioned by NEVRA and ordered by build time within each partition, so
+        the most recently built package gets build_rank=1 and any other package with the same
+        NEVRA (but a different checksum) a higher rank. Packages without a build time rank last.
+        """
+        return self.annotate(
+            build_rank=Window(
+                expression=RowNumber(),
+                partition_by=[F("name"), F("epoch"), F("version"), F("release"), F("arch")],
+                order_by=[F("time_build").desc(nulls_last=True), F("pk")],
+            )
+        )
+
 
 class Package(Content):
     """
@@ -300,6 +316,36 @@ class Package(Content):
     class ReadonlyMeta:
         readonly = ["evr"]
 
+    @classmethod
+    def createrepo_to_reference_dict(cls, package):
+        """
+        Convert createrepo_c package object to dict for referring to an existing Package object.
+
+        Only the natural key of the package and the data needed to download it are converted,
+        which only requires the package to be parsed from primary.xml.
+
+        Args:
+            package(createrepo_c.Package): a RPM/SRPM package to convert
+
+        Returns:
+            dict: data for instantiating an unsaved Package object with the natural key of an
+                existing one
+
+        """
+        return {
+            PULP_PACKAGE_ATTRS.ARCH: getattr(package, CR_PACKAGE_ATTRS.ARCH),
+            PULP_PACKAGE_ATTRS.CHECKSUM_TYPE: getattr(
+                CHECKSUM_TYPES, getattr(package, CR_PACKAGE_ATTRS.CHECKSUM_TYPE).upper()
+            ),
+            PULP_PACKAGE_ATTRS.EPOCH: getattr(package, CR_PACKAGE_ATTRS.EPOCH) or "0",
+            PULP_PACKAGE_ATTRS.LOCATION_HREF: getattr(package, CR_PACKAGE_ATTRS.LOCATION_HREF),
+            PULP_PACKAGE_ATTRS.NAME: getattr(package, CR_PACKAGE_ATTRS.NAME),
+            PULP_PACKAGE_ATTRS.PKGID: getattr(package, CR_PACKAGE_ATTRS.PKGID),
+            PULP_PACKAGE_ATTRS.RELEASE: getattr(package, CR_PACKAGE_ATTRS.RELEASE),
+            PULP_PACKAGE_ATTRS.SIZE_PACKAGE: getattr(package, CR_PACKAGE_ATTRS.SIZE_PACKAGE),
+            PULP_PACKAGE_ATTRS.VERSION: getattr(package, CR_PACKAGE_ATTRS.VERSION),
+        }
+
     @classmethod
     def createrepo_to_dict(cls, package):
         """
@@ -381,6 +427,109 @@ class Package(Content):
             PULP_PACKAGE_ATTRS.VERSION: getattr(package, CR_PACKAGE_ATTRS.VERSION),
         }
 
+    # The fields which make up the repository metadata of a package, in the order expected by
+    # `createrepo_c_from_values()`. Can be passed to `values_list()` to avoid instantiating
+    # whole Package objects.
+    CREATEREPO_FIELDS = (
+        PULP_PACKAGE_ATTRS.ARCH,
+        PULP_PACKAGE_ATTRS.CHANGELOGS,
+        PULP_PACKAGE_ATTRS.CHECKSUM_TYPE,
+        PULP_PACKAGE_ATTRS.CONFLICTS,
+        PULP_PACKAGE_ATTRS.DESCRIPTION,
+        PULP_PACKAGE_ATTRS.ENHANCES,
+        PULP_PACKAGE_ATTRS.EPOCH,
+        PULP_PACKAGE_ATTRS.FILES,
+        PULP_PACKAGE_ATTRS.LOCATION_HREF,
+        PULP_PACKAGE_ATTRS.NAME,
+        PULP_PACKAGE_ATTRS.OBSOLETES,
+        PULP_PACKAGE_ATTRS.PKGID,
+        PULP_PACKAGE_ATTRS.PROVIDES,
+        PULP_PACKAGE_ATTRS.RECOMMENDS,
+        PULP_PACKAGE_ATTRS.RELEASE,
+        PULP_PACKAGE_ATTRS.REQUIRES,
+        PULP_PACKAGE_ATTRS.RPM_BUILDHOST,
+        PULP_PACKAGE_ATTRS.RPM_GROUP,
+        PULP_PACKAGE_ATTRS.RPM_HEADER_END,
+        PULP_PACKAGE_ATTRS.RPM_HEADER_START,
+        PULP_PACKAGE_ATTRS.RPM_LICENSE,
+        PULP_PACKAGE_ATTRS.RPM_PACKAGER,
+        PULP_PACKAGE_ATTRS.RPM_SOURCERPM,
+        PULP_PACKAGE_ATTRS.RPM_VENDOR,
+        PULP_PACKAGE_ATTRS.SIZE_ARCHIVE,
+        PULP_PACKAGE_ATTRS.SIZE_INSTALLED,
+        PULP_PACKAGE_ATTRS.SIZE_PACKAGE,
+        PULP_PACKAGE_ATTRS.SUGGESTS,
+        PULP_PACKAGE_ATTRS.SUMMARY,
+        PULP_PACKAGE_ATTRS.SUPPLEMENTS,
+        PULP_PACKAGE_ATTRS.TIME_BUILD,
+        PULP_PACKAGE_ATTRS.TIME_FILE,
+        PULP_PACKAGE_ATTRS.URL,
+        PULP_PACKAGE_ATTRS.VERSION,
+    )
+
+    # JSON fields which hold lists of lists, createrepo_c expects lists of tuples instead
+    CREATEREPO_LIST_FIELDS = frozenset(
+        (
+            PULP_PACKAGE_ATTRS.CHANGELOGS,
+            PULP_PACKAGE_ATTRS.CONFLICTS,
+            PULP_PACKAGE_ATTRS.ENHANCES,
+            PULP_PACKAGE_ATTRS.FILES,
+            PULP_PACKAGE_ATTRS.OBSOLETES,
+            PULP_PACKAGE_ATTRS.PROVIDES,
+            PULP_PACKAGE_ATTRS.RECOMMENDS,
+            PULP_PACKAGE_ATTRS.REQUIRES,
+            PULP_PACKAGE_ATTRS.SUGGESTS,
+            PULP_PACKAGE_ATTRS.SUPPLEMENTS,
+        )
+    )
+
+    @classmethod
+    def createrepo_c_from_values(cls, values):
+        """
+        Convert the values of `CREATEREPO_FIELDS` to a createrepo_c package object.
+
+        Args:
+            values(iterable): field values, in the order of `CREATEREPO_FIELDS`
+
+        Returns:
+            createrepo_c.Package: package itself in a format of a createrepo_c package object
+
+        """
+        package = cr.Package()
+        for field, value in zip(cls.CREATEREPO_FIELDS, values):
+            if field in cls.CREATEREPO_LIST_FIELDS:
+                # The assumption is that there are no nested lists, which is true for the data
+                # on the Package model at the moment.
+                value = [tuple(item) if isinstance(item, list) else item for item in value]
+            elif field == PULP_PACKAGE_ATTRS.CHECKSUM_TYPE:
+                value = getattr(CHECKSUM_TYPES, value.upper())
+            setattr(package, field, value)
+        package.location_base = ""  # TODO: delete this entirely
+        return package
+
+    @classmethod
+    def iter_createrepo_c(cls, queryset, chunk_size=2000):
+        """
+        Stream the packages of a queryset as createrepo_c package objects.
+
+        Only the columns needed for the repository metadata are fetched, using a server-side
+        cursor, and no Package objects are created. Memory usage is bound by `chunk_size` rather
+        than by the number of packages.
+
+        Args:
+            queryset(django.db.models.QuerySet): the packages to convert, in the desired order
+
+        Keyword Args:
+            chunk_size(int): the number of rows fetched from the database at once
+
+        Yields:
+            tuple: the pk of the package and the createrepo_c package object
+
+        """
+        fields = ("pk",) + cls.CREATEREPO_FIELDS
+        for pk, *values in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+            yield pk, cls.createrepo_c_from_values(values)
+
     def to_createrepo_c(self):
         """
         Convert Package object to a createrepo_c package object.
@@ -392,67 +541,124 @@ class Package(Content):
             createrepo_c.Package: package itself in a format of a createrepo_c package object
 
         """
+        return self.createrepo_c_from_values(
+            getattr(self, field) for field in self.CREATEREPO_FIELDS
+        )
 
-        def list_to_createrepo_c(lst):
-            """
-            Convert list to createrepo_c format.
 
-            Createrepo_c expects list of tuples, not list of lists.
-            The assumption is that there are no nested lists, which is true for the data on the
-            Package model at the moment.
+class PackageMetadataFragments(BaseModel):
+    """
+    The pre-rendered primary, filelists and other XML of a Package.
 
-            Args:
-                lst(list): a list
+    A Package is immutable, so its XML is the same in every publication, except for the checksum
+    (which can be overridden by the publication), the location of the package and the file time.
+    These are rendered as placeholders and substituted when the fragments are published.
 
-            Returns:
-                list: list of strings and/or tuples
+    Fields:
+        primary (Text):
+            The <package> element of primary.xml
+        filelists (Text):
+            The <package> element of filelists.xml
+        other (Text):
+            The <package> element of other.xml
 
-            """
-            createrepo_c_list = []
-            for item in lst:
-                if isinstance(item, list):
-                    createrepo_c_list.append(tuple(item))
-                else:
-                    createrepo_c_list.append(item)
+    Relations:
 
-            return createrepo_c_list
+        package (models.OneToOneField): The Package the fragments were rendered from
 
-        package = cr.Package()
-        package.arch = getattr(self, PULP_PACKAGE_ATTRS.ARCH)
-        package.changelogs = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.CHANGELOGS))
-        package.checksum_type = getattr(
-            CHECKSUM_TYPES, getattr(self, PULP_PACKAGE_ATTRS.CHECKSUM_TYPE).upper()
+    """
+
+    CHECKSUM_TYPE_PLACEHOLDER = "@@PULP_CHECKSUM_TYPE@@"
+    PKGID_PLACEHOLDER = "@@PULP_PKGID@@"
+    LOCATION_HREF_PLACEHOLDER = "@@PULP_LOCATION_HREF@@"
+
+    primary = models.TextField()
+    filelists = models.TextField()
+    other = models.TextField()
+
+    package = models.OneToOneField(
+        Package, on_delete=models.CASCADE, related_name="metadata_fragments"
+    )
+
+    @classmethod
+    def from_createrepo_c(cls, pk, package):
+        """
+        Render the fragments of a package.
+
+        Args:
+            pk (str): The pk of the Package
+            package (createrepo_c.Package): The package, see `Package.iter_createrepo_c()`
+
+        Returns:
+            PackageMetadataFragments: the unsaved fragments
+
+        """
+        package.checksum_type = cls.CHECKSUM_TYPE_PLACEHOLDER
+        package.pkgId = cls.PKGID_PLACEHOLDER
+        package.location_href = cls.LOCATION_HREF_PLACEHOLDER
+        package.time_file = 0
+        primary, filelists, other = cr.xml_dump(package)
+        return cls(package_id=pk, primary=primary, filelists=filelists, other=other)
+
+    @classmethod
+    def create_missing(cls, packages, batch_size=1000):
+        """
+        Render and store the fragments of the packages which don't have any yet.
+
+        Args:
+            packages (django.db.models.QuerySet): the packages
+
+        Keyword Args:
+            batch_size(int): the number of fragments stored at once
+
+        """
+        missing = packages.filter(metadata_fragments__isnull=True).order_by()
+        batch = []
+        for pk, package in Package.iter_createrepo_c(missing):
+            batch.append(cls.from_createrepo_c(pk, package))
+            if len(batch) >= batch_size:
+                cls.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        if batch:
+            cls.objects.bulk_create(batch, ignore_conflicts=True)
+
+    @classmethod
+    def render(cls, fragments, checksum_type, pkgid, location_href, time_file):
+        """
+        Substitute the publication specific values into the fragments of a package.
+
+        Args:
+            fragments (tuple): the primary, filelists and other fragments
+            checksum_type (str): The checksum type of the package
+            pkgid (str): The checksum of the package
+            location_href (str): The location of the package within the publication
+            time_file (int): The 'file' time of the package
+
+        Returns:
+            tuple: the primary, filelists and other XML of the package
+
+        """
+        primary, filelists, other = fragments
+        location_href = escape(location_href, {'"': "&quot;"})
+        # Replace whole tags, the escaped package data can't contain any of them.
+        primary = (
+            primary.replace(
+                f'<checksum type="{cls.CHECKSUM_TYPE_PLACEHOLDER}" '
+                f'pkgid="YES">{cls.PKGID_PLACEHOLDER}</checksum>',
+                f'<checksum type="{checksum_type}" pkgid="YES">{pkgid}</checksum>',
+                1,
+            )
+            .replace('<time file="0" ', f'<time file="{int(time_file)}" ', 1)
+            .replace(
+                f'<location href="{cls.LOCATION_HREF_PLACEHOLDER}"/>',
+                f'<location href="{location_href}"/>',
+                1,
+            )
         )
-        package.conflicts = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.CONFLICTS))
-        package.description = getattr(self, PULP_PACKAGE_ATTRS.DESCRIPTION)
-        package.enhances = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.ENHANCES))
-        package.epoch = getattr(self, PULP_PACKAGE_ATTRS.EPOCH)
-        package.files = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.FILES))
-        package.location_base = ""  # TODO: delete this entirely
-        package.location_href = getattr(self, PULP_PACKAGE_ATTRS.LOCATION_HREF)
-        package.name = getattr(self, PULP_PACKAGE_ATTRS.NAME)
-        package.obsoletes = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.OBSOLETES))
-        package.pkgId = getattr(self, PULP_PACKAGE_ATTRS.PKGID)
-        package.provides = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.PROVIDES))
-        package.recommends = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.RECOMMENDS))
-        package.release = getattr(self, PULP_PACKAGE_ATTRS.RELEASE)
-        package.requires = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.REQUIRES))
-        package.rpm_buildhost = getattr(self, PULP_PACKAGE_ATTRS.RPM_BUILDHOST)
-        package.rpm_group = getattr(self, PULP_PACKAGE_ATTRS.RPM_GROUP)
-        package.rpm_header_end = getattr(self, PULP_PACKAGE_ATTRS.RPM_HEADER_END)
-        package.rpm_header_start = getattr(self, PULP_PACKAGE_ATTRS.RPM_HEADER_START)
-        package.rpm_license = getattr(self, PULP_PACKAGE_ATTRS.RPM_LICENSE)
-        package.rpm_packager = getattr(self, PULP_PACKAGE_ATTRS.RPM_PACKAGER)
-        package.rpm_sourcerpm = getattr(self, PULP_PACKAGE_ATTRS.RPM_SOURCERPM)
-        package.rpm_vendor = getattr(self, PULP_PACKAGE_ATTRS.RPM_VENDOR)
-        package.size_archive = getattr(self, PULP_PACKAGE_ATTRS.SIZE_ARCHIVE)
-        package.size_installed = getattr(self, PULP_PACKAGE_ATTRS.SIZE_INSTALLED)
-        package.size_package = getattr(self, PULP_PACKAGE_ATTRS.SIZE_PACKAGE)
-        package.suggests = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.SUGGESTS))
-        package.summary = getattr(self, PULP_PACKAGE_ATTRS.SUMMARY)
-        package.supplements = list_to_createrepo_c(getattr(self, PULP_PACKAGE_ATTRS.SUPPLEMENTS))
-        package.time_build = getattr(self, PULP_PACKAGE_ATTRS.TIME_BUILD)
-        package.time_file = getattr(self, PULP_PACKAGE_ATTRS.TIME_FILE)
-        package.url = getattr(self, PULP_PACKAGE_ATTRS.URL)
-        package.version = getattr(self, PULP_PACKAGE_ATTRS.VERSION)
-        return package
+        package_tag = f'<package pkgid="{cls.PKGID_PLACEHOLDER}" '
+        filelists = filelists.replace(package_tag, f'<package pkgid="{pkgid}" ', 1)
+        other = other.replace(package_tag, f'<package pkgid="{pkgid}" ', 1)
+        return primary, filelists, other
+
+    class Meta:
+        default_related_name = "%(app_label)s_%(model_name)s"
@@ -13,6 +13,7 @@ from pulpcore.plugin.models import (
     Artifact,
     AsciiArmoredDetachedSigningService,
     AutoAddObjPermsMixin,
+    BaseModel,
     Content,
     ContentArtifact,
     Distribution,
@@ -514,6 +515,38 @@ class RpmPublication(Publication, AutoAddObjPermsMixin):
         ]
 
 
+class RepodataDigest(BaseModel):
+    """
+    Digest of the content and options a repodata directory of a publication was generated from.
+
+    Publications of identical content with identical options get identical metadata, so the
+    metadata files of the publication can be reused rather than generated again. The entries
+    are deleted along with their publication, after which the metadata Artifacts become orphans
+    and are removed by orphan cleanup.
+
+    Fields:
+        digest (Text):
+            sha256 digest of the content pks and publish options
+        relative_path (Text):
+            The path of the repodata directory within the publication
+
+    Relations:
+
+        publication (models.ForeignKey): The publication containing the repodata
+
+    """
+
+    digest = models.TextField(db_index=True)
+    relative_path = models.TextField()
+    publication = models.ForeignKey(
+        RpmPublication, on_delete=models.CASCADE, related_name="repodata_digests"
+    )
+
+    class Meta:
+        default_related_name = "%(app_label)s_%(model_name)s"
+        unique_together = ("publication", "relative_path")
+
+
 class RpmDistribution(Distribution, AutoAddObjPermsMixin):
     """
     Distribution for "rpm" content.
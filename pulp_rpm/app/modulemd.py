@@ -6,10 +6,11 @@ import tempfile
 import yaml
 import collections
 
+from django.db.models import F, TextField, Value
 from jsonschema import Draft7Validator
 from gettext import gettext as _  # noqa:F401
 
-from pulp_rpm.app.models import Modulemd, Package
+from pulp_rpm.app.models import Modulemd, ModulemdDefaults, ModulemdObsolete, Package
 from pulp_rpm.app.constants import (
     PULP_MODULEDEFAULTS_ATTR,
     PULP_MODULEOBSOLETES_ATTR,
@@ -256,3 +257,39 @@ class ModularYamlLoader(yaml.SafeLoader):
                 value = self.construct_object(value_node, deep=deep)
             mapping[key] = value
         return mapping
+
+
+def modular_snippets(content):
+    """
+    Query the snippets of all modular metadata of a content set, in the order of modules.yaml.
+
+    Modulemds come first, then modulemd-defaults and then modulemd-obsoletes, each of them
+    ordered by their natural key. All of them are fetched with a single query.
+
+    Args:
+        content: content set
+
+    Yields:
+        str: the snippets
+    """
+    models = (Modulemd, ModulemdDefaults, ModulemdObsolete)
+    # every content set is within a single domain
+    natural_keys = [
+        [field for field in model.natural_key_fields() if field != "_pulp_domain"]
+        for model in models
+    ]
+    num_keys = max(len(keys) for keys in natural_keys)
+    key_names = [f"key{index}" for index in range(num_keys)]
+
+    querysets = []
+    for document, (model, keys) in enumerate(zip(models, natural_keys)):
+        keys = [F(key) for key in keys]
+        keys += [Value("", output_field=TextField())] * (num_keys - len(keys))
+        querysets.append(
+            model.objects.filter(pk__in=content)
+            .annotate(document=Value(document), **dict(zip(key_names, keys)))
+            .values("document", *key_names, "snippet")
+        )
+    documents = querysets[0].union(*querysets[1:], all=True).order_by("document", *key_names)
+    for document in documents.iterator():
+        yield document["snippet"]
@@ -17,3 +17,14 @@ SOLVER_DEBUG_LOGS = True
 RPM_METADATA_USE_REPO_PACKAGE_TIME = False
 NOCACHE_LIST = ["repomd.xml", "repomd.xml.asc", "repomd.xml.key"]
 PRUNE_WORKERS_MAX = 5
+RPM_INCREMENTAL_PUBLISH = False
+RPM_PUBLISH_SUBREPO_WORKERS = 0
+RPM_SYNC_SUBREPO_WORKERS = 0
+RPM_METADATA_CACHE_DIR = None
+RPM_METADATA_CACHE_SIZE = 1024 * 1024 * 1024
+RPM_MIRRORLIST_PROBES = 1
+RPM_SYNC_COPY_INSERT = False
+RPM_SYNC_COMPACT_PACKAGES = False
+RPM_PUBLISH_METADATA_CACHE = False
+RPM_PUBLISH_PACKAGE_FRAGMENTS = False
+RPM_PUBLISH_PARALLEL_COMPRESSION = False
@@ -1,26 +1,31 @@
+import hashlib
 import logging
+import multiprocessing
 import os
 import shutil
 import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from gettext import gettext as _
 
 import createrepo_c as cr
-import libcomps
 from django.conf import settings
 from django.core.files import File
+from django.db import connections, transaction
 from django.db.models import Q
 from pulpcore.plugin.models import (
     AsciiArmoredDetachedSigningService,
     ContentArtifact,
+    Domain,
     ProgressReport,
     PublishedArtifact,
     PublishedMetadata,
     RepositoryContent,
     RepositoryVersion,
 )
+from pulpcore.plugin.util import get_domain, set_domain
 
-from pulp_rpm.app.comps import dict_to_strdict
+from pulp_rpm.app.comps import dict_to_strdict, write_comps_xml
 from pulp_rpm.app.constants import (
     ALLOWED_CHECKSUM_ERROR_MSG,
     CHECKSUM_TYPES,
@@ -33,21 +38,35 @@ from pulp_rpm.app.models import (
     DistributionTree,
     Modulemd,
     ModulemdDefaults,
-    ModulemdObsolete,
     Package,
     PackageCategory,
+    PackageMetadataFragments,
     PackageEnvironment,
     PackageGroup,
     PackageLangpacks,
+    RepodataDigest,
     RepoMetadataFile,
     RpmPublication,
     UpdateRecord,
 )
+from pulp_rpm.app.modulemd import modular_snippets
+from pulp_rpm.app.shared_utils import format_nevra
 
 log = logging.getLogger(__name__)
 
 REPODATA_PATH = "repodata"
 
+# Bump whenever a change to metadata generation makes previously generated repodata unsuitable
+# for reuse by the metadata cache.
+REPODATA_DIGEST_VERSION = 2
+
+# How many packages of previously published metadata are buffered at most while splicing, and how
+# many packages missing from it are rendered from the database at once
+SPLICE_BATCH_SIZE = 1000
+
+# How many PublishedArtifacts are created at once
+PUBLISHED_ARTIFACT_BATCH_SIZE = 2000
+
 
 class PublicationData:
     """
@@ -57,21 +76,30 @@ class PublicationData:
         publication (pulpcore.plugin.models.Publication): A Publication to populate.
         sub_repos (list): A list of tuples with sub_repos data.
         repomdrecords (list): A list of tuples with repomdrecords data.
+        previous_publication (pulp_rpm.app.models.RpmPublication): An earlier publication of
+            the same repository whose package data may be reused (incremental publishing).
+        package_selection (tuple): The packages of the repository picked by `select_packages`.
 
     """
 
-    def __init__(self, publication, checksum_types):
+    def __init__(self, publication, checksum_types, previous_publication=None):
         """
         Setting Publication data.
 
         Args:
             publication (pulpcore.plugin.models.Publication): A Publication to populate.
 
+        Keyword Args:
+            previous_publication (pulp_rpm.app.models.RpmPublication): An earlier publication of
+                the same repository to reuse package data from.
+
         """
         self.publication = publication
         self.sub_repos = []
         self.repomdrecords = []
         self.checksum_types = checksum_types
+        self.previous_publication = previous_publication
+        self.package_selection = None
 
     def prepare_metadata_files(self, content, folder=None):
         """
@@ -98,7 +126,7 @@ class PublicationData:
                 # they might still exist in old repo versions from before we started excluding them.
                 continue
             content_artifact = repo_metadata_file.contentartifact_set.get()
-            current_file = content_artifact.artifact.file.file
+            artifact_file = content_artifact.artifact.file
             path = content_artifact.relative_path.split("/")[-1]
             if repo_metadata_file.checksum in path:
                 # filenames can be checksum-xxxx.yyy - but can also be checksum-mmm-nnn-ooo.yyy
@@ -110,29 +138,71 @@ class PublicationData:
                     path = "-".join(filename)
             if folder:
                 path = os.path.join(folder, path)
-            with open(path, "wb") as new_file:
-                shutil.copyfileobj(current_file, new_file)
-                repomdrecords.append((repo_metadata_file.data_type, new_file.name))
+            try:
+                # The file only needs to be read while generating the metadata, so link to it
+                # rather than copying it if the storage is on the local filesystem.
+                os.symlink(artifact_file.path, path)
+            except NotImplementedError:
+                with open(path, "wb") as new_file:
+                    shutil.copyfileobj(artifact_file.file, new_file)
+            repomdrecords.append((repo_metadata_file.data_type, path))
 
         return repomdrecords
 
-    def publish_artifacts(self, content, prefix=""):
+    def publish_artifacts(
+        self, content, writer, prefix="", previous_publication=None, pkg_pks_to_ignore=()
+    ):
         """
         Publish artifacts.
 
         Args:
             content (pulpcore.plugin.models.Content): content set.
+            writer (PublishedArtifactWriter): The writer of the publication.
             prefix (str): a relative path prefix for the published artifact
 
-        """
-        published_artifacts = []
+        Keyword Args:
+            previous_publication (pulp_rpm.app.models.RpmPublication): An earlier publication
+                whose package PublishedArtifacts are reused for content that is still present.
+            pkg_pks_to_ignore (set): Packages which aren't published because another package
+                with the same NEVRA is, see `select_packages`.
 
+        """
         # Special case for Packages
         contentartifact_qs = ContentArtifact.objects.filter(content__in=content).filter(
             content__pulp_type=Package.get_pulp_type()
         )
 
         rel_path_mapping = defaultdict(list)
+
+        if previous_publication:
+            # The package paths of the previous publication are still valid for any package
+            # that is still part of the repository, so only the remaining ones (added since, or
+            # previously shadowed by a duplicate that has since been removed) need to be looked
+            # at individually. Reused paths still take part in the duplicate detection below.
+            previous_pa_qs = PublishedArtifact.objects.filter(
+                publication=previous_publication,
+                relative_path__startswith=os.path.join(prefix, PACKAGES_DIRECTORY, ""),
+                content_artifact__in=contentartifact_qs,
+            )
+            fields = [
+                "relative_path",
+                "content_artifact_id",
+                "content_artifact__content_id",
+                "content_artifact__content__rpm_package__time_build",
+            ]
+            for published_artifact in previous_pa_qs.values(*fields).iterator():
+                if published_artifact["content_artifact__content_id"] in pkg_pks_to_ignore:
+                    continue
+                rel_path_mapping[published_artifact["relative_path"]].append(
+                    (
+                        published_artifact["content_artifact_id"],
+                        published_artifact["content_artifact__content__rpm_package__time_build"],
+                    )
+                )
+            contentartifact_qs = contentartifact_qs.exclude(
+                pk__in=previous_pa_qs.values("content_artifact_id")
+            )
+
         # Some Suboptimal Repos have the 'same' artifact living in multiple places.
         # Specifically, the same NEVRA, in more than once place, **with different checksums**
         # (since if all that was different was location_href there would be only one
@@ -144,14 +214,18 @@ class PublicationData:
         # is kept as relative_path.
         #
         # In this case, we have to pick one - which is essentially what the rest of the RPM
-        # Ecosystem does when faced with the impossible. This code takes the one with the
-        # most recent build time which is the same heuristic used by Yum/DNF/Zypper.
+        # Ecosystem does when faced with the impossible. The packages of such NEVRAs which
+        # `select_packages` didn't pick for the metadata are skipped, and of any other packages
+        # which still share a path this code takes the one with the most recent build time,
+        # which is the same heuristic used by Yum/DNF/Zypper.
         #
         # Note that this only impacts user-created publications, which produce the "standard"
         # RPM layout of repo/Packages/f/foo.rpm. A publication created by mirror-sync retains
         # whatever layout their "upstream" repo-metadata dictates.
-        fields = ["pk", "relative_path", "content__rpm_package__time_build"]
+        fields = ["pk", "content_id", "relative_path", "content__rpm_package__time_build"]
         for content_artifact in contentartifact_qs.values(*fields).iterator():
+            if content_artifact["content_id"] in pkg_pks_to_ignore:
+                continue
             relative_path = content_artifact["relative_path"]
             time_build = content_artifact["content__rpm_package__time_build"]
 
@@ -172,42 +246,10 @@ class PublicationData:
                 )
 
             # Only add the first one (the one with the highest build time)
-            published_artifacts.append(
-                PublishedArtifact(
-                    relative_path=rel_path,
-                    publication=self.publication,
-                    content_artifact_id=content_artifacts[0][0],
-                )
-            )
+            writer.add(rel_path, content_artifacts[0][0])
 
         # Handle everything else
-        is_treeinfo = Q(relative_path__in=["treeinfo", ".treeinfo"])
-        unpublishable_types = Q(
-            content__pulp_type__in=[
-                RepoMetadataFile.get_pulp_type(),
-                Modulemd.get_pulp_type(),
-                ModulemdDefaults.get_pulp_type(),
-                # already dealt with
-                Package.get_pulp_type(),
-            ]
-        )
-
-        contentartifact_qs = (
-            ContentArtifact.objects.filter(content__in=content)
-            .exclude(unpublishable_types)
-            .exclude(is_treeinfo)
-        )
-
-        for content_artifact in contentartifact_qs.values("pk", "relative_path").iterator():
-            published_artifacts.append(
-                PublishedArtifact(
-                    relative_path=content_artifact["relative_path"],
-                    publication=self.publication,
-                    content_artifact_id=content_artifact["pk"],
-                )
-            )
-
-        PublishedArtifact.objects.bulk_create(published_artifacts, batch_size=2000)
+        publish_other_artifacts(content, writer)
 
     def handle_sub_repos(self, distribution_tree):
         """
@@ -258,6 +300,7 @@ class PublicationData:
 
                 if repository_version and repository.user_hidden:
                     addon_or_variant_id = getattr(addon_or_variant, f"{relation}_id")
+                    setattr(self, f"{addon_or_variant_id}_version", repository_version)
                     self.sub_repos.append(
                         (
                             addon_or_variant_id,
@@ -274,8 +317,7 @@ class PublicationData:
         """
         main_content = self.publication.repository_version.content
         self.repomdrecords = self.prepare_metadata_files(main_content)
-
-        self.publish_artifacts(main_content)
+        self.package_selection = select_packages(main_content)
 
         distribution_trees = DistributionTree.objects.filter(pk__in=main_content).prefetch_related(
             "addons",
@@ -293,7 +335,25 @@ class PublicationData:
             setattr(self, f"{name}_content", content)
             setattr(self, f"{name}_checksums", self.checksum_types)
             setattr(self, f"{name}_repomdrecords", self.prepare_metadata_files(content, name))
-            self.publish_artifacts(content, prefix=name)
+            setattr(self, f"{name}_package_selection", select_packages(content))
+
+        artifacts_pb = ProgressReport(
+            message="Publishing artifacts", code="publish.publishing_artifacts"
+        )
+        with artifacts_pb, PublishedArtifactWriter(self.publication, artifacts_pb) as writer:
+            self.publish_artifacts(
+                main_content,
+                writer,
+                previous_publication=self.previous_publication,
+                pkg_pks_to_ignore=self.package_selection[1],
+            )
+            for name, content in self.sub_repos:
+                self.publish_artifacts(
+                    content,
+                    writer,
+                    prefix=name,
+                    pkg_pks_to_ignore=getattr(self, f"{name}_package_selection")[1],
+                )
 
 
 def get_checksum_type(checksum_types, default=CHECKSUM_TYPES.SHA256):
@@ -322,6 +382,509 @@ def cr_checksum_type_from_string(checksum_type):
     return getattr(cr, checksum_type.upper())
 
 
+def get_previous_publication(publication):
+    """
+    Find an earlier publication of the same repository which incremental publishing can build on.
+
+    Only complete publications created with the same checksum, compression and layout options
+    produce package metadata which can be reused verbatim.
+
+    Args:
+        publication (pulp_rpm.app.models.RpmPublication): The publication being created.
+
+    Returns:
+        pulp_rpm.app.models.RpmPublication: The most recent matching publication, or None.
+
+    """
+    repository_version = publication.repository_version
+    return (
+        RpmPublication.objects.filter(
+            repository_version__repository=repository_version.repository,
+            repository_version__number__lt=repository_version.number,
+            complete=True,
+            checksum_type=publication.checksum_type,
+            package_checksum_type=publication.package_checksum_type,
+            compression_type=publication.compression_type,
+            layout=publication.layout,
+        )
+        .select_related("repository_version")
+        .order_by("-repository_version__number", "-pulp_created")
+        .first()
+    )
+
+
+def copy_published_metadata(publication, data_types, dest_dir, sub_folder=None):
+    """
+    Copy metadata files of an existing publication out of Artifact storage.
+
+    Args:
+        publication (pulpcore.plugin.models.Publication): The publication to copy files from.
+        data_types (list): repomd.xml record types to copy, e.g. ["primary", "filelists"].
+        dest_dir (str): The directory to copy the files to.
+
+    Keyword Args:
+        sub_folder (str): name of the folder for sub repos
+
+    Returns:
+        dict: A mapping of record type to the path of the local copy, or None if the publication
+            does not contain all of the requested files.
+
+    """
+    repodata_path = os.path.join(sub_folder or "", REPODATA_PATH)
+
+    def copy_file(relative_path):
+        try:
+            content_artifact = ContentArtifact.objects.select_related("artifact").get(
+                content__in=PublishedMetadata.objects.filter(
+                    publication=publication, relative_path=relative_path
+                )
+            )
+        except ContentArtifact.DoesNotExist:
+            return None
+        artifact = content_artifact.artifact
+        path = os.path.join(dest_dir, os.path.basename(relative_path))
+        artifact_file = artifact.pulp_domain.get_storage().open(artifact.file.name)
+        with open(path, "wb") as local_file:
+            shutil.copyfileobj(artifact_file, local_file)
+        artifact_file.close()
+        return path
+
+    repomd_path = copy_file(os.path.join(repodata_path, "repomd.xml"))
+    if not repomd_path:
+        return None
+
+    records = {record.type: record for record in cr.Repomd(repomd_path).records}
+    metadata_paths = {}
+    for data_type in data_types:
+        record = records.get(data_type)
+        if not record:
+            return None
+        path = copy_file(os.path.join(repodata_path, os.path.basename(record.location_href)))
+        if not path:
+            return None
+        metadata_paths[data_type] = path
+    return metadata_paths
+
+
+def get_repodata_digest(content_pks, options, package_checksums=None):
+    """
+    Calculate the digest identifying the repodata generated for a content set.
+
+    Args:
+        content_pks (iterable): Primary keys of the content, sorted.
+        options (dict): The options which affect the generated metadata, e.g. the checksum type.
+        package_checksums (dict): The checksum type and checksum each package is published with,
+            by primary key. With a package checksum type, they depend on which of the packages
+            have been downloaded, not only on the content.
+
+    Returns:
+        str: sha256 hexdigest
+
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"version={REPODATA_DIGEST_VERSION}\n".encode())
+    for key in sorted(options):
+        hasher.update(f"{key}={options[key]}\n".encode())
+    for pk in content_pks:
+        hasher.update(f"{pk}\n".encode())
+    package_checksums = package_checksums or {}
+    for pk in sorted(package_checksums, key=str):
+        checksum_type, pkgid = package_checksums[pk]
+        hasher.update(f"{pk} {checksum_type} {pkgid}\n".encode())
+    return hasher.hexdigest()
+
+
+def publish_metadata_artifact(artifact, relative_path, publication):
+    """
+    Publish an already stored metadata Artifact at a path of a publication, without copying it.
+
+    Args:
+        artifact (pulpcore.plugin.models.Artifact): The metadata file.
+        relative_path (str): relative path at which the metadata is published.
+        publication (pulpcore.plugin.models.Publication): The publication in which the
+            metadata is included.
+
+    Returns:
+        PublishedMetadata (pulpcore.app.models.PublishedMetadata):
+            A saved instance of PublishedMetadata.
+
+    """
+    with transaction.atomic():
+        metadata = PublishedMetadata(relative_path=relative_path, publication=publication)
+        metadata.save()
+        content_artifact = ContentArtifact(
+            relative_path=relative_path, content=metadata, artifact=artifact
+        )
+        content_artifact.save()
+        PublishedArtifact(
+            relative_path=relative_path,
+            content_artifact=content_artifact,
+            publication=publication,
+        ).save()
+    return metadata
+
+
+class PublishedArtifactWriter:
+    """
+    Creates the PublishedArtifacts of a publication in batches while they are added.
+
+    Only a batch of them is held in memory at a time, and the progress report, if any, is
+    updated after every batch.
+    """
+
+    def __init__(self, publication, progress_report=None, batch_size=PUBLISHED_ARTIFACT_BATCH_SIZE):
+        """
+        Args:
+            publication (pulpcore.plugin.models.Publication): The publication to populate.
+
+        Keyword Args:
+            progress_report (pulpcore.plugin.models.ProgressReport): Counts the created
+                PublishedArtifacts.
+            batch_size (int): How many PublishedArtifacts are created at once.
+
+        """
+        self.publication = publication
+        self.progress_report = progress_report
+        self.batch_size = batch_size
+        self._batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, relative_path, content_artifact_id):
+        """
+        Add a PublishedArtifact to the publication.
+
+        Args:
+            relative_path (str): The relative path at which the artifact is published.
+            content_artifact_id (str): The pk of the published ContentArtifact.
+
+        """
+        self._batch.append(
+            PublishedArtifact(
+                relative_path=relative_path,
+                publication=self.publication,
+                content_artifact_id=content_artifact_id,
+            )
+        )
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Create the PublishedArtifacts added since the last batch."""
+        if not self._batch:
+            return
+        PublishedArtifact.objects.bulk_create(self._batch)
+        if self.progress_report is not None:
+            self.progress_report.increase_by(len(self._batch))
+        self._batch = []
+
+
+def select_packages(content):
+    """
+    Pick the package to publish for each NEVRA of a content set.
+
+    TODO: this is meant to be a !! *temporary* !! fix for
+    https://github.com/pulp/pulp_rpm/issues/2407
+
+    Some repositories contain the same NEVRA more than once, with different checksums. The one
+    with the most recent build time is picked, which is the same heuristic used by
+    Yum/DNF/Zypper. The packages are ranked in the database with a single scan, whose result is
+    used both for publishing the package files and for generating the metadata.
+
+    Args:
+        content (pulpcore.plugin.models.Content): content set.
+
+    Returns:
+        tuple: The number of selected packages and the set of pks of the packages not selected.
+
+    """
+    total_packages = 0
+    duplicates_by_nevra = defaultdict(set)
+    packages = Package.objects.with_build_rank().filter(pk__in=content)
+    for pk, build_rank, *nevra in packages.values_list(
+        "pk", "build_rank", "name", "epoch", "version", "release", "arch"
+    ).iterator():
+        if build_rank == 1:
+            total_packages += 1
+        else:
+            duplicates_by_nevra[format_nevra(*nevra)].add(pk)
+
+    pkg_pks_to_ignore = set()
+    for nevra, pks in duplicates_by_nevra.items():
+        pkg_pks_to_ignore |= pks
+        log.warning(
+            "Duplicate packages found competing for NEVRA {nevra}, selected the one with "
+            "the most recent build time, excluding {others} others.".format(
+                nevra=nevra, others=len(pks)
+            )
+        )
+    return total_packages, pkg_pks_to_ignore
+
+
+def publish_other_artifacts(content, writer):
+    """
+    Publish the artifacts of all content except packages and metadata, at their own paths.
+
+    Args:
+        content (pulpcore.plugin.models.Content): content set.
+        writer (PublishedArtifactWriter): The writer of the publication.
+
+    """
+    is_treeinfo = Q(relative_path__in=["treeinfo", ".treeinfo"])
+    unpublishable_types = Q(
+        content__pulp_type__in=[
+            RepoMetadataFile.get_pulp_type(),
+            Modulemd.get_pulp_type(),
+            ModulemdDefaults.get_pulp_type(),
+            # already dealt with
+            Package.get_pulp_type(),
+        ]
+    )
+
+    contentartifact_qs = (
+        ContentArtifact.objects.filter(content__in=content)
+        .exclude(unpublishable_types)
+        .exclude(is_treeinfo)
+    )
+
+    for content_artifact in contentartifact_qs.values("pk", "relative_path").iterator():
+        writer.add(content_artifact["relative_path"], content_artifact["pk"])
+
+
+def reuse_cached_repodata(digest, publication, repodata_path):
+    """
+    Publish the repodata of an earlier publication which was generated from the same digest.
+
+    Args:
+        digest (str): The digest of the content and options, see `get_repodata_digest`.
+        publication (pulpcore.plugin.models.Publication): The publication being created.
+        repodata_path (str): The path of the repodata directory within the publication.
+
+    Returns:
+        bool: Whether cached repodata has been found and published.
+
+    """
+    cached = (
+        RepodataDigest.objects.filter(
+            digest=digest,
+            publication__complete=True,
+            publication__pulp_domain=publication.pulp_domain,
+        )
+        .exclude(publication=publication)
+        .order_by("-pulp_created")
+        .first()
+    )
+    if not cached:
+        return False
+
+    prefix = os.path.join(cached.relative_path, "")
+    content_artifacts = ContentArtifact.objects.select_related("artifact").filter(
+        content__in=PublishedMetadata.objects.filter(
+            publication=cached.publication, relative_path__startswith=prefix
+        )
+    )
+    for content_artifact in content_artifacts:
+        relative_path = os.path.join(repodata_path, content_artifact.relative_path[len(prefix) :])
+        publish_metadata_artifact(content_artifact.artifact, relative_path, publication)
+
+    log.info(
+        _("Reusing repository metadata of publication {} for {}.").format(
+            cached.publication.pk, repodata_path
+        )
+    )
+    return True
+
+
+def splice_packages(
+    ordered_pks, added_packages, expected_pkgids, previous_packages, render, load_packages=None
+):
+    """
+    Merge packages parsed from previously published metadata with newly added ones.
+
+    Packages are yielded in the order of `ordered_pks`. Unchanged packages are taken verbatim
+    from `previous_packages`, which was written in the same order by an earlier publish,
+    so the stream usually lines up and only a handful of entries are buffered. Entries of the
+    previous metadata which are not expected anymore belong to removed packages and are
+    dropped. If an unchanged package can't be found in the previous metadata at all, it is
+    rendered from the database instead, `SPLICE_BATCH_SIZE` packages at once. Once more than
+    `SPLICE_BATCH_SIZE` entries are buffered, the previous metadata is ordered too differently,
+    and all the remaining unchanged packages are rendered from the database.
+
+    Args:
+        ordered_pks (iterable): Primary keys of the packages to publish, in publication order.
+        added_packages (dict): createrepo_c packages not present in the previous publication,
+            by pk.
+        expected_pkgids (dict): The pkgId each unchanged package has in the metadata, by pk.
+        previous_packages (iterable): createrepo_c packages of the previous publication.
+        render (callable): Prepares a package (given its pk and createrepo_c package) for
+            publishing.
+        load_packages (callable): Loads the createrepo_c packages of a list of pks from the
+            database, as a dict by pk.
+
+    Yields:
+        createrepo_c.Package: packages to be added to the repository metadata
+
+    """
+    if load_packages is None:
+
+        def load_packages(pks):
+            return dict(Package.iter_createrepo_c(Package.objects.filter(pk__in=pks)))
+
+    wanted_pkgids = set(expected_pkgids.values())
+    buffered = {}
+    previous_packages = iter(previous_packages)
+    previous_exhausted = False
+    # packages which are held back until the missing ones among them are loaded
+    pending = []
+    missing = []
+
+    def flush():
+        loaded = load_packages(missing) if missing else {}
+        for pk, pkg in pending:
+            yield pkg if pkg is not None else render(pk, loaded[pk])
+        pending.clear()
+        missing.clear()
+
+    for pk in ordered_pks:
+        if pk in added_packages:
+            pending.append((pk, render(pk, added_packages.pop(pk))))
+        elif pk in expected_pkgids:
+            pkgid = expected_pkgids[pk]
+            pkg = buffered.pop(pkgid, None)
+            while pkg is None and not previous_exhausted:
+                candidate = next(previous_packages, None)
+                if candidate is None:
+                    previous_exhausted = True
+                elif candidate.pkgId == pkgid:
+                    pkg = candidate
+                elif candidate.pkgId in wanted_pkgids:
+                    buffered[candidate.pkgId] = candidate
+                    if len(buffered) > SPLICE_BATCH_SIZE:
+                        log.debug("Previous metadata is out of order, regenerating the rest.")
+                        buffered.clear()
+                        previous_exhausted = True
+
+            if pkg is None:
+                missing.append(pk)
+            pending.append((pk, pkg))
+        else:
+            # excluded from the publication, e.g. a duplicate NEVRA
+            continue
+
+        if not missing or len(pending) >= SPLICE_BATCH_SIZE:
+            yield from flush()
+
+    yield from flush()
+
+
+class CompressingXmlFile:
+    """
+    Writes (and compresses) a primary, filelists or other XML file in a separate process.
+
+    Compression takes most of the time spent writing the metadata, and createrepo_c holds the
+    GIL while compressing, so each stream gets its own process. The chunks are buffered and
+    sent through a pipe.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, xml_file_class, path, compression, num_of_pkgs):
+        """
+        Start the process writing the file.
+
+        Args:
+            xml_file_class (type): createrepo_c.PrimaryXmlFile, FilelistsXmlFile or OtherXmlFile
+            path (str): The path of the file.
+            compression (int): createrepo_c compression type.
+            num_of_pkgs (int): The number of packages which will be added.
+
+        """
+        context = multiprocessing.get_context("fork")
+        reader, self._connection = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=self._write,
+            args=(xml_file_class, path, compression, num_of_pkgs, reader),
+            daemon=True,
+        )
+        self._process.start()
+        reader.close()
+        self._buffer = []
+        self._buffered = 0
+
+    @staticmethod
+    def _write(xml_file_class, path, compression, num_of_pkgs, connection):
+        xml_file = xml_file_class(path, compressiontype=compression)
+        xml_file.set_num_of_pkgs(num_of_pkgs)
+        while chunk := connection.recv_bytes():
+            xml_file.add_chunk(chunk.decode())
+        xml_file.close()
+
+    def _flush(self):
+        if self._buffer:
+            self._connection.send_bytes("".join(self._buffer).encode())
+            self._buffer = []
+            self._buffered = 0
+
+    def add_chunk(self, chunk):
+        """
+        Add a chunk of XML to the file.
+
+        Args:
+            chunk (str): the XML of a package
+
+        """
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.BUFFER_SIZE:
+            self._flush()
+
+    def close(self):
+        """
+        Finish the file and wait for the process to write it.
+        """
+        self._flush()
+        # an empty message ends the file
+        self._connection.send_bytes(b"")
+        self._connection.close()
+        self._process.join()
+        if self._process.exitcode != 0:
+            raise RuntimeError(
+                _("Writing the metadata failed, exit code {}.").format(self._process.exitcode)
+            )
+
+
+def compress_packages_in_parallel(writer, compression, num_of_pkgs):
+    """
+    Let the primary, filelists and other XML files of a RepositoryWriter be written in parallel.
+
+    Args:
+        writer (createrepo_c.RepositoryWriter): The writer, before any package is added.
+        compression (int): createrepo_c compression type the writer was created with.
+        num_of_pkgs (int): The number of packages which will be added.
+
+    """
+    xml_file_classes = {
+        "primary": cr.PrimaryXmlFile,
+        "filelists": cr.FilelistsXmlFile,
+        "other": cr.OtherXmlFile,
+    }
+    for name, xml_file_class in xml_file_classes.items():
+        metadata_info = writer.working_metadata_files[name]
+        # the file is written again from scratch by the process
+        metadata_info.writer.close()
+        os.remove(metadata_info.path)
+        writer.working_metadata_files[name] = metadata_info._replace(
+            writer=CompressingXmlFile(
+                xml_file_class, str(metadata_info.path), compression, num_of_pkgs
+            )
+        )
+
+
 def publish(
     repository_version_pk,
     metadata_signing_service=None,
@@ -378,7 +941,13 @@ def publish(
             publication.layout = layout
             publication.repo_config = repo_config
 
-            publication_data = PublicationData(publication, checksum_types)
+            previous_publication = None
+            if settings.RPM_INCREMENTAL_PUBLISH:
+                previous_publication = get_previous_publication(publication)
+
+            publication_data = PublicationData(
+                publication, checksum_types, previous_publication=previous_publication
+            )
             publication_data.populate()
 
             total_repos = 1 + len(publication_data.sub_repos)
@@ -388,39 +957,203 @@ def publish(
                 total=total_repos,
             )
             with ProgressReport(**pb_data) as publish_pb:
-                content = publication.repository_version.content
-
-                # Main repo
-                generate_repo_metadata(
-                    content,
+                cache_hits = generate_metadata(
                     publication,
+                    publication_data,
                     checksum_types,
-                    publication_data.repomdrecords,
                     metadata_signing_service=metadata_signing_service,
                     compression_type=compression_type,
+                    previous_publication=previous_publication,
+                    sub_repo_workers=settings.RPM_PUBLISH_SUBREPO_WORKERS,
+                    progress_report=publish_pb,
                 )
-                publish_pb.increment()
-
-                for sub_repo in publication_data.sub_repos:
-                    name = sub_repo[0]
-                    content = getattr(publication_data, f"{name}_content")
-                    extra_repomdrecords = getattr(publication_data, f"{name}_repomdrecords")
-                    generate_repo_metadata(
-                        content,
-                        publication,
-                        checksum_types,
-                        extra_repomdrecords,
-                        name,
-                        metadata_signing_service=metadata_signing_service,
-                        compression_type=compression_type,
-                    )
-                    publish_pb.increment()
+
+            if settings.RPM_PUBLISH_METADATA_CACHE:
+                with ProgressReport(
+                    message="Reusing cached repository metadata", code="publish.metadata_cache"
+                ) as pb:
+                    pb.done = cache_hits
+                    pb.total = total_repos
 
             log.info(_("Publication: {publication} created").format(publication=publication.pk))
 
             return publication
 
 
+def generate_metadata(
+    publication,
+    publication_data,
+    checksum_types,
+    metadata_signing_service=None,
+    compression_type=COMPRESSION_TYPES.GZ,
+    previous_publication=None,
+    sub_repo_workers=0,
+    progress_report=None,
+):
+    """
+    Generate the metadata of a repository and of its sub-repos.
+
+    With `sub_repo_workers`, the metadata of that many sub-repos is generated concurrently in
+    worker processes, while the metadata of the main repository is generated in this process.
+
+    The worker processes are forked, so they start with the Django setup and settings of the
+    task. This is safe as the task runs in a process of its own, whose heartbeats are sent by
+    the pulpcore worker process, so no other thread of the task holds a lock while publishing.
+    The database connections are closed before forking, so that each process opens its own, and
+    only primary keys are passed to the worker processes, which load the objects themselves.
+
+    Args:
+        publication (pulp_rpm.app.models.RpmPublication): The publication being created.
+        publication_data (PublicationData): The populated data of the publication.
+        checksum_types (dict): Checksum types for metadata and packages.
+        metadata_signing_service (pulpcore.app.models.AsciiArmoredDetachedSigningService):
+            A reference to an associated signing service.
+        compression_type(pulp_rpm.app.constants.COMPRESSION_TYPES):
+            Compression type to use for metadata files.
+        previous_publication (pulp_rpm.app.models.RpmPublication): An earlier publication the
+            package metadata of the main repository is reused from.
+        sub_repo_workers (int): The number of sub-repos whose metadata is generated concurrently.
+        progress_report (pulpcore.plugin.models.ProgressReport): Incremented for each repository.
+
+    Returns:
+        int: The number of repositories whose repodata of an earlier publication was reused.
+
+    """
+    sub_repo_workers = min(sub_repo_workers, len(publication_data.sub_repos))
+    futures = []
+    executor = None
+    cache_hits = 0
+
+    def increment():
+        if progress_report:
+            progress_report.increment()
+
+    if sub_repo_workers:
+        # The worker processes load the publication from the database.
+        publication.save()
+        connections.close_all()
+        executor = ProcessPoolExecutor(
+            max_workers=sub_repo_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_sub_repo_worker,
+            initargs=(get_domain().pk,),
+        )
+        for name, _content in publication_data.sub_repos:
+            future = executor.submit(
+                generate_sub_repo_metadata,
+                getattr(publication_data, f"{name}_version").pk,
+                publication.pk,
+                checksum_types,
+                getattr(publication_data, f"{name}_repomdrecords"),
+                name,
+                metadata_signing_service_pk=(
+                    metadata_signing_service.pk if metadata_signing_service else None
+                ),
+                compression_type=compression_type,
+                package_selection=getattr(publication_data, f"{name}_package_selection"),
+            )
+            futures.append(future)
+
+    try:
+        # Main repo
+        cache_hits += generate_repo_metadata(
+            publication.repository_version.content,
+            publication,
+            checksum_types,
+            publication_data.repomdrecords,
+            metadata_signing_service=metadata_signing_service,
+            compression_type=compression_type,
+            previous_publication=previous_publication,
+            package_selection=publication_data.package_selection,
+        )
+        increment()
+
+        for future in as_completed(futures):
+            cache_hits += future.result()
+            increment()
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    if not executor:
+        for sub_repo in publication_data.sub_repos:
+            name = sub_repo[0]
+            content = getattr(publication_data, f"{name}_content")
+            extra_repomdrecords = getattr(publication_data, f"{name}_repomdrecords")
+            cache_hits += generate_repo_metadata(
+                content,
+                publication,
+                checksum_types,
+                extra_repomdrecords,
+                name,
+                metadata_signing_service=metadata_signing_service,
+                compression_type=compression_type,
+                package_selection=getattr(publication_data, f"{name}_package_selection"),
+            )
+            increment()
+
+    return cache_hits
+
+
+def init_sub_repo_worker(domain_pk):
+    """
+    Set up a worker process generating the metadata of sub-repos.
+
+    Args:
+        domain_pk (str): The domain of the task.
+
+    """
+    set_domain(Domain.objects.get(pk=domain_pk))
+
+
+def generate_sub_repo_metadata(
+    repository_version_pk,
+    publication_pk,
+    checksum_types,
+    extra_repomdrecords,
+    sub_folder,
+    metadata_signing_service_pk=None,
+    compression_type=COMPRESSION_TYPES.GZ,
+    package_selection=None,
+):
+    """
+    Generate the metadata of a sub-repo in a worker process.
+
+    Querysets and model instances aren't passed to another process, so the content, the
+    publication and the signing service are looked up by their primary keys instead.
+
+    Args:
+        repository_version_pk (str): The repository version of the sub-repo.
+        publication_pk (str): The publication being created.
+        checksum_types (dict): Checksum types for metadata and packages.
+        extra_repomdrecords (list): list with data relative to repo metadata files
+        sub_folder (str): name of the folder of the sub-repo
+        metadata_signing_service_pk (str): The signing service of the publication, if any.
+        compression_type (pulp_rpm.app.constants.COMPRESSION_TYPES):
+            Compression type to use for metadata files.
+        package_selection (tuple): The packages picked by `select_packages` for the sub-repo.
+
+    Returns:
+        bool: Whether the repodata of an earlier publication was reused.
+
+    """
+    metadata_signing_service = None
+    if metadata_signing_service_pk:
+        metadata_signing_service = AsciiArmoredDetachedSigningService.objects.get(
+            pk=metadata_signing_service_pk
+        )
+    return generate_repo_metadata(
+        RepositoryVersion.objects.get(pk=repository_version_pk).content,
+        RpmPublication.objects.get(pk=publication_pk),
+        checksum_types,
+        extra_repomdrecords,
+        sub_folder,
+        metadata_signing_service=metadata_signing_service,
+        compression_type=compression_type,
+        package_selection=package_selection,
+    )
+
+
 def generate_repo_metadata(
     content,
     publication,
@@ -430,6 +1163,8 @@ def generate_repo_metadata(
     metadata_signing_service=None,
     compression_type=COMPRESSION_TYPES.GZ,
     layout=LAYOUT_TYPES.NESTED_ALPHABETICALLY,
+    previous_publication=None,
+    package_selection=None,
 ):
     """
     Creates a repomd.xml file.
@@ -445,6 +1180,15 @@ def generate_repo_metadata(
             Compression type to use for metadata files.
         layout(pulp_rpm.app.constants.LAYOUT_TYPES):
             How to layout the package files within the publication (flat, nested, etc.)
+        previous_publication (pulp_rpm.app.models.RpmPublication): An earlier publication of
+            the same repository with the same options. The package metadata of packages which
+            haven't changed since is reused rather than regenerated.
+        package_selection (tuple): The packages picked by `select_packages` for the content,
+            if they have been picked already.
+
+    Returns:
+        bool: Whether the repodata of an earlier publication was reused, see
+            `RPM_PUBLISH_METADATA_CACHE`.
 
     """
     cwd = os.getcwd()
@@ -512,28 +1256,34 @@ def generate_repo_metadata(
 
         pkg_to_hash[ca["content_id"]] = (package_checksum_type, pkgid)
 
-    # TODO: this is meant to be a !! *temporary* !! fix for
-    # https://github.com/pulp/pulp_rpm/issues/2407
-    pkg_pks_to_ignore = set()
-    latest_build_time_by_nevra = defaultdict(list)
-    packages = Package.objects.filter(pk__in=content)
-    for pkg in packages.only(
-        "pk", "name", "epoch", "version", "release", "arch", "time_build"
-    ).iterator():
-        latest_build_time_by_nevra[pkg.nevra].append((pkg.time_build, pkg.pk))
-    for nevra, pkg_data in latest_build_time_by_nevra.items():
-        # sort the packages by when they were built
-        if len(pkg_data) > 1:
-            pkg_data.sort(key=lambda p: p[0], reverse=True)
-            pkg_pks_to_ignore |= set(entry[1] for entry in pkg_data[1:])
-            log.warning(
-                "Duplicate packages found competing for NEVRA {nevra}, selected the one with "
-                "the most recent build time, excluding {others} others.".format(
-                    nevra=nevra, others=len(pkg_data[1:])
-                )
-            )
+    digest = None
+    if settings.RPM_PUBLISH_METADATA_CACHE:
+        options = {
+            "checksum_type": publication.checksum_type,
+            "package_checksum_type": checksum_types.get("package"),
+            "compression_type": compression_type,
+            "layout": layout,
+            "metadata_signing_service": getattr(
+                metadata_signing_service, "pk", metadata_signing_service
+            ),
+            "extra_repomdrecords": ",".join(sorted(name for name, _path in extra_repomdrecords)),
+        }
+        if settings.RPM_METADATA_USE_REPO_PACKAGE_TIME:
+            # the file times depend on when the packages were added to this repository version
+            options["repository_version"] = publication.repository_version.pk
+        digest = get_repodata_digest(
+            content.order_by("pk").values_list("pk", flat=True).iterator(), options, pkg_to_hash
+        )
+        cache_hit = reuse_cached_repodata(digest, publication, repodata_path)
+        RepodataDigest.objects.create(
+            publication=publication, relative_path=repodata_path, digest=digest
+        )
+        if cache_hit:
+            return True
 
-    total_packages = packages.count() - len(pkg_pks_to_ignore)
+    if package_selection is None:
+        package_selection = select_packages(content)
+    total_packages, pkg_pks_to_ignore = package_selection
 
     if settings.RPM_METADATA_USE_REPO_PACKAGE_TIME:
         # gather the times the packages were added to the repo
@@ -547,6 +1297,105 @@ def generate_repo_metadata(
         )
         repo_pkg_times = {pk: created.timestamp() for pk, created in repo_content}
 
+    def get_location_href(location_href):
+        pkg_filename = os.path.basename(location_href)
+        if layout == LAYOUT_TYPES.NESTED_ALPHABETICALLY:
+            # this can cause an issue when two same RPM package names appears
+            # a/name1.rpm b/name1.rpm
+            return os.path.join(PACKAGES_DIRECTORY, pkg_filename[0].lower(), pkg_filename)
+        elif layout == LAYOUT_TYPES.FLAT:
+            return os.path.join(PACKAGES_DIRECTORY, pkg_filename)
+        else:
+            raise ValueError("Layout value is unsupported by this version")
+
+    def render_package(pk, pkg):
+        # rewrite the checksum and checksum type with the desired ones
+        (checksum, pkgId) = pkg_to_hash[pk]
+        pkg.checksum_type = checksum
+        pkg.pkgId = pkgId
+
+        pkg.location_href = get_location_href(pkg.location_href)
+
+        if settings.RPM_METADATA_USE_REPO_PACKAGE_TIME:
+            pkg.time_file = repo_pkg_times[pk]
+
+        return pkg
+
+    def render_fragments(pk, location_href, time_file, *fragments):
+        (checksum, pkgId) = pkg_to_hash[pk]
+        if settings.RPM_METADATA_USE_REPO_PACKAGE_TIME:
+            time_file = repo_pkg_times[pk]
+        return PackageMetadataFragments.render(
+            fragments, checksum, pkgId, get_location_href(location_href), time_file
+        )
+
+    ordered_packages = (
+        Package.objects.filter(pk__in=content)
+        .exclude(pk__in=pkg_pks_to_ignore)
+        .order_by("name", "evr")
+    )
+    # Stream only the needed columns rather than instantiating whole Package objects
+    pkg_iterator = (
+        render_package(pk, pkg) for pk, pkg in Package.iter_createrepo_c(ordered_packages)
+    )
+    chunk_iterator = None
+
+    previous_metadata = None
+    if previous_publication and (
+        previous_publication.checksum_type != publication.checksum_type
+        or previous_publication.package_checksum_type != publication.package_checksum_type
+    ):
+        # the previous metadata lists different checksums, none of the packages would match
+        previous_publication = None
+    if previous_publication:
+        added_pks = set(
+            ordered_packages.exclude(
+                pk__in=previous_publication.repository_version.content
+            ).values_list("pk", flat=True)
+        )
+        # Splicing only pays off when most of the repository is unchanged.
+        if len(added_pks) <= total_packages // 2:
+            previous_metadata = copy_published_metadata(
+                previous_publication,
+                ["primary", "filelists", "other"],
+                tempfile.mkdtemp(dir="."),
+                sub_folder=sub_folder,
+            )
+        if previous_metadata:
+            log.info(
+                _("Reusing package metadata of publication {}, {} packages added.").format(
+                    previous_publication.pk, len(added_pks)
+                )
+            )
+            pkg_iterator = splice_packages(
+                ordered_packages.values_list("pk", flat=True).iterator(),
+                dict(Package.iter_createrepo_c(ordered_packages.filter(pk__in=added_pks))),
+                {
+                    pk: pkg_to_hash[pk][1]
+                    for pk in pkg_to_hash.keys() - added_pks - pkg_pks_to_ignore
+                },
+                cr.PackageIterator(
+                    previous_metadata["primary"],
+                    previous_metadata["filelists"],
+                    previous_metadata["other"],
+                ),
+                render_package,
+            )
+
+    if settings.RPM_PUBLISH_PACKAGE_FRAGMENTS and not previous_metadata:
+        # Render the XML of packages published for the first time once, after that the stored
+        # fragments are only concatenated.
+        PackageMetadataFragments.create_missing(ordered_packages)
+        fragments = ordered_packages.values_list(
+            "pk",
+            "location_href",
+            "time_file",
+            "metadata_fragments__primary",
+            "metadata_fragments__filelists",
+            "metadata_fragments__other",
+        )
+        chunk_iterator = (render_fragments(*row) for row in fragments.iterator(chunk_size=2000))
+
     repomd_path = os.path.join(repodata_path, "repomd.xml")
     mod_yml_path = os.path.join(repodata_path, "modules.yaml")
     comps_xml_path = os.path.join(repodata_path, "comps.xml")
@@ -558,38 +1407,22 @@ def generate_repo_metadata(
         cwd, compression=cr_compression_type, checksum_type=cr_checksum_type
     ) as writer:
         writer.set_num_of_pkgs(total_packages)
+        if settings.RPM_PUBLISH_PARALLEL_COMPRESSION:
+            compress_packages_in_parallel(writer, cr_compression_type, total_packages)
 
         # If the repository is empty, use a revision of 0
         # See: https://pulp.plan.io/issues/9402
         if not content.exists():
             writer.repomd.revision = "0"
 
-        for package in packages.order_by("name", "evr").iterator():
-            if package.pk in pkg_pks_to_ignore:  # Temporary!
-                continue
-            pkg = package.to_createrepo_c()
-
-            # rewrite the checksum and checksum type with the desired ones
-            (checksum, pkgId) = pkg_to_hash[package.pk]
-            pkg.checksum_type = checksum
-            pkg.pkgId = pkgId
-
-            pkg_filename = os.path.basename(package.location_href)
-            if layout == LAYOUT_TYPES.NESTED_ALPHABETICALLY:
-                # this can cause an issue when two same RPM package names appears
-                # a/name1.rpm b/name1.rpm
-                pkg_path = os.path.join(PACKAGES_DIRECTORY, pkg_filename[0].lower(), pkg_filename)
-            elif layout == LAYOUT_TYPES.FLAT:
-                pkg_path = os.path.join(PACKAGES_DIRECTORY, pkg_filename)
-            else:
-                raise ValueError("Layout value is unsupported by this version")
-
-            pkg.location_href = pkg_path
-
-            if settings.RPM_METADATA_USE_REPO_PACKAGE_TIME:
-                pkg.time_file = repo_pkg_times[package.pk]
-
-            writer.add_pkg(pkg)
+        if chunk_iterator is None:
+            chunk_iterator = (cr.xml_dump(pkg) for pkg in pkg_iterator)
+        xml_files = [
+            writer.working_metadata_files[name].writer for name in ("primary", "filelists", "other")
+        ]
+        for chunks in chunk_iterator:
+            for xml_file, chunk in zip(xml_files, chunks):
+                xml_file.add_chunk(chunk)
 
         # Process update records
         update_records = UpdateRecord.objects.filter(pk__in=content).order_by("id", "digest")
@@ -598,57 +1431,38 @@ def generate_repo_metadata(
 
         # Process modulemd, modulemd_defaults and obsoletes
         with open(mod_yml_path, "ab") as mod_yml:
-            modulemds = Modulemd.objects.filter(pk__in=content).order_by(
-                *Modulemd.natural_key_fields()
-            )
-            for modulemd in modulemds.iterator():
-                mod_yml.write(modulemd.snippet.encode())
-                mod_yml.write(b"\n")
-                has_modules = True
-            modulemd_defaults = ModulemdDefaults.objects.filter(pk__in=content).order_by(
-                *ModulemdDefaults.natural_key_fields()
-            )
-            for default in modulemd_defaults.iterator():
-                mod_yml.write(default.snippet.encode())
-                mod_yml.write(b"\n")
-                has_modules = True
-            modulemd_obsoletes = ModulemdObsolete.objects.filter(pk__in=content).order_by(
-                *ModulemdObsolete.natural_key_fields()
-            )
-            for obsolete in modulemd_obsoletes.iterator():
-                mod_yml.write(obsolete.snippet.encode())
+            for snippet in modular_snippets(content):
+                mod_yml.write(snippet.encode())
                 mod_yml.write(b"\n")
                 has_modules = True
 
-        # Process comps
-        comps = libcomps.Comps()
-        for pkg_grp in PackageGroup.objects.filter(pk__in=content).order_by("id").iterator():
-            group = pkg_grp.pkg_grp_to_libcomps()
-            comps.groups.append(group)
-            has_comps = True
-        for pkg_cat in PackageCategory.objects.filter(pk__in=content).order_by("id").iterator():
-            cat = pkg_cat.pkg_cat_to_libcomps()
-            comps.categories.append(cat)
-            has_comps = True
-        for pkg_env in PackageEnvironment.objects.filter(pk__in=content).order_by("id").iterator():
-            env = pkg_env.pkg_env_to_libcomps()
-            comps.environments.append(env)
-            has_comps = True
+        # Process comps, one element at a time
+        langpacks = None
         package_langpacks = PackageLangpacks.objects.filter(pk__in=content).order_by(
             *PackageLangpacks.natural_key_fields()
         )
         for pkg_lng in package_langpacks.iterator():
-            comps.langpacks = dict_to_strdict(pkg_lng.matches)
-            has_comps = True
+            langpacks = dict_to_strdict(pkg_lng.matches)
 
-        comps.toxml_f(
+        has_comps = write_comps_xml(
             comps_xml_path,
-            xml_options={
-                "default_explicit": True,
-                "empty_groups": True,
-                "empty_packages": True,
-                "uservisible_explicit": True,
-            },
+            groups=(
+                pkg_grp.pkg_grp_to_libcomps()
+                for pkg_grp in PackageGroup.objects.filter(pk__in=content).order_by("id").iterator()
+            ),
+            categories=(
+                pkg_cat.pkg_cat_to_libcomps()
+                for pkg_cat in PackageCategory.objects.filter(pk__in=content)
+                .order_by("id")
+                .iterator()
+            ),
+            environments=(
+                pkg_env.pkg_env_to_libcomps()
+                for pkg_env in PackageEnvironment.objects.filter(pk__in=content)
+                .order_by("id")
+                .iterator()
+            ),
+            langpacks=langpacks,
         )
 
         if has_modules:
@@ -701,7 +1515,8 @@ def generate_repo_metadata(
 
         # publish a public key required for further verification
         pubkey_name = "repomd.xml.key"
-        with open(pubkey_name, "wb+") as f:
+        # written next to repomd.xml, the working directory may be shared with other sub-repos
+        with open(os.path.join(repodata_path, pubkey_name), "wb+") as f:
             f.write(signing_service.public_key.encode("utf-8"))
             f.flush()
             # important! as the file has already been opened and used, it will be treated as a
@@ -719,3 +1534,5 @@ def generate_repo_metadata(
                 publication=publication,
                 file=File(repomd_fd),
             )
+
+    return False
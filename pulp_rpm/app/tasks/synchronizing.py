@@ -1,22 +1,26 @@
 import asyncio
-import collections
-import functools
 import json
 import logging
 import os
 import re
+import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import uuid
+import zlib
 
 from collections import defaultdict
 from gettext import gettext as _  # noqa:F401
+from itertools import islice
 
-from asgiref.sync import sync_to_async
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files import File
-from django.db import transaction
-from django.db.models import Q
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
 
 
 from aiohttp.client_exceptions import ClientResponseError
@@ -25,13 +29,13 @@ from aiohttp.web_exceptions import HTTPNotFound
 import createrepo_c as cr
 import libcomps
 
+from pulpcore.plugin.download import DownloadResult
 from pulpcore.plugin.util import get_domain
 from pulpcore.plugin.models import (
     Artifact,
     ContentArtifact,
     ProgressReport,
     Remote,
-    PublishedArtifact,
     PublishedMetadata,
 )
 from pulpcore.plugin.stages import (
@@ -47,7 +51,8 @@ from pulpcore.plugin.stages import (
     QueryExistingArtifacts,
     QueryExistingContents,
 )
-from pulp_rpm.app.advisory import hash_update_record
+from pulp_rpm.app.advisory import hash_update_record, iter_updateinfo, iter_updateinfo_batches
+from pulp_rpm.app.bulk_insert import bulk_insert, copy_insert_content, copy_insert_enabled
 from pulp_rpm.app.constants import (
     CHECKSUM_TYPES,
     COMPS_REPODATA,
@@ -56,6 +61,7 @@ from pulp_rpm.app.constants import (
     PACKAGE_DB_REPODATA,
     PACKAGE_REPODATA,
     PULP_MODULE_ATTR,
+    PULP_PACKAGE_ATTRS,
     SYNC_POLICIES,
     UPDATE_REPODATA,
 )
@@ -86,6 +92,7 @@ from pulp_rpm.app.models import (
 from pulp_rpm.app.modulemd import parse_modular
 
 from pulp_rpm.app.comps import strdict_to_dict, dict_digest
+from pulp_rpm.app.metadata_cache import get_metadata_cache
 from pulp_rpm.app.kickstart.treeinfo import PulpTreeInfo, TreeinfoData
 from pulp_rpm.app.shared_utils import (
     is_previous_version,
@@ -93,18 +100,36 @@ from pulp_rpm.app.shared_utils import (
     urlpath_sanitize,
 )
 from pulp_rpm.app.rpm_version import RpmVersion
+from pulp_rpm.app.tasks.publishing import (
+    PublishedArtifactWriter,
+    publish_metadata_artifact,
+    publish_other_artifacts,
+)
 
 log = logging.getLogger(__name__)
 
 
-# TODO: https://pulp.plan.io/issues/8687
-# A global dictionary for storing data about the remote's metadata files, used for mirroring
-# Indexed by repository.pk due to sub-repos.
-metadata_files_for_mirroring = collections.defaultdict(dict)
-# A global dictionary for storing data mapping pkgid to location_href for all packages, used
-# for mirroring. Indexed by repository.pk due to sub-repos.
-pkgid_to_location_href = collections.defaultdict(functools.partial(collections.defaultdict, set))
-
+# How many packages are looked up in a MirroringIndex at once while publishing
+MIRRORING_INDEX_BATCH_SIZE = 500
+
+# How often a ProgressCounter updates its progress report, in items and in seconds
+PROGRESS_BATCH_SIZE = 1000
+PROGRESS_INTERVAL = 0.5
+
+# The bulky fields of packages which are packed while packages pass through the sync pipeline
+PACKED_PACKAGE_FIELDS = (
+    PULP_PACKAGE_ATTRS.CHANGELOGS,
+    PULP_PACKAGE_ATTRS.CONFLICTS,
+    PULP_PACKAGE_ATTRS.DESCRIPTION,
+    PULP_PACKAGE_ATTRS.ENHANCES,
+    PULP_PACKAGE_ATTRS.FILES,
+    PULP_PACKAGE_ATTRS.OBSOLETES,
+    PULP_PACKAGE_ATTRS.PROVIDES,
+    PULP_PACKAGE_ATTRS.RECOMMENDS,
+    PULP_PACKAGE_ATTRS.REQUIRES,
+    PULP_PACKAGE_ATTRS.SUGGESTS,
+    PULP_PACKAGE_ATTRS.SUPPLEMENTS,
+)
 
 MIRROR_INCOMPATIBLE_REPO_ERR_MSG = (
     "This repository uses features which are incompatible with 'mirror' sync. "
@@ -112,47 +137,379 @@ MIRROR_INCOMPATIBLE_REPO_ERR_MSG = (
 )
 
 
-def store_metadata_for_mirroring(repo, md_path, relative_path):
-    """Used to store data about the downloaded metadata for mirror-publishing after the sync.
+class MirroringIndex:
+    """
+    A per-task index of the metadata files and package locations of the synced repositories.
+
+    It is used to create the publication of a "mirror_complete" sync once the sync is done. The
+    index is kept in an SQLite database in the task working directory rather than in memory, as
+    it holds an entry for every package of the repository and of all of its sub-repos. It is
+    indexed by repository.pk due to sub-repos, which may be synced in threads of their own, and
+    it is removed when it is closed.
+    """
+
+    def __init__(self):
+        """Create an empty index."""
+        self.directory = tempfile.mkdtemp(dir=".")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(self.directory, "mirroring.sqlite3"), check_same_thread=False
+        )
+        # the index doesn't outlive the task, so it doesn't need to survive a crash
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE metadata_files ("
+            "repository TEXT, relative_path TEXT, path TEXT, "
+            "PRIMARY KEY (repository, relative_path)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE packages ("
+            "repository TEXT, pkgid TEXT, location_href TEXT, "
+            "PRIMARY KEY (repository, pkgid, location_href)) WITHOUT ROWID"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the index and remove its database."""
+        self.connection.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def add_metadata_file(self, repo, md_path, relative_path):
+        """Store data about a downloaded metadata file for mirror-publishing after the sync.
+
+        Args:
+            repo: Which repository the metadata is associated with
+            md_path: The path to the metadata file
+            relative_path: The relative path to the metadata file within the repository
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata_files VALUES (?, ?, ?)",
+                (str(repo.pk), relative_path, md_path),
+            )
+
+    def add_package(self, repo, pkgid, location_href):
+        """Store data about a package for mirror-publishing after the sync.
+
+        Some repositories have the same package present in multiple places, i.e. with the
+        same pkgid at more than one location_href, so all of them are kept.
+
+        Args:
+            repo: Which repository the package is associated with
+            pkgid: The checksum of the package
+            location_href: The relative path to the package within the repository
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO packages VALUES (?, ?, ?)",
+                (str(repo.pk), pkgid, location_href),
+            )
+
+    def metadata_files(self, repo):
+        """Get the metadata files stored for a repository.
+
+        Args:
+            repo: The repository
+
+        Returns:
+            dict: The paths of the metadata files keyed by their relative paths
+        """
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT relative_path, path FROM metadata_files WHERE repository = ?",
+                    (str(repo.pk),),
+                )
+            )
+
+    def location_hrefs(self, repo, pkgids):
+        """Get the locations stored for some packages of a repository.
+
+        Args:
+            repo: The repository
+            pkgids: The checksums of the packages
+
+        Returns:
+            dict: The sets of relative paths of the packages keyed by their checksums
+        """
+        pkgids = list(pkgids)
+        locations = defaultdict(set)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT pkgid, location_href FROM packages "
+                "WHERE repository = ? AND pkgid IN ({})".format(", ".join("?" * len(pkgids))),
+                [str(repo.pk), *pkgids],
+            ).fetchall()
+        for pkgid, location_href in rows:
+            locations[pkgid].add(location_href)
+        return locations
+
+
+class PackedPackageFields:
+    """
+    The bulky fields of a package, compressed into a single bytes object.
+
+    Until a new package is saved, only its compressed fields are kept, rather than the many
+    Python lists and strings of its changelogs, files and dependencies.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, fields):
+        """
+        Args:
+            fields (dict): The values of the fields by name
+        """
+        self.data = zlib.compress(json.dumps(fields, separators=(",", ":")).encode(), 1)
+
+    def unpack_into(self, package):
+        """
+        Set the fields on a package.
+
+        Args:
+            package (pulp_rpm.app.models.Package): The package the fields were packed from
+        """
+        for name, value in json.loads(zlib.decompress(self.data)).items():
+            setattr(package, name, value)
+
+
+class ProgressCounter:
+    """
+    Count processed items and update a progress report with them in batches.
+
+    The progress report is updated at most every `batch_size` items or every `interval` seconds,
+    along with the rate of items per second as its suffix, rather than once per item.
+
+    It's used as an async context manager nested in the one of the progress report, and updates
+    the progress report with the remaining items on exit.
+    """
+
+    def __init__(self, progress_report, batch_size=PROGRESS_BATCH_SIZE, interval=PROGRESS_INTERVAL):
+        """
+        Args:
+            progress_report: The progress report to update
+            batch_size: The number of items after which the progress report is updated
+            interval: The number of seconds after which the progress report is updated
+        """
+        self.progress_report = progress_report
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = 0
+        self.started = self.last_update = time.monotonic()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aupdate()
+
+    async def aincrement(self):
+        """Count an item, and update the progress report if it's due."""
+        self.pending += 1
+        if self.pending >= self.batch_size or time.monotonic() - self.last_update >= self.interval:
+            await self.aupdate()
+
+    async def aupdate(self):
+        """Update the progress report with the counted items."""
+        now = time.monotonic()
+        if now > self.started:
+            rate = (self.progress_report.done + self.pending) / (now - self.started)
+            self.progress_report.suffix = f"{rate:.1f}/s"
+        self.last_update = now
+        pending, self.pending = self.pending, 0
+        await self.progress_report.aincrease_by(pending)
+
+
+def get_existing_update_records(digests):
+    """Get the advisories with the given digests which already exist in the domain.
+
+    The advisories are touched, just like QueryExistingContents would, so that they aren't
+    removed as orphans while the sync is running. Whether they have collections and references
+    is annotated as `has_collections` and `has_references`, see `has_relations`.
+
+    Args:
+        digests: The digests of the advisories
+
+    Returns:
+        dict: The existing advisories by digest
+    """
+    update_records = UpdateRecord.objects.filter(_pulp_domain=get_domain(), digest__in=digests)
+    update_records.touch()
+    update_records = update_records.annotate(
+        has_collections=Exists(UpdateCollection.objects.filter(update_record=OuterRef("pk"))),
+        has_references=Exists(UpdateReference.objects.filter(update_record=OuterRef("pk"))),
+    )
+    return {update_record.digest: update_record for update_record in update_records.iterator()}
+
+
+def has_relations(update_record, update):
+    """Whether an existing advisory has the collections and references it was parsed with.
+
+    Advisories whose relations weren't (completely) saved, e.g. by an interrupted sync, have
+    to be built again so that the missing relations are saved.
 
     Args:
-        repo: Which repository the metadata is associated with
-        md_path: The path to the metadata file
-        relative_path: The relative path to the metadata file within the repository
+        update_record: An advisory from `get_existing_update_records`
+        update: The parsed createrepo_c.UpdateRecord with the same digest
+
+    Returns:
+        bool: Whether the advisory can be used as it is
     """
-    global metadata_files_for_mirroring
-    metadata_files_for_mirroring[str(repo.pk)][relative_path] = md_path
+    return (update_record.has_collections or not update.collections) and (
+        update_record.has_references or not update.references
+    )
 
 
-def store_package_for_mirroring(repo, pkgid, location_href):
-    """Used to store data about the packages for mirror-publishing after the sync.
+def run_with_event_loop(func, *args):
+    """Run a function in a worker thread, with an event loop and a database connection of its own.
 
     Args:
-        repo: Which repository the metadata is associated with
-        pkgid: The checksum of the package
-        location_href: The relative path to the package within the repository
+        func: The function to run
+        args: The arguments of the function
+
+    Returns:
+        The result of the function
     """
-    global pkgid_to_location_href
-    # this shouldn't really add the location_href to a list, really it ought to set the value
-    # but unfortunately some repositories have the same packages present in multiple places
-    # same pkgid, >1 different location_hrefs
-    pkgid_to_location_href[str(repo.pk)][pkgid].add(location_href)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return func(*args)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        connection.close()
 
 
-def add_metadata_to_publication(publication, version, prefix=""):
-    """Create a mirrored publication for the given repository version.
+# The directory of the primary repository of a distribution tree, in which the sub-repos are
+PRIMARY_REPO = ""
+
+
+def sync_repos(sync_repo, repos_to_sync, sub_repo_workers=0):
+    """Sync the sub-repos of a distribution tree and then its primary repository.
+
+    With `sub_repo_workers`, that many sub-repos are synced concurrently. Each of them is synced
+    in a worker thread with an event loop of its own, and within a ThreadSensitiveContext, so the
+    database access of its pipeline happens in a thread and on a connection of its own, rather
+    than in the single thread shared by all the pipelines otherwise. Parsing metadata still
+    happens in the process of the task, so mostly the downloads of the sub-repos overlap.
 
-    Uses the `metadata_files` global data.
+    If syncing a sub-repo fails, the sub-repos which haven't been started yet and the primary
+    repository aren't synced at all, and the error is raised once the running syncs are complete.
+
+    Args:
+        sync_repo: The function syncing a repository, called with its directory and config
+        repos_to_sync (dict): The configs of the repositories to sync, by directory
+        sub_repo_workers (int): The number of sub-repos synced concurrently
+
+    Returns:
+        dict: The results of `sync_repo`, by directory
+
+    """
+    repo_sync_results = {}
+    repos_to_sync = dict(repos_to_sync)
+    sub_repos_to_sync = {
+        directory: repos_to_sync.pop(directory)
+        for directory in list(repos_to_sync)
+        if directory != PRIMARY_REPO
+    }
+    sub_repo_workers = min(sub_repo_workers, len(sub_repos_to_sync))
+
+    if sub_repo_workers:
+        semaphore = asyncio.Semaphore(sub_repo_workers)
+        errors = []
+
+        async def sync_sub_repo(directory, repo_config):
+            async with semaphore:
+                if errors:
+                    return
+                async with ThreadSensitiveContext():
+                    try:
+                        repo_sync_results[directory] = await sync_to_async(
+                            run_with_event_loop, thread_sensitive=False
+                        )(sync_repo, directory, repo_config)
+                    except Exception as exc:
+                        errors.append(exc)
+                    finally:
+                        # the connection of the thread the pipeline accessed the database in
+                        await sync_to_async(connection.close)()
+
+        async def sync_sub_repos():
+            await asyncio.gather(
+                *(
+                    sync_sub_repo(directory, repo_config)
+                    for directory, repo_config in sub_repos_to_sync.items()
+                )
+            )
+
+        asyncio.get_event_loop().run_until_complete(sync_sub_repos())
+        if errors:
+            raise errors[0]
+        sub_repos_to_sync = {}
+
+    # make sure PRIMARY is the LAST thing we process here, or autopublish will fail to find any
+    # subrepo-content.
+    repos_to_sync = {**sub_repos_to_sync, **repos_to_sync}
+    for directory, repo_config in repos_to_sync.items():
+        repo_sync_results[directory] = sync_repo(directory, repo_config)
+    return repo_sync_results
+
+
+# The natural key of a package within a domain
+PACKAGE_KEY_FIELDS = [field for field in Package.natural_key_fields() if field != "_pulp_domain"]
+
+
+def get_existing_package_keys(repository):
+    """Get the natural keys of the packages in the latest version of a repository.
+
+    Args:
+        repository: The repository being synced
+
+    Returns:
+        set: tuples of the values of PACKAGE_KEY_FIELDS
+    """
+    version = repository.latest_version()
+    if version is None:
+        return set()
+    packages = Package.objects.filter(pk__in=version.content).values_list(*PACKAGE_KEY_FIELDS)
+    return set(packages.iterator())
+
+
+def add_metadata_to_publication(publication, version, mirroring_index, prefix=""):
+    """Create a mirrored publication for the given repository version.
 
     Args:
         publication: The publication to add downloaded repo metadata to
         version: The repository version the repo corresponds to
+        mirroring_index: The MirroringIndex of the sync
     Kwargs:
         prefix: Subdirectory underneath the root repository (if a sub-repo)
     """
-    repo_metadata_files = metadata_files_for_mirroring[str(version.repository.pk)]
+    repo_metadata_files = mirroring_index.metadata_files(version.repository)
+
+    # Metadata files of unknown types (productid, extra filelists, ...) have already been saved
+    # as RepoMetadataFile content of the same sync, publish those Artifacts as they are.
+    stored_artifacts = {
+        ca.relative_path: ca.artifact
+        for ca in ContentArtifact.objects.select_related("artifact").filter(
+            content__in=version.content,
+            content__pulp_type=RepoMetadataFile.get_pulp_type(),
+            relative_path__in=repo_metadata_files.keys(),
+            artifact__isnull=False,
+        )
+    }
 
     for relative_path, metadata_file_path in repo_metadata_files.items():
+        if relative_path in stored_artifacts:
+            publish_metadata_artifact(
+                stored_artifacts[relative_path], os.path.join(prefix, relative_path), publication
+            )
+            continue
         with open(metadata_file_path, "rb") as metadata_fd:
             PublishedMetadata.create_from_file(
                 file=File(metadata_fd),
@@ -160,65 +517,36 @@ def add_metadata_to_publication(publication, version, prefix=""):
                 publication=publication,
             )
 
-    published_artifacts = []
-
-    # Handle packages
-    pkg_data = ContentArtifact.objects.filter(
-        content__in=version.content, content__pulp_type=Package.get_pulp_type()
-    ).values("pk", "content__rpm_package__pkgId")
-    for ca in pkg_data.iterator():
-        for relative_path in pkgid_to_location_href[str(version.repository.pk)][
-            ca["content__rpm_package__pkgId"]
-        ]:
-            pa = PublishedArtifact(
-                content_artifact_id=ca["pk"],
-                relative_path=os.path.join(prefix, relative_path),
-                publication=publication,
-            )
-            published_artifacts.append(pa)
-
-    # Handle everything else
-    # TODO: this code is copied directly from publication, we should deduplicate it later
-    # (if possible)
-    is_treeinfo = Q(relative_path__in=["treeinfo", ".treeinfo"])
-    unpublishable_types = Q(
-        content__pulp_type__in=[
-            RepoMetadataFile.get_pulp_type(),
-            Modulemd.get_pulp_type(),
-            ModulemdDefaults.get_pulp_type(),
-            # already dealt with
-            Package.get_pulp_type(),
-        ]
-    )
-
-    contentartifact_qs = (
-        ContentArtifact.objects.filter(content__in=version.content)
-        .exclude(unpublishable_types)
-        .exclude(is_treeinfo)
+    artifacts_pb = ProgressReport(
+        message="Publishing artifacts", code="publish.publishing_artifacts"
     )
-
-    for content_artifact in contentartifact_qs.values("pk", "relative_path").iterator():
-        published_artifacts.append(
-            PublishedArtifact(
-                relative_path=content_artifact["relative_path"],
-                publication=publication,
-                content_artifact_id=content_artifact["pk"],
+    with artifacts_pb, PublishedArtifactWriter(publication, artifacts_pb) as writer:
+        # Handle packages
+        pkg_data = ContentArtifact.objects.filter(
+            content__in=version.content, content__pulp_type=Package.get_pulp_type()
+        ).values("pk", "content__rpm_package__pkgId")
+        pkg_data_iterator = pkg_data.iterator(chunk_size=MIRRORING_INDEX_BATCH_SIZE)
+        while batch := list(islice(pkg_data_iterator, MIRRORING_INDEX_BATCH_SIZE)):
+            location_hrefs = mirroring_index.location_hrefs(
+                version.repository, {ca["content__rpm_package__pkgId"] for ca in batch}
             )
-        )
+            for ca in batch:
+                for relative_path in location_hrefs[ca["content__rpm_package__pkgId"]]:
+                    writer.add(os.path.join(prefix, relative_path), ca["pk"])
 
-    PublishedArtifact.objects.bulk_create(published_artifacts)
+        # Handle everything else
+        publish_other_artifacts(version.content, writer)
 
 
-def get_repomd_file(remote, url):
+def get_repomd_url(url):
     """
-    Check if repodata exists.
+    Get the URL of the repomd.xml of a repository.
 
     Args:
-        remote (RpmRemote or UlnRemote): An RpmRemote or UlnRemote to download with.
         url (str): A remote repository URL
 
     Returns:
-        pulpcore.plugin.download.DownloadResult: downloaded repomd.xml
+        str: The URL of repomd.xml
 
     """
     # URLs, esp mirrorlist URLs, can come into this method with parameters attached.
@@ -227,43 +555,127 @@ def get_repomd_file(remote, url):
     # Make sure we're only looking for the repomd.xml file, no matter what weirdness comes
     # in. See https://pulp.plan.io/issues/8981 for more details.
     url = url.split("?")[0]
-    downloader = remote.get_downloader(url=urlpath_sanitize(url, "repodata/repomd.xml"))
-    return downloader.fetch()
+    return urlpath_sanitize(url, "repodata/repomd.xml")
+
 
+async def aget_repomd_file(remote, url, repomd_results=None):
+    """
+    Check if repodata exists.
 
-def fetch_mirror(remote):
+    Args:
+        remote (RpmRemote or UlnRemote): An RpmRemote or UlnRemote to download with.
+        url (str): A remote repository URL
+        repomd_results (dict): Downloaded repomd.xml files by URL, used to download each of
+            them only once
+
+    Returns:
+        pulpcore.plugin.download.DownloadResult: downloaded repomd.xml
+
+    """
+    repomd_url = get_repomd_url(url)
+    if repomd_results is not None and repomd_url in repomd_results:
+        return repomd_results[repomd_url]
+    downloader = remote.get_downloader(url=repomd_url)
+    result = await downloader.run()
+    if repomd_results is not None:
+        repomd_results[repomd_url] = result
+    return result
+
+
+def get_repomd_file(remote, url, repomd_results=None):
+    """
+    Check if repodata exists.
+
+    Args:
+        remote (RpmRemote or UlnRemote): An RpmRemote or UlnRemote to download with.
+        url (str): A remote repository URL
+        repomd_results (dict): Downloaded repomd.xml files by URL, used to download each of
+            them only once
+
+    Returns:
+        pulpcore.plugin.download.DownloadResult: downloaded repomd.xml
+
+    """
+    return asyncio.get_event_loop().run_until_complete(
+        aget_repomd_file(remote, url, repomd_results)
+    )
+
+
+def fetch_mirror(remote, repomd_results=None):
     """Fetch the first valid mirror from a list of all available mirrors from a mirror list feed.
 
     URLs which are commented out or have any punctuations in front of them are being ignored.
+    The mirrors are probed `RPM_MIRRORLIST_PROBES` at a time, in the order of the list, and the
+    first of them to serve its repomd.xml is used. The repomd.xml of the mirror is added to
+    `repomd_results`, if given.
     """
     downloader = remote.get_downloader(url=remote.url.rstrip("/"), urlencode=False)
     result = downloader.fetch()
 
     url_pattern = re.compile(r"(^|^[\w\s=]+\s)((http(s)?)://.*)")
+    mirror_urls = []
     with open(result.path) as mirror_list_file:
         for mirror in mirror_list_file:
             match = re.match(url_pattern, mirror)
-            if not match:
-                continue
+            if match:
+                mirror_urls.append(match.group(2))
 
-            mirror_url = match.group(2)
-            try:
-                get_repomd_file(remote, mirror_url)
-                # just check if the metadata exists
-                return mirror_url
-            except Exception as exc:
-                log.warning(
-                    "Url '{}' from mirrorlist was tried and failed with error: {}".format(
-                        mirror_url, exc
-                    )
+    probes = max(settings.RPM_MIRRORLIST_PROBES, 1)
+    for start in range(0, len(mirror_urls), probes):
+        mirror_url = asyncio.get_event_loop().run_until_complete(
+            probe_mirrors(remote, mirror_urls[start : start + probes], repomd_results)
+        )
+        if mirror_url:
+            return mirror_url
+
+    return None
+
+
+async def probe_mirrors(remote, mirror_urls, repomd_results=None):
+    """Probe several mirrors concurrently and return the first to serve its repomd.xml.
+
+    Args:
+        remote (RpmRemote or UlnRemote): An RpmRemote or UlnRemote to download with.
+        mirror_urls (list): The URLs of the mirrors
+        repomd_results (dict): Downloaded repomd.xml files by URL
+
+    Returns:
+        str: The URL of the fastest working mirror, or None if none of them works
+    """
+
+    async def probe(mirror_url):
+        try:
+            await aget_repomd_file(remote, mirror_url, repomd_results)
+        except Exception as exc:
+            log.warning(
+                "Url '{}' from mirrorlist was tried and failed with error: {}".format(
+                    mirror_url, exc
                 )
-                continue
+            )
+            return None
+        # just check if the metadata exists
+        return mirror_url
+
+    futures = [asyncio.ensure_future(probe(mirror_url)) for mirror_url in mirror_urls]
+    try:
+        for future in asyncio.as_completed(futures):
+            mirror_url = await future
+            if mirror_url:
+                return mirror_url
+    finally:
+        # stop probing the slower mirrors
+        for future in futures:
+            future.cancel()
+        await asyncio.gather(*futures, return_exceptions=True)
 
     return None
 
 
-def fetch_remote_url(remote, custom_url=None):
-    """Fetch a single remote from which can be content synced."""
+def fetch_remote_url(remote, custom_url=None, repomd_results=None):
+    """Fetch a single remote from which can be content synced.
+
+    The repomd.xml of the remote is added to `repomd_results`, if given.
+    """
 
     def normalize_url(url_to_normalize):
         return url_to_normalize.rstrip("/") + "/"
@@ -272,7 +684,7 @@ def fetch_remote_url(remote, custom_url=None):
 
     try:
         normalized_remote_url = normalize_url(url)
-        get_repomd_file(remote, normalized_remote_url)
+        get_repomd_file(remote, normalized_remote_url, repomd_results)
         # just check if the metadata exists
         return normalized_remote_url
     except ClientResponseError as exc:
@@ -288,7 +700,7 @@ def fetch_remote_url(remote, custom_url=None):
         log.info(
             _("Attempting to resolve a true url from potential mirrolist url '{}'").format(url)
         )
-        remote_url = fetch_mirror(remote)
+        remote_url = fetch_mirror(remote, repomd_results)
         if remote_url:
             log.info(
                 _("Using url '{}' from mirrorlist in place of the provided url {}").format(
@@ -395,12 +807,17 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
     deferred_download = remote.policy != Remote.IMMEDIATE  # Interpret download policy
     skip_treeinfo = "treeinfo" in skip_types
 
-    def get_treeinfo_data(remote, remote_url):
-        """Get Treeinfo data from remote."""
-        treeinfo_serialized = {}
-        if skip_treeinfo:
-            return treeinfo_serialized
+    # The files downloaded while setting up the sync, by URL, so that each is only downloaded once
+    repomd_results = {}
+    treeinfo_results = {}
+    treeinfo_data_by_url = {}
 
+    async def download_treeinfo(remote, remote_url):
+        """Download the treeinfo file of a repository, if it has one."""
+        if remote_url in treeinfo_results:
+            return treeinfo_results[remote_url]
+
+        downloaded = None
         namespaces = [".treeinfo", "treeinfo"]
         for namespace in namespaces:
             treeinfo_url = urlpath_sanitize(remote_url, namespace)
@@ -410,16 +827,14 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
             )
 
             try:
-                result = downloader.fetch()
+                result = await downloader.run()
             except FileNotFoundError:
                 continue
 
-            treeinfo = PulpTreeInfo()
             with open(result.path, "r") as f:
-                treeinfo_str = f.read()
                 # some impolitely configured webservers return HTTP 200 with an HTML error page
                 # when a resource isn't found, instead of returning an HTTP 404 code
-                if treeinfo_str.startswith("<"):
+                if f.read(1) == "<":
                     # in the event that the response looks like HTML rather than an INI file,
                     # let's just pretend it returned 404
                     log.debug(
@@ -427,37 +842,67 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
                         " rather than treeinfo. Ignoring it."
                     )
                     continue
-                treeinfo.loads(treeinfo_str)
+
+            downloaded = (namespace, result)
+            break
+
+        treeinfo_results[remote_url] = downloaded
+        return downloaded
+
+    def get_treeinfo_data(remote, remote_url, store=True):
+        """Get Treeinfo data from remote."""
+        treeinfo_serialized = {}
+        if skip_treeinfo:
+            return treeinfo_serialized
+        if remote_url in treeinfo_data_by_url:
+            return treeinfo_data_by_url[remote_url]
+
+        downloaded = asyncio.get_event_loop().run_until_complete(
+            download_treeinfo(remote, remote_url)
+        )
+        if downloaded:
+            namespace, result = downloaded
+            treeinfo = PulpTreeInfo()
+            with open(result.path, "r") as f:
+                treeinfo.loads(f.read())
             sha256 = result.artifact_attributes["sha256"]
             treeinfo_data = TreeinfoData(treeinfo.parsed_sections())
 
             # get the data we need before changing the original
             treeinfo_serialized = treeinfo_data.to_dict(hash=sha256, filename=namespace)
 
-            # rewrite the treeinfo file such that the variant repository and package location
-            # is a relative subtree
-            treeinfo.rewrite_subrepo_paths(treeinfo_data)
+            if store:
+                # rewrite the treeinfo file such that the variant repository and package location
+                # is a relative subtree
+                treeinfo.rewrite_subrepo_paths(treeinfo_data)
 
-            # TODO: better way to do this?
-            main_variant = treeinfo.original_parser._sections.get("general", {}).get(
-                "variant", None
-            )
-            treeinfo_file = tempfile.NamedTemporaryFile(dir=".", delete=False)
-            treeinfo.dump(treeinfo_file.name, main_variant=main_variant)
-            store_metadata_for_mirroring(repository, treeinfo_file.name, namespace)
-            break
+                # TODO: better way to do this?
+                main_variant = treeinfo.original_parser._sections.get("general", {}).get(
+                    "variant", None
+                )
+                treeinfo_file = tempfile.NamedTemporaryFile(dir=".", delete=False)
+                treeinfo.dump(treeinfo_file.name, main_variant=main_variant)
+                mirroring_index.add_metadata_file(repository, treeinfo_file.name, namespace)
 
+        treeinfo_data_by_url[remote_url] = treeinfo_serialized
         return treeinfo_serialized
 
+    async def prefetch_metadata(urls):
+        """Download the repomd.xml and treeinfo files of several repositories concurrently."""
+        downloads = [aget_repomd_file(remote, url, repomd_results) for url in urls]
+        if not skip_treeinfo:
+            downloads.extend(download_treeinfo(remote, url) for url in urls)
+        # errors are raised again once the files are actually needed
+        await asyncio.gather(*downloads, return_exceptions=True)
+
     def get_sync_details(remote, url, sync_policy, repository):
         version = repository.latest_version()
-        with tempfile.TemporaryDirectory(dir="."):
-            result = get_repomd_file(remote, url)
-            repomd_path = result.path
-            repomd = cr.Repomd(repomd_path)
-            repomd_checksum = get_sha256(repomd_path)
-            treeinfo_file_data = get_treeinfo_data(remote, url)
-            treeinfo_checksum = treeinfo_file_data.get("hash", "")
+        result = get_repomd_file(remote, url, repomd_results)
+        repomd_path = result.path
+        repomd = cr.Repomd(repomd_path)
+        repomd_checksum = get_sha256(repomd_path)
+        treeinfo_file_data = get_treeinfo_data(remote, url, store=False)
+        treeinfo_checksum = treeinfo_file_data.get("hash", "")
 
         return {
             "url": remote.url,  # use the original remote url so that mirrorlists are optimizable
@@ -474,20 +919,18 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
     mirror_metadata = sync_policy == SYNC_POLICIES.MIRROR_COMPLETE
 
     repo_sync_config = {}
-    # this is the "directory" of the repo within the target repo location - for the primary
-    # repo, they are the same
-    PRIMARY_REPO = ""
 
     def is_subrepo(directory):
         return directory != PRIMARY_REPO
 
-    with tempfile.TemporaryDirectory(dir="."):
-        remote_url = fetch_remote_url(remote, url)
+    with tempfile.TemporaryDirectory(dir="."), MirroringIndex() as mirroring_index:
+        remote_url = fetch_remote_url(remote, url, repomd_results)
 
         # Find and set up to deal with any subtrees
         treeinfo = get_treeinfo_data(remote, remote_url)
         if treeinfo:
             treeinfo["repositories"] = {}
+            sub_repos = []
             for repodata in set(treeinfo["download"]["repodatas"]):
                 if repodata == DIST_TREE_MAIN_REPO_PATH:
                     treeinfo["repositories"].update({repodata: None})
@@ -500,7 +943,13 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
                 treeinfo["repositories"].update({directory: str(sub_repo.pk)})
                 path = f"{repodata}/"
                 new_url = urlpath_sanitize(remote_url, path)
+                sub_repos.append((directory, sub_repo, new_url))
+
+            asyncio.get_event_loop().run_until_complete(
+                prefetch_metadata([new_url for _directory, _sub_repo, new_url in sub_repos])
+            )
 
+            for directory, sub_repo, new_url in sub_repos:
                 try:
                     subrepo_sync_details = get_sync_details(remote, new_url, sync_policy, sub_repo)
                 except ClientResponseError as exc:
@@ -540,18 +989,8 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
         skipped_syncs = 0
         repo_sync_results = {}
 
-        # If some repos need to be synced and others do not, we go through them all
-        # items() returns in insertion-order - make sure PRIMARY is the LAST thing we process
-        # here, or autopublish will fail to find any subrepo-content.
-        for directory, repo_config in repo_sync_config.items():
+        def sync_repo(directory, repo_config):
             repo = repo_config["repo"]
-            # If metadata_mirroring is enabled we cannot skip any syncs, because the generated
-            # publication needs to contain exactly the same metadata at the same paths.
-            if not mirror_metadata and optimize and repo_config["should_skip"]:
-                skipped_syncs += 1
-                repo_sync_results[directory] = repo.latest_version()
-                continue
-
             stage = RpmFirstStage(
                 remote,
                 repo,
@@ -561,6 +1000,8 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
                 new_url=repo_config["url"],
                 treeinfo=(treeinfo if not is_subrepo(directory) else None),
                 namespace=directory,
+                repomd_result=repomd_results.get(get_repomd_url(repo_config["url"])),
+                mirroring_index=mirroring_index,
             )
 
             dv = RpmDeclarativeVersion(first_stage=stage, repository=repo, mirror=mirror)
@@ -570,35 +1011,55 @@ def synchronize(remote_pk, repository_pk, sync_policy, skip_types, optimize, url
             repo.last_sync_details = repo_config["sync_details"]
             repo.save()
 
-            repo_sync_results[directory] = repo_version
-
-    if skipped_syncs:
-        with ProgressReport(
-            message="Skipping Sync (no change from previous sync)", code="sync.was_skipped"
-        ) as pb:
-            pb.done = skipped_syncs
-            pb.total = len(repo_sync_config)
-
-    if mirror_metadata:
-        with RpmPublication.create(
-            repo_sync_results[PRIMARY_REPO], pass_through=False
-        ) as publication:
-            gpgcheck = repository.repo_config.get("gpgcheck", 0)
-            has_repomd_signature = (
-                "repodata/repomd.xml.asc" in metadata_files_for_mirroring[str(repository.pk)].keys()
-            )
-            repo_gpgcheck = has_repomd_signature and repository.repo_config.get("repo_gpgcheck", 0)
+            return repo_version
+
+        # If some repos need to be synced and others do not, we go through them all
+        repos_to_sync = {}
+        for directory, repo_config in repo_sync_config.items():
+            repo = repo_config["repo"]
+            # If metadata_mirroring is enabled we cannot skip any syncs, because the generated
+            # publication needs to contain exactly the same metadata at the same paths.
+            if not mirror_metadata and optimize and repo_config["should_skip"]:
+                skipped_syncs += 1
+                repo_sync_results[directory] = repo.latest_version()
+                continue
+            repos_to_sync[directory] = repo_config
+
+        repo_sync_results.update(
+            sync_repos(sync_repo, repos_to_sync, settings.RPM_SYNC_SUBREPO_WORKERS)
+        )
+
+        if skipped_syncs:
+            with ProgressReport(
+                message="Skipping Sync (no change from previous sync)", code="sync.was_skipped"
+            ) as pb:
+                pb.done = skipped_syncs
+                pb.total = len(repo_sync_config)
+
+        if mirror_metadata:
+            with RpmPublication.create(
+                repo_sync_results[PRIMARY_REPO], pass_through=False
+            ) as publication:
+                gpgcheck = repository.repo_config.get("gpgcheck", 0)
+                has_repomd_signature = "repodata/repomd.xml.asc" in mirroring_index.metadata_files(
+                    repository
+                )
+                repo_gpgcheck = has_repomd_signature and repository.repo_config.get(
+                    "repo_gpgcheck", 0
+                )
 
-            publication.checksum_type = CHECKSUM_TYPES.UNKNOWN
-            publication.package_checksum_type = CHECKSUM_TYPES.UNKNOWN
-            publication.metadata_checksum_type = CHECKSUM_TYPES.UNKNOWN
-            publication.repo_config = {
-                "repo_gpgcheck": int(repo_gpgcheck),
-                "gpgcheck": int(gpgcheck),
-            }
+                publication.checksum_type = CHECKSUM_TYPES.UNKNOWN
+                publication.package_checksum_type = CHECKSUM_TYPES.UNKNOWN
+                publication.metadata_checksum_type = CHECKSUM_TYPES.UNKNOWN
+                publication.repo_config = {
+                    "repo_gpgcheck": int(repo_gpgcheck),
+                    "gpgcheck": int(gpgcheck),
+                }
 
-            for path, repo_version in repo_sync_results.items():
-                add_metadata_to_publication(publication, repo_version, prefix=path)
+                for path, repo_version in repo_sync_results.items():
+                    add_metadata_to_publication(
+                        publication, repo_version, mirroring_index, prefix=path
+                    )
 
     return repo_sync_results[PRIMARY_REPO]
 
@@ -668,6 +1129,8 @@ class RpmFirstStage(Stage):
         new_url=None,
         treeinfo=None,
         namespace="",
+        repomd_result=None,
+        mirroring_index=None,
     ):
         """
         The first stage of a pulp_rpm sync pipeline.
@@ -685,6 +1148,9 @@ class RpmFirstStage(Stage):
             new_url(str): URL to replace remote url
             treeinfo(dict): Treeinfo data
             namespace(str): Path where this repo is located relative to some parent repo.
+            repomd_result(DownloadResult): repomd.xml, if it was already downloaded
+            mirroring_index(MirroringIndex): Where to record the metadata files and packages
+                for mirror-publishing after the sync
 
         """
         super().__init__()
@@ -700,12 +1166,15 @@ class RpmFirstStage(Stage):
         self.namespace_depth = 0 if not namespace else len(namespace.strip("/").split("/"))
 
         self.treeinfo = treeinfo
+        self.repomd_result = repomd_result
+        self.mirroring_index = mirroring_index
         self.skip_types = [] if skip_types is None else skip_types
 
         self.remote_url = new_url or self.remote.url
+        self.compact_packages = settings.RPM_SYNC_COMPACT_PACKAGES
 
-        self.nevra_to_module = defaultdict(dict)
-        self.pkgname_to_groups = defaultdict(list)
+        # NEVRAs of the packages listed by the modulemds of the repository
+        self.modular_nevras = set()
 
     def is_illegal_relative_path(self, path):
         """Whether a relative path points outside the repository being synced."""
@@ -720,14 +1189,16 @@ class RpmFirstStage(Stage):
             updateinfo_xml_path: a path to a downloaded updateinfo.xml
 
         Returns:
-            :obj:`list` of :obj:`createrepo_c.UpdateRecord`: parsed update records
+            iterator of :obj:`createrepo_c.UpdateRecord`: parsed update records, which are only
+                parsed a batch at a time while iterating
 
         """
-        uinfo = cr.UpdateInfo()
+        return iter_updateinfo(updateinfo_xml_path)
 
-        # TODO: handle parsing errors/warnings, warningcb callback can be used
-        cr.xml_parse_updateinfo(updateinfo_xml_path, uinfo)
-        return uinfo.updates
+    def store_metadata_for_mirroring(self, md_path, relative_path):
+        """Record a downloaded metadata file for mirror-publishing after the sync."""
+        if self.mirroring_index is not None:
+            self.mirroring_index.add_metadata_file(self.repository, md_path, relative_path)
 
     async def run(self):
         """Build `DeclarativeContent` from the repodata."""
@@ -736,12 +1207,14 @@ class RpmFirstStage(Stage):
                 message="Downloading Metadata Files", code="sync.downloading.metadata"
             )
             async with ProgressReport(**progress_data) as metadata_pb:
-                # download repomd.xml
-                downloader = self.remote.get_downloader(
-                    url=urlpath_sanitize(self.remote_url, "repodata/repomd.xml")
-                )
-                result = await downloader.run()
-                store_metadata_for_mirroring(self.repository, result.path, "repodata/repomd.xml")
+                # download repomd.xml, unless it was already downloaded while setting up the sync
+                result = self.repomd_result
+                if result is None:
+                    downloader = self.remote.get_downloader(
+                        url=urlpath_sanitize(self.remote_url, "repodata/repomd.xml")
+                    )
+                    result = await downloader.run()
+                self.store_metadata_for_mirroring(result.path, "repodata/repomd.xml")
                 await metadata_pb.aincrement()
 
                 repomd_path = result.path
@@ -769,8 +1242,28 @@ class RpmFirstStage(Stage):
                     | set(MODULAR_REPODATA)
                 )
 
-                async def run_repomdrecord_download(name, location_href, downloader):
+                metadata_cache = get_metadata_cache()
+
+                async def run_repomdrecord_download(record, downloader):
+                    name, location_href = record.type, record.location_href
+                    cache_key = (record.type, record.checksum_type, record.checksum)
+                    if metadata_cache:
+                        filename = os.path.basename(location_href)
+                        path = metadata_cache.get(*cache_key, filename)
+                        if path:
+                            result = DownloadResult(
+                                url=downloader.url,
+                                artifact_attributes={
+                                    "size": record.size,
+                                    record.checksum_type: record.checksum,
+                                },
+                                path=path,
+                                headers={},
+                            )
+                            return name, location_href, result
                     result = await downloader.run()
+                    if metadata_cache:
+                        metadata_cache.add(*cache_key, result.path)
                     return name, location_href, result
 
                 for record in repomd.records:
@@ -799,13 +1292,13 @@ class RpmFirstStage(Stage):
                         expected_digests={record_checksum_type: record.checksum},
                     )
                     repomd_downloaders[record.type] = asyncio.ensure_future(
-                        run_repomdrecord_download(record.type, record.location_href, downloader)
+                        run_repomdrecord_download(record, downloader)
                     )
 
                 try:
                     for future in asyncio.as_completed(list(repomd_downloaders.values())):
                         name, location_href, result = await future
-                        store_metadata_for_mirroring(self.repository, result.path, location_href)
+                        self.store_metadata_for_mirroring(result.path, location_href)
                         repomd_files[name] = result
                         await metadata_pb.aincrement()
                 except ClientResponseError as exc:
@@ -822,7 +1315,7 @@ class RpmFirstStage(Stage):
                                 silence_errors_for_response_status_codes={403, 404},
                             )
                             result = await downloader.run()
-                            store_metadata_for_mirroring(self.repository, result.path, file_href)
+                            self.store_metadata_for_mirroring(result.path, file_href)
                             await metadata_pb.aincrement()
                         except (ClientResponseError, FileNotFoundError):
                             pass
@@ -834,9 +1327,7 @@ class RpmFirstStage(Stage):
                             silence_errors_for_response_status_codes={403, 404},
                         )
                         result = await downloader.run()
-                        store_metadata_for_mirroring(
-                            self.repository, result.path, "extra_files.json"
-                        )
+                        self.store_metadata_for_mirroring(result.path, "extra_files.json")
                         await metadata_pb.aincrement()
                     except (ClientResponseError, FileNotFoundError):
                         pass
@@ -856,9 +1347,7 @@ class RpmFirstStage(Stage):
                                         expected_digests=filtered_checksums,
                                     )
                                     result = await downloader.run()
-                                    store_metadata_for_mirroring(
-                                        self.repository, result.path, data["file"]
-                                    )
+                                    self.store_metadata_for_mirroring(result.path, data["file"])
                                     await metadata_pb.aincrement()
                         except ClientResponseError as exc:
                             raise HTTPNotFound(
@@ -1013,13 +1502,11 @@ class RpmFirstStage(Stage):
         for modulemd in modulemd_all:
             modulemd_content = Modulemd(**modulemd)
             dc = DeclarativeContent(content=modulemd_content)
-            dc.extra_data = defaultdict(list)
             modulemd_dcs.append(dc)
 
             # dc.content.artifacts are Modulemd artifacts
             if dc.content.artifacts:
-                for artifact in dc.content.artifacts:
-                    self.nevra_to_module.setdefault(artifact, set()).add(dc)
+                self.modular_nevras.update(dc.content.artifacts)
 
         # Parsing module-defaults happens all at one time, and from here on no useful
         # work happens. So just report that it finished this stage.
@@ -1137,10 +1624,6 @@ class RpmFirstStage(Stage):
                 dc = DeclarativeContent(content=packagegroup)
                 dc.extra_data = defaultdict(list)
 
-                if packagegroup.packages:
-                    for package in packagegroup.packages:
-                        self.pkgname_to_groups[package["name"]].append(dc)
-
                 if dc.content.id in group_to_categories.keys():
                     for dc_category in group_to_categories[dc.content.id]:
                         dc.extra_data["category_relations"].append(dc_category)
@@ -1171,11 +1654,26 @@ class RpmFirstStage(Stage):
 
     async def parse_packages(self, primary_xml, filelists_xml, other_xml, modulemd_list=None):
         """Parse packages from the remote repository."""
-        parser = cr.RepositoryReader.from_metadata_files(
-            primary_xml.path,
-            filelists_xml.path if filelists_xml else None,
-            other_xml.path if other_xml else None,
-        )
+        # primary.xml is parsed twice, first on its own to decide which packages to skip and then
+        # along with filelists.xml and other.xml, so it's decompressed only once up front.
+        with tempfile.TemporaryDirectory(dir=".") as tf:
+            primary_xml_path = os.path.join(tf, "primary.xml")
+            cr.decompress_file(primary_xml.path, primary_xml_path, cr.AUTO_DETECT_COMPRESSION)
+            await self.parse_decompressed_packages(
+                primary_xml_path, filelists_xml, other_xml, modulemd_list
+            )
+
+    async def parse_decompressed_packages(
+        self, primary_xml_path, filelists_xml, other_xml, modulemd_list
+    ):
+        """Parse packages from the remote repository, given the decompressed primary.xml."""
+        # Packages which are already present in the latest repository version only need to be
+        # referred to by their natural key, so parsing their filelists.xml and other.xml entries
+        # and building complete Package objects for them can be skipped.
+        existing_package_keys = await sync_to_async(get_existing_package_keys)(self.repository)
+        existing_packages = []
+        existing_pkgids = set()
+        parsed_pkgids = set()
 
         # skip SRPM if defined
         skip_srpms = "srpm" in self.skip_types
@@ -1244,6 +1742,13 @@ class RpmFirstStage(Stage):
             nevras.add(pkg_nevra)
             checksums.add(pkg.pkgId)
 
+            reference = Package.createrepo_to_reference_dict(pkg)
+            if tuple(reference[field] for field in PACKAGE_KEY_FIELDS) in existing_package_keys:
+                existing_packages.append((reference, pkg.location_base, pkg_nevra, pkg.time_build))
+                existing_pkgids.add(pkg.pkgId)
+            else:
+                parsed_pkgids.add(pkg.pkgId)
+
             # Check that all packages are within the root of the repo (if in mirror_complete mode).
             # We can't allow mirroring metadata that references packages outside of the repo
             # e.g. "../../RPMS/foobar.rpm"
@@ -1273,7 +1778,7 @@ class RpmFirstStage(Stage):
 
         # Ew, callback-based API, gross. The streaming API doesn't support optionally
         # specifying particular files yet so we have to use the old way.
-        cr.xml_parse_primary(primary_xml.path, pkgcb=verification_and_skip_callback, do_files=False)
+        cr.xml_parse_primary(primary_xml_path, pkgcb=verification_and_skip_callback, do_files=False)
 
         # Go through the package lists, sort them descending by EVR, ignore the first N and then
         # add the remaining ones to the skip list.
@@ -1303,13 +1808,43 @@ class RpmFirstStage(Stage):
         async with ProgressReport(**progress_data) as skipped_pb:
             await skipped_pb.asave()
 
+        # A pkgid listed with several different NEVRAs is parsed completely for all of them
+        existing_pkgids -= parsed_pkgids
+        parsed_pkgids.clear()
+
+        def skip_existing_callback(pkgId, name, arch):
+            # returning None skips the package in all metadata files
+            return None if pkgId in existing_pkgids else cr.Package()
+
         progress_data = {
             "message": "Parsed Packages",
             "code": "sync.parsing.packages",
             "total": total_packages,
         }
-        async with ProgressReport(**progress_data) as packages_pb:
-            for pkg in parser.iter_packages():
+        async with ProgressReport(**progress_data) as packages_pb, ProgressCounter(
+            packages_pb
+        ) as packages_counter:
+            for reference, location_base, pkg_nevra, time_build in existing_packages:
+                if reference[PULP_PACKAGE_ATTRS.PKGID] not in existing_pkgids:
+                    continue
+                # Skip over packages (retention feature, skip_types feature)
+                if package_skip_nevras and pkg_nevra in package_skip_nevras:
+                    continue
+                elif time_build != latest_build_time_by_nevra[pkg_nevra]:
+                    continue
+                await packages_counter.aincrement()
+                # QueryExistingContents replaces the reference with the existing package
+                await self.put_package(Package(**reference), location_base)
+
+            existing_packages.clear()
+
+            packages = cr.PackageIterator(
+                primary_path=primary_xml_path,
+                filelists_path=filelists_xml.path if filelists_xml else None,
+                other_path=other_xml.path if other_xml else None,
+                newpkgcb=skip_existing_callback,
+            )
+            for pkg in packages:
                 pkg_nevra = pkg.nevra()
                 # Skip over packages (retention feature, skip_types feature)
                 if package_skip_nevras and pkg_nevra in package_skip_nevras:
@@ -1321,130 +1856,192 @@ class RpmFirstStage(Stage):
                 # Implicit: There can be multiple package entries that are completely identical
                 # (same NEVRA, same build time, same checksum / pkgid) and the same or different
                 # location_href. We're not explicitly handling this, the pipeline will deduplicate.
-                package = Package(**Package.createrepo_to_dict(pkg))
-                base_url = pkg.location_base or self.remote_url
-                url = urlpath_sanitize(base_url, package.location_href)
+                package, packed_fields = self.package_from_createrepo(pkg)
+                location_base = pkg.location_base
                 del pkg  # delete it as soon as we're done with it
 
-                store_package_for_mirroring(self.repository, package.pkgId, package.location_href)
-                artifact = Artifact(size=package.size_package)
-                checksum_type = getattr(CHECKSUM_TYPES, package.checksum_type.upper())
-                setattr(artifact, checksum_type, package.pkgId)
-                filename = os.path.basename(package.location_href)
-                da = DeclarativeArtifact(
-                    artifact=artifact,
-                    url=url,
-                    relative_path=filename,
-                    remote=self.remote,
-                    deferred_download=self.deferred_download,
-                )
-                dc = DeclarativeContent(content=package, d_artifacts=[da])
-                dc.extra_data = defaultdict(list)
+                await packages_counter.aincrement()
+                await self.put_package(package, location_base, packed_fields)
 
-                # find if a package relates to a modulemd
-                if dc.content.nevra in self.nevra_to_module.keys():
-                    dc.content.is_modular = True
-                    for dc_modulemd in self.nevra_to_module[dc.content.nevra]:
-                        dc.extra_data["modulemd_relation"].append(dc_modulemd)
-                        dc_modulemd.extra_data["package_relation"].append(dc)
+    def package_from_createrepo(self, pkg):
+        """
+        Create a Package from a createrepo_c package.
 
-                if dc.content.name in self.pkgname_to_groups.keys():
-                    for dc_group in self.pkgname_to_groups[dc.content.name]:
-                        dc.extra_data["group_relations"].append(dc_group)
-                        dc_group.extra_data["related_packages"].append(dc)
+        If RPM_SYNC_COMPACT_PACKAGES is enabled, the bulky fields of the package are packed
+        instead and set to None, so that saving the package fails unless they are unpacked.
 
-                await packages_pb.aincrement()  # TODO: don't do this for every individual package
-                await self.put(dc)
+        Args:
+            pkg (createrepo_c.Package): The parsed package
+
+        Returns:
+            tuple: the unsaved Package and its PackedPackageFields, or None if not packed
+
+        """
+        package_dict = Package.createrepo_to_dict(pkg)
+        if not self.compact_packages:
+            return Package(**package_dict), None
+
+        packed_fields = PackedPackageFields(
+            {name: package_dict[name] for name in PACKED_PACKAGE_FIELDS}
+        )
+        package_dict.update(dict.fromkeys(PACKED_PACKAGE_FIELDS))
+        return Package(**package_dict), packed_fields
+
+    async def put_package(self, package, location_base, packed_fields=None):
+        """Create a DeclarativeContent for a package and pass it down the pipeline."""
+        base_url = location_base or self.remote_url
+        url = urlpath_sanitize(base_url, package.location_href)
+
+        if self.mirror_metadata and self.mirroring_index is not None:
+            self.mirroring_index.add_package(self.repository, package.pkgId, package.location_href)
+        artifact = Artifact(size=package.size_package)
+        checksum_type = getattr(CHECKSUM_TYPES, package.checksum_type.upper())
+        setattr(artifact, checksum_type, package.pkgId)
+        filename = os.path.basename(package.location_href)
+        da = DeclarativeArtifact(
+            artifact=artifact,
+            url=url,
+            relative_path=filename,
+            remote=self.remote,
+            deferred_download=self.deferred_download,
+        )
+        dc = DeclarativeContent(content=package, d_artifacts=[da])
+
+        # find if a package relates to a modulemd, the relations are created by
+        # RpmInterrelateContent once both are saved
+        if package.nevra in self.modular_nevras:
+            package.is_modular = True
+            dc.extra_data["modular"] = True
+
+        # unpacked by RpmContentSaver if the package is new
+        if packed_fields is not None:
+            dc.extra_data["packed_fields"] = packed_fields
+
+        await self.put(dc)
 
     async def parse_advisories(self, result):
         """Parse advisories from the remote repository."""
         updateinfo_xml_path = result.path
 
-        updates = await RpmFirstStage.parse_updateinfo(updateinfo_xml_path)
         progress_data = {
             "message": "Parsed Advisories",
             "code": "sync.parsing.advisories",
-            "total": len(updates),
         }
         async with ProgressReport(**progress_data) as advisories_pb:
-            for update in updates:
-                update_record = UpdateRecord(**UpdateRecord.createrepo_to_dict(update))
-                update_record.pulp_domain = get_domain()
-                update_record.digest = hash_update_record(update)
-                future_relations = {"collections": defaultdict(list), "references": []}
-
-                for collection in update.collections:
-                    coll_dict = UpdateCollection.createrepo_to_dict(collection)
-                    if coll_dict["name"] is None:
-                        coll_dict["name"] = "collection-autofill-" + uuid.uuid4().hex[:12]
-                    coll = UpdateCollection(**coll_dict)
-
-                    for package in collection.packages:
-                        pkg_dict = UpdateCollectionPackage.createrepo_to_dict(package)
-                        pkg = UpdateCollectionPackage(**pkg_dict)
-                        future_relations["collections"][coll].append(pkg)
-
-                for reference in update.references:
-                    reference_dict = UpdateReference.createrepo_to_dict(reference)
-                    ref = UpdateReference(**reference_dict)
-                    future_relations["references"].append(ref)
-
-                await advisories_pb.aincrement()
-                dc = DeclarativeContent(content=update_record)
-                dc.extra_data = future_relations
-                await self.put(dc)
+            async with ProgressCounter(advisories_pb) as advisories_counter:
+                for updates in iter_updateinfo_batches(updateinfo_xml_path):
+                    digests = [hash_update_record(update) for update in updates]
+                    # Advisories which already exist are passed on as they are, without building
+                    # their collections and references again, unless some of them are missing.
+                    existing_update_records = await sync_to_async(get_existing_update_records)(
+                        digests
+                    )
+
+                    for update, digest in zip(updates, digests):
+                        update_record = existing_update_records.get(digest)
+                        if update_record and has_relations(update_record, update):
+                            dc = DeclarativeContent(content=update_record)
+                        else:
+                            dc = self.update_record_to_declarative_content(update, digest)
+                        await advisories_counter.aincrement()
+                        await self.put(dc)
+            advisories_pb.total = advisories_pb.done
+
+    @staticmethod
+    def update_record_to_declarative_content(update, digest):
+        """Create a DeclarativeContent for a new advisory and its future relations."""
+        update_record = UpdateRecord(**UpdateRecord.createrepo_to_dict(update))
+        update_record.pulp_domain = get_domain()
+        update_record.digest = digest
+        future_relations = {"collections": defaultdict(list), "references": []}
+
+        for collection in update.collections:
+            coll_dict = UpdateCollection.createrepo_to_dict(collection)
+            if coll_dict["name"] is None:
+                coll_dict["name"] = "collection-autofill-" + uuid.uuid4().hex[:12]
+            coll = UpdateCollection(**coll_dict)
+
+            for package in collection.packages:
+                pkg_dict = UpdateCollectionPackage.createrepo_to_dict(package)
+                pkg = UpdateCollectionPackage(**pkg_dict)
+                future_relations["collections"][coll].append(pkg)
+
+        for reference in update.references:
+            reference_dict = UpdateReference.createrepo_to_dict(reference)
+            ref = UpdateReference(**reference_dict)
+            future_relations["references"].append(ref)
+
+        dc = DeclarativeContent(content=update_record)
+        dc.extra_data = future_relations
+        return dc
 
 
 class RpmInterrelateContent(Stage):
     """
-    A stage that creates relationships between Packages and other related types.
+    A stage that creates relationships between Packages and Modulemds.
 
-    This stage creates relationships Packages and Modulemd, PackageGroup, PackageCatagory and
-    PackageEnvironment models.
+    Only the NEVRAs and primary keys of the saved modular packages and modulemds are recorded
+    while the content passes through, so the DeclarativeContents aren't kept alive until the
+    modulemds come through at the end of the sync. The relations are then created with a single
+    set-based insert which joins both on the NEVRA.
     """
 
     async def run(self):
         """
         Create all the relationships.
         """
+        package_nevras = []
+        package_pks = []
+        modulemd_nevras = []
+        modulemd_pks = []
+
         async for batch in self.batches():
+            for d_content in batch:
+                if d_content is None:
+                    continue
 
-            def process_batch():
-                with transaction.atomic():
-                    ModulemdPackages = Modulemd.packages.through
+                if isinstance(d_content.content, Modulemd):
+                    for nevra in d_content.content.artifacts or []:
+                        modulemd_nevras.append(nevra)
+                        modulemd_pks.append(d_content.content.pk)
 
-                    modulemd_pkgs_to_save = []
+                elif isinstance(d_content.content, Package) and d_content.extra_data.get(
+                    "modular"
+                ):
+                    package_nevras.append(d_content.content.nevra)
+                    package_pks.append(d_content.content.pk)
 
-                    for d_content in batch:
-                        if d_content is None:
-                            continue
+                await self.put(d_content)
 
-                        if isinstance(d_content.content, Modulemd):
-                            for pkg in d_content.extra_data["package_relation"]:
-                                if not pkg.content._state.adding:
-                                    module_package = ModulemdPackages(
-                                        package_id=pkg.content.pk,
-                                        modulemd_id=d_content.content.pk,
-                                    )
-                                    modulemd_pkgs_to_save.append(module_package)
-
-                        elif isinstance(d_content.content, Package):
-                            for modulemd in d_content.extra_data["modulemd_relation"]:
-                                if not modulemd.content._state.adding:
-                                    module_package = ModulemdPackages(
-                                        package_id=d_content.content.pk,
-                                        modulemd_id=modulemd.content.pk,
-                                    )
-                                    modulemd_pkgs_to_save.append(module_package)
+        if package_pks and modulemd_pks:
+            await sync_to_async(create_modulemd_packages)(
+                modulemd_nevras, modulemd_pks, package_nevras, package_pks
+            )
 
-                    if modulemd_pkgs_to_save:
-                        ModulemdPackages.objects.bulk_create(
-                            modulemd_pkgs_to_save, ignore_conflicts=True
-                        )
 
-            await sync_to_async(process_batch)()
-            for declarative_content in batch:
-                await self.put(declarative_content)
+def create_modulemd_packages(modulemd_nevras, modulemd_pks, package_nevras, package_pks):
+    """
+    Relate modulemds to the packages with the NEVRAs they list.
+
+    Args:
+        modulemd_nevras (list): The NEVRAs listed by the modulemds
+        modulemd_pks (list): The primary keys of the modulemds, one for each NEVRA
+        package_nevras (list): The NEVRAs of the packages
+        package_pks (list): The primary keys of the packages, one for each NEVRA
+
+    """
+    ModulemdPackages = Modulemd.packages.through
+    quote_name = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote_name(ModulemdPackages._meta.db_table)} "
+            "(modulemd_id, package_id) "
+            "SELECT modulemds.pk, packages.pk "
+            "FROM unnest(%s::text[], %s::uuid[]) AS modulemds (nevra, pk) "
+            "JOIN unnest(%s::text[], %s::uuid[]) AS packages (nevra, pk) USING (nevra) "
+            "ON CONFLICT DO NOTHING",
+            [modulemd_nevras, modulemd_pks, package_nevras, package_pks],
+        )
 
 
 class RpmContentSaver(ContentSaver):
@@ -1455,17 +2052,79 @@ class RpmContentSaver(ContentSaver):
     the UpdateRecord content unit.
     """
 
+    def _pre_save(self, batch):
+        """
+        Unpack the packed fields of new packages and insert them with COPY, if enabled.
+
+        The packed fields of packages which already exist are dropped. If RPM_SYNC_COPY_INSERT is
+        enabled, the new packages of the batch are inserted with COPY. The inserted packages and
+        their ContentArtifacts are saved here, so ContentSaver treats them as existing content.
+        Their DeclarativeArtifacts are set aside until `_post_save`, so that ContentSaver doesn't
+        look up the ContentArtifacts which were just created to update their artifacts. Packages
+        which conflict with existing ones are left unsaved for ContentSaver to resolve.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+
+        """
+        for declarative_content in batch:
+            packed_fields = declarative_content.extra_data.pop("packed_fields", None)
+            if packed_fields is not None and declarative_content.content._state.adding:
+                packed_fields.unpack_into(declarative_content.content)
+
+        if not copy_insert_enabled():
+            return
+
+        new_packages = [
+            declarative_content
+            for declarative_content in batch
+            if type(declarative_content.content) is Package
+            and declarative_content.content._state.adding
+        ]
+        inserted_pks = {
+            package.pk
+            for package in copy_insert_content(
+                Package, [declarative_content.content for declarative_content in new_packages]
+            )
+        }
+
+        content_artifacts = []
+        for declarative_content in new_packages:
+            if declarative_content.content.pk not in inserted_pks:
+                continue
+            for d_artifact in declarative_content.d_artifacts:
+                content_artifacts.append(
+                    ContentArtifact(
+                        content=declarative_content.content,
+                        # None for on-demand synced artifacts
+                        artifact=None if d_artifact.artifact._state.adding else d_artifact.artifact,
+                        relative_path=d_artifact.relative_path,
+                    )
+                )
+            declarative_content.extra_data["copy_inserted_d_artifacts"] = (
+                declarative_content.d_artifacts
+            )
+            declarative_content.d_artifacts = []
+        content_artifacts.sort(key=ContentArtifact.sort_key)
+        ContentArtifact.objects.bulk_get_or_create(content_artifacts)
+
     def _post_save(self, batch):
         """
         Save a batch of UpdateCollection, UpdateCollectionPackage, UpdateReference objects.
 
         When it has a treeinfo file, save a batch of Addon, Checksum, Image, Variant objects.
+        The DeclarativeArtifacts of packages inserted by `_pre_save` are restored.
 
         Args:
             batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
                 :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
 
         """
+        for declarative_content in batch:
+            d_artifacts = declarative_content.extra_data.pop("copy_inserted_d_artifacts", None)
+            if d_artifacts is not None:
+                declarative_content.d_artifacts = d_artifacts
 
         def _handle_distribution_tree(declarative_content):
             distribution_tree = declarative_content.content
@@ -1520,6 +2179,28 @@ class RpmContentSaver(ContentSaver):
         update_collection_packages_to_save = []
         seen_updaterecords = []
 
+        # existing content which was retrieved from the db at earlier stages usually already has
+        # its relations, look them all up at once
+        update_record_pks = [
+            declarative_content.content.pk
+            for declarative_content in batch
+            if declarative_content is not None
+            and isinstance(declarative_content.content, UpdateRecord)
+        ]
+        update_records_with_collections = set()
+        update_records_with_references = set()
+        if update_record_pks:
+            update_records_with_collections.update(
+                UpdateCollection.objects.filter(update_record__in=update_record_pks).values_list(
+                    "update_record", flat=True
+                )
+            )
+            update_records_with_references.update(
+                UpdateReference.objects.filter(update_record__in=update_record_pks).values_list(
+                    "update_record", flat=True
+                )
+            )
+
         for declarative_content in batch:
             if declarative_content is None:
                 continue
@@ -1530,10 +2211,9 @@ class RpmContentSaver(ContentSaver):
             elif isinstance(declarative_content.content, UpdateRecord):
                 update_record = declarative_content.content
 
-                relations_exist = (
-                    update_record.collections.count() or update_record.references.count()
-                )
-                if relations_exist:
+                has_collections = update_record.pk in update_records_with_collections
+                has_references = update_record.pk in update_records_with_references
+                if has_collections and has_references:
                     # existing content which was retrieved from the db at earlier stages
                     continue
 
@@ -1549,6 +2229,12 @@ class RpmContentSaver(ContentSaver):
                 update_collections = future_relations.get("collections", {})
                 update_references = future_relations.get("references", [])
 
+                # only the missing relations of existing content are saved
+                if has_collections:
+                    update_collections = {}
+                if has_references:
+                    update_references = []
+
                 for update_collection, packages in update_collections.items():
                     update_collection.update_record = update_record
                     update_collection_to_save.append(update_collection)
@@ -1562,12 +2248,10 @@ class RpmContentSaver(ContentSaver):
                     update_references_to_save.append(update_reference)
 
         if update_collection_to_save:
-            UpdateCollection.objects.bulk_create(update_collection_to_save, ignore_conflicts=True)
+            bulk_insert(UpdateCollection, update_collection_to_save)
 
         if update_collection_packages_to_save:
-            UpdateCollectionPackage.objects.bulk_create(
-                update_collection_packages_to_save, ignore_conflicts=True
-            )
+            bulk_insert(UpdateCollectionPackage, update_collection_packages_to_save)
 
         if update_references_to_save:
-            UpdateReference.objects.bulk_create(update_references_to_save, ignore_conflicts=True)
+            bulk_insert(UpdateReference, update_references_to_save)
@@ -1,5 +1,10 @@
+import gzip
+import hashlib
 import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 from django.test import TestCase
 
@@ -7,6 +12,14 @@ from django.test import TestCase
 # If we can't import pulp_rpm.app.advisory, set a flag so we know to skip this test on the
 # platform we're running on at the moment.
 try:
+    import createrepo_c as cr
+
+    from pulp_rpm.app import advisory
+    from pulp_rpm.app.advisory import (
+        hash_update_record,
+        iter_updateinfo,
+        iter_updateinfo_batches,
+    )
     from pulp_rpm.app.advisory import resolve_advisory_conflict
     from pulp_rpm.app.exceptions import AdvisoryConflict
     from pulp_rpm.app.serializers.advisory import UpdateRecordSerializer
@@ -460,3 +473,124 @@ class TestAdvisoryConflicts(TestCase):
         finally:
             existing.delete()
             incoming.delete()
+
+
+@unittest.skipIf(no_createrepo, "createrepo_c is not available")
+class TestIterUpdateinfo(unittest.TestCase):
+    """Test parsing updateinfo.xml a batch at a time."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def write_updateinfo(self, count):
+        """Write an updateinfo.xml.gz with some update records."""
+        uinfo = cr.UpdateInfo()
+        for i in range(count):
+            update = cr.UpdateRecord()
+            update.id = f"TEST-{i}"
+            update.title = "</update> & <updates>"
+            update.description = "x" * 100
+            collection = cr.UpdateCollection()
+            collection.name = "collection"
+            package = cr.UpdateCollectionPackage()
+            package.name = f"package-{i}"
+            package.filename = f"package-{i}.rpm"
+            collection.append(package)
+            update.append_collection(collection)
+            uinfo.append(update)
+        path = os.path.join(self.tmp_dir.name, "updateinfo.xml.gz")
+        with gzip.open(path, "wt") as f:
+            f.write(uinfo.xml_dump())
+        return path
+
+    def assert_same_updates(self, path):
+        uinfo = cr.UpdateInfo()
+        cr.xml_parse_updateinfo(path, uinfo)
+        expected = [hash_update_record(update) for update in uinfo.updates]
+        updates = [hash_update_record(update) for update in iter_updateinfo(path, batch_size=3)]
+        self.assertEqual(updates, expected)
+        return updates
+
+    def test_same_as_whole_file(self):
+        """The update records are identical to the ones parsed from the whole file."""
+        path = self.write_updateinfo(10)
+        # split the end tags between reads
+        with mock.patch.object(advisory, "UPDATEINFO_READ_SIZE", 7):
+            self.assertEqual(len(self.assert_same_updates(path)), 10)
+
+    def test_empty(self):
+        """An empty updateinfo.xml has no update records."""
+        path = self.write_updateinfo(0)
+        self.assertEqual(self.assert_same_updates(path), [])
+
+    def write_xml(self, xml):
+        """Write an updateinfo.xml.gz with the given XML."""
+        path = os.path.join(self.tmp_dir.name, "updateinfo.xml.gz")
+        with gzip.open(path, "wt") as f:
+            f.write(xml)
+        return path
+
+    def test_end_tag_with_whitespace(self):
+        """End tags with whitespace before the ">" end update records, too."""
+        path = self.write_updateinfo(10)
+        with gzip.open(path, "rt") as f:
+            xml = f.read()
+        path = self.write_xml(xml.replace("</update>", "</update \n>"))
+        with mock.patch.object(advisory, "UPDATEINFO_READ_SIZE", 7):
+            self.assertEqual(len(self.assert_same_updates(path)), 10)
+
+    def test_cdata_and_comments(self):
+        """Files with unescaped </update> tags in CDATA sections or comments aren't split."""
+        update = (
+            '<update from="test" status="final" type="bugfix" version="1">'
+            "<id>TEST-{}</id><title>Title</title>{}</update>"
+        )
+        path = self.write_xml(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<updates>\n'
+            + update.format(1, "<description><![CDATA[<b></update></b>]]></description>")
+            + "<!-- </update> -->"
+            + update.format(2, "<description>plain</description>")
+            + update.format(3, "")
+            + "\n</updates>\n"
+        )
+
+        updates = list(iter_updateinfo(path, batch_size=1))
+
+        self.assertEqual([update.id for update in updates], ["TEST-1", "TEST-2", "TEST-3"])
+        self.assertEqual(updates[0].description, "<b></update></b>")
+        self.assertEqual(updates[1].description, "plain")
+        self.assertEqual(len(self.assert_same_updates(path)), 3)
+
+    def test_batches(self):
+        """The update records are parsed in batches of the given size."""
+        path = self.write_updateinfo(10)
+        batches = list(iter_updateinfo_batches(path, batch_size=3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+        self.assertEqual([update.id for update in batches[3]], ["TEST-9"])
+
+
+@unittest.skipIf(no_createrepo, "createrepo_c is not available")
+class TestHashUpdateRecord(unittest.TestCase):
+    """Test the digest of update records."""
+
+    def test_digest_of_whole_document(self):
+        """The digest is the one of an updateinfo.xml holding just the update record."""
+        update = cr.UpdateRecord()
+        update.id = "TEST-1"
+        update.title = "Title & <more>"
+        collection = cr.UpdateCollection()
+        collection.name = "collection"
+        package = cr.UpdateCollectionPackage()
+        package.name = "package"
+        package.filename = "package.rpm"
+        collection.append(package)
+        update.append_collection(collection)
+
+        uinfo = cr.UpdateInfo()
+        uinfo.append(update)
+        expected = hashlib.sha256(uinfo.xml_dump().encode("utf-8")).hexdigest()
+        self.assertEqual(hash_update_record(update), expected)
@@ -0,0 +1,187 @@
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+import createrepo_c as cr
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
+from pulpcore.plugin.models import Artifact, Content, ContentArtifact
+from pulpcore.plugin.stages import DeclarativeContent
+
+from pulp_rpm.app.bulk_insert import copy_insert, copy_insert_content
+from pulp_rpm.app.models import Package, UpdateRecord, UpdateReference
+from pulp_rpm.app.tasks.synchronizing import RpmContentSaver
+
+# columns which differ between two saved rows of otherwise identical packages
+UNIQUE_COLUMNS = {
+    "pulp_id",
+    "content_ptr_id",
+    "pkgId",
+    "pulp_created",
+    "pulp_last_updated",
+    "timestamp_of_interest",
+}
+
+
+def make_package(pkgid, name="foo"):
+    """Create an unsaved package."""
+    pkg = cr.Package()
+    pkg.name = name
+    pkg.epoch = "0"
+    pkg.version = "1.0"
+    pkg.release = "1"
+    pkg.arch = "x86_64"
+    pkg.pkgId = pkgid
+    pkg.checksum_type = "sha256"
+    pkg.summary = "A package"
+    pkg.location_href = f"{name}-1.0-1.x86_64.rpm"
+    pkg.size_package = 1
+    pkg.time_build = 1
+    pkg.requires = [("glibc", None, None, None, None, False)]
+    pkg.files = [("", "/usr/bin/", name)]
+    pkg.changelogs = [("Someone <someone@example.com>", 1, "- initial")]
+    package = Package(**Package.createrepo_to_dict(pkg))
+    package.pulp_labels = {"key": "value"}
+    return package
+
+
+def saved_rows(package):
+    """The rows of a package in rpm_package and core_content, without the unique columns."""
+    rows = []
+    for model in (Package, Content):
+        row = model.objects.filter(pk=package.pk).values().get()
+        rows.append(
+            {column: value for column, value in row.items() if column not in UNIQUE_COLUMNS}
+        )
+    return rows
+
+
+def run_content_saver(declarative_contents):
+    """Pass DeclarativeContents through an RpmContentSaver."""
+
+    async def run():
+        in_q = asyncio.Queue()
+        for declarative_content in declarative_contents:
+            in_q.put_nowait(declarative_content)
+        in_q.put_nowait(None)
+        stage = RpmContentSaver()
+        stage._connect(in_q, asyncio.Queue())
+        await stage()
+
+    # the stage's database access happens in this thread, within the transaction of the test
+    async_to_sync(run)()
+
+
+class TestCopyInsertContent(TestCase):
+    """Test inserting content with COPY."""
+
+    def test_same_rows_as_save(self):
+        """The rows inserted with COPY are the ones Model.save() inserts."""
+        copied = make_package("a" * 64)
+        saved = make_package("b" * 64)
+
+        inserted = copy_insert_content(Package, [copied])
+        saved.save()
+
+        self.assertEqual(inserted, [copied])
+        self.assertFalse(copied._state.adding)
+        self.assertEqual(saved_rows(copied), saved_rows(saved))
+        copied.refresh_from_db()
+        self.assertEqual(copied.pulp_type, "rpm.package")
+        self.assertEqual(copied.pulp_domain_id, saved.pulp_domain_id)
+        self.assertEqual(copied.pulp_labels, {"key": "value"})
+        self.assertIsNotNone(copied.timestamp_of_interest)
+
+    def test_conflicts(self):
+        """Conflicting packages are left unsaved and without any rows."""
+        make_package("a" * 64).save()
+        duplicate = make_package("a" * 64)
+        new = make_package("b" * 64)
+
+        inserted = copy_insert_content(Package, [duplicate, new])
+
+        self.assertEqual(inserted, [new])
+        self.assertTrue(duplicate._state.adding)
+        self.assertFalse(Content.objects.filter(pk=duplicate.pk).exists())
+        self.assertEqual(Package.objects.filter(pkgId="a" * 64).count(), 1)
+
+
+class TestCopyInsert(TestCase):
+    """Test inserting other rows with COPY."""
+
+    def test_same_rows_as_bulk_create(self):
+        """The rows inserted with COPY are the ones bulk_create() inserts."""
+        update_record = UpdateRecord(id="RHSA-2024:0001", digest="a" * 64)
+        update_record.save()
+
+        def references():
+            return [
+                UpdateReference(
+                    href=f"https://example.com/{index}",
+                    ref_id=str(index),
+                    ref_type="bugzilla",
+                    update_record=update_record,
+                )
+                for index in range(3)
+            ]
+
+        UpdateReference.objects.bulk_create(references(), ignore_conflicts=True)
+        expected = list(update_record.references.order_by("href").values("href", "ref_id"))
+        update_record.references.all().delete()
+
+        copy_insert(UpdateReference, references())
+
+        self.assertEqual(
+            list(update_record.references.order_by("href").values("href", "ref_id")), expected
+        )
+
+
+@override_settings(RPM_SYNC_COPY_INSERT=True)
+class TestRpmContentSaverCopyInsert(TestCase):
+    """Test saving packages with COPY in RpmContentSaver."""
+
+    def make_declarative_content(self, pkgid, artifact):
+        """Create a DeclarativeContent for a new package with an artifact."""
+        d_artifact = SimpleNamespace(artifact=artifact, relative_path=f"{pkgid[:8]}.rpm")
+        return DeclarativeContent(content=make_package(pkgid), d_artifacts=[d_artifact])
+
+    def test_on_demand(self):
+        """ContentArtifacts without artifacts are created for on-demand packages."""
+        dc = self.make_declarative_content("a" * 64, Artifact(size=1, sha256="a" * 64))
+
+        run_content_saver([dc])
+
+        self.assertFalse(dc.content._state.adding)
+        self.assertEqual(len(dc.d_artifacts), 1)
+        content_artifact = ContentArtifact.objects.get(content=dc.content)
+        self.assertIsNone(content_artifact.artifact)
+        self.assertEqual(content_artifact.relative_path, dc.d_artifacts[0].relative_path)
+
+    def test_immediate(self):
+        """ContentArtifacts with their artifacts are created for downloaded packages."""
+        with tempfile.NamedTemporaryFile() as temp_file:
+            temp_file.write(b"package")
+            temp_file.flush()
+            artifact = Artifact.init_and_validate(temp_file.name)
+            artifact.save()
+        dc = self.make_declarative_content(artifact.sha256, artifact)
+
+        run_content_saver([dc])
+
+        self.assertFalse(dc.content._state.adding)
+        content_artifact = ContentArtifact.objects.get(content=dc.content)
+        self.assertEqual(content_artifact.artifact, artifact)
+
+    def test_conflicts_resolved(self):
+        """ContentSaver replaces packages which conflict with existing ones by the existing ones."""
+        existing = make_package("a" * 64)
+        existing.save()
+        conflicting = self.make_declarative_content("a" * 64, Artifact(size=1, sha256="a" * 64))
+        new = self.make_declarative_content("b" * 64, Artifact(size=1, sha256="b" * 64))
+
+        run_content_saver([conflicting, new])
+
+        self.assertEqual(conflicting.content.pk, existing.pk)
+        self.assertFalse(new.content._state.adding)
+        self.assertEqual(Package.objects.filter(pkgId__in=["a" * 64, "b" * 64]).count(), 2)
+        self.assertTrue(ContentArtifact.objects.filter(content=new.content).exists())
@@ -0,0 +1,40 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from pulpcore.plugin.models import Task
+
+from pulp_rpm.app.models import Package, RpmPublication, RpmRepository
+
+
+class TestRpmPublishBenchmark(TestCase):
+    """Test the rpm-publish-benchmark management command."""
+
+    def test_tiny_repository(self):
+        """All phases are measured, and everything the benchmark created is deleted."""
+        with tempfile.TemporaryDirectory() as output_dir:
+            output = os.path.join(output_dir, "results.json")
+            call_command(
+                "rpm-publish-benchmark",
+                "--packages=3",
+                "--files=1",
+                "--changelogs=1",
+                "--advisories=1",
+                "--modules=1",
+                "--groups=1",
+                "--packages-per-item=2",
+                f"--output={output}",
+                stderr=StringIO(),
+            )
+            with open(output) as results_file:
+                results = json.load(results_file)
+
+        (run,) = results["runs"]
+        self.assertEqual(set(run), {"populate", "generate_repo_metadata", "publish"})
+        self.assertFalse(RpmRepository.objects.filter(name=results["repository"]).exists())
+        self.assertFalse(RpmPublication.objects.exists())
+        self.assertFalse(Package.objects.filter(name__startswith="benchmark-").exists())
+        self.assertFalse(Task.objects.filter(name="rpm-publish-benchmark").exists())
@@ -0,0 +1,51 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import libcomps
+
+from pulp_rpm.app.comps import COMPS_XML_OPTIONS, dict_to_strdict, write_comps_xml
+
+
+class TestWriteCompsXml(TestCase):
+    """Test writing comps.xml one element at a time."""
+
+    def make_comps(self):
+        group = libcomps.Group("core", "Core", "Smallest possible installation", 0, 1)
+        group.packages.append(libcomps.Package("bash", libcomps.PACKAGE_TYPE_MANDATORY))
+        group.packages.append(libcomps.Package("vim", libcomps.PACKAGE_TYPE_OPTIONAL))
+        group.name_by_lang = dict_to_strdict({"de": "Kern"})
+        category = libcomps.Category("base", "Base", "Base system", 1)
+        category.group_ids.append(libcomps.GroupId("core"))
+        environment = libcomps.Environment("minimal", "Minimal", "Minimal install", 1)
+        environment.group_ids.append(libcomps.GroupId("core"))
+        langpacks = dict_to_strdict({"vim": "vim-lang-%s"})
+        return [group], [category], [environment], langpacks
+
+    def compare(self, groups, categories, environments, langpacks):
+        comps = libcomps.Comps()
+        for group in groups:
+            comps.groups.append(group)
+        for category in categories:
+            comps.categories.append(category)
+        for environment in environments:
+            comps.environments.append(environment)
+        if langpacks is not None:
+            comps.langpacks = langpacks
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            expected_path = os.path.join(tmp_dir, "expected.xml")
+            comps.toxml_f(expected_path, xml_options=COMPS_XML_OPTIONS)
+            path = os.path.join(tmp_dir, "comps.xml")
+            has_comps = write_comps_xml(path, groups, categories, environments, langpacks)
+            with open(expected_path) as expected, open(path) as written:
+                self.assertEqual(written.read(), expected.read())
+        return has_comps
+
+    def test_same_as_libcomps(self):
+        """The file is identical to the one libcomps writes for all elements at once."""
+        self.assertTrue(self.compare(*self.make_comps()))
+
+    def test_empty(self):
+        """An empty comps.xml is identical to the one libcomps writes."""
+        self.assertFalse(self.compare([], [], [], None))
@@ -0,0 +1,46 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from pulp_rpm.app.metadata_cache import MetadataCache
+
+
+class TestMetadataCache(TestCase):
+    """Test the worker-local cache of downloaded metadata files."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, self.cwd)
+        self.cache = MetadataCache(os.path.join(self.tmp_dir.name, "cache"), max_size=10)
+
+    def download(self, data):
+        """Create a downloaded file."""
+        with tempfile.NamedTemporaryFile("w", dir=".", delete=False) as f:
+            f.write(data)
+        return f.name
+
+    def test_get_cached_file(self):
+        """A cached file is available under its own name, unknown files are not."""
+        self.cache.add("primary", "sha256", "abcd", self.download("primary"))
+
+        path = self.cache.get("primary", "sha256", "abcd", "abcd-primary.xml.gz")
+        self.assertEqual(os.path.basename(path), "abcd-primary.xml.gz")
+        with open(path) as f:
+            self.assertEqual(f.read(), "primary")
+        self.assertIsNone(self.cache.get("primary", "sha256", "efgh", "efgh-primary.xml.gz"))
+
+    def test_evict_least_recently_used(self):
+        """The least recently used files are evicted once the cache is too large."""
+        self.cache.add("primary", "sha256", "1", self.download("1234"))
+        os.utime(self.cache._path("primary", "sha256", "1"), (1, 1))
+        self.cache.add("other", "sha256", "2", self.download("1234"))
+        os.utime(self.cache._path("other", "sha256", "2"), (2, 2))
+        self.cache.get("primary", "sha256", "1", "primary.xml")
+        self.cache.add("filelists", "sha256", "3", self.download("1234"))
+
+        self.assertIsNotNone(self.cache.get("primary", "sha256", "1", "primary.xml"))
+        self.assertIsNone(self.cache.get("other", "sha256", "2", "other.xml"))
+        self.assertIsNotNone(self.cache.get("filelists", "sha256", "3", "filelists.xml"))
@@ -1,4 +1,9 @@
-from django.test import TestCase
+from collections import defaultdict
+
+import createrepo_c as cr
+from django.test import SimpleTestCase, TestCase
+
+from pulp_rpm.app.models import Package, PackageMetadataFragments
 
 
 class TestNothing(TestCase):
@@ -7,3 +12,136 @@ class TestNothing(TestCase):
     def test_nothing_at_all(self):
         """Test that the tests are running and that's it."""
         self.assertTrue(True)
+
+
+class TestBuildRank(TestCase):
+    """Test picking one of several builds of the same NEVRA."""
+
+    def make_package(self, pkgid, time_build, name="foo", version="1.0"):
+        """Create and save a package."""
+        pkg = cr.Package()
+        pkg.name = name
+        pkg.epoch = "0"
+        pkg.version = version
+        pkg.release = "1"
+        pkg.arch = "x86_64"
+        pkg.pkgId = pkgid
+        pkg.checksum_type = "sha256"
+        pkg.location_href = f"{name}-{version}-1.x86_64.rpm"
+        package = Package(**Package.createrepo_to_dict(pkg))
+        package.time_build = time_build
+        package.save()
+        return package
+
+    def select(self, packages):
+        """The pks of the packages ranked first for their NEVRA."""
+        ranked = Package.objects.with_build_rank().filter(pk__in=[pkg.pk for pkg in packages])
+        return set(ranked.filter(build_rank=1).values_list("pk", flat=True))
+
+    def select_like_before(self, packages):
+        """The pks the publish task selected before the ranking was done in the database."""
+        builds_by_nevra = defaultdict(list)
+        for pkg in packages:
+            builds_by_nevra[pkg.nevra].append((pkg.time_build, pkg.pk))
+        selected = set()
+        for builds in builds_by_nevra.values():
+            builds.sort(key=lambda build: build[0], reverse=True)
+            selected.add(builds[0][1])
+        return selected
+
+    def test_latest_build_selected(self):
+        """The most recent build of each NEVRA is picked, as before."""
+        packages = [
+            self.make_package("a" * 64, 2),
+            self.make_package("b" * 64, 5),
+            self.make_package("c" * 64, 3),
+            self.make_package("d" * 64, 1, version="2.0"),
+            self.make_package("e" * 64, 4, name="bar"),
+        ]
+
+        selected = self.select(packages)
+
+        self.assertEqual(selected, self.select_like_before(packages))
+        self.assertEqual(selected, {packages[1].pk, packages[3].pk, packages[4].pk})
+
+    def test_missing_build_time(self):
+        """Builds without a build time are only picked if no build of the NEVRA has one."""
+        dated = self.make_package("a" * 64, 1)
+        undated = self.make_package("b" * 64, None)
+        only_undated = [
+            self.make_package("c" * 64, None, version="2.0"),
+            self.make_package("d" * 64, None, version="2.0"),
+        ]
+
+        selected = self.select([dated, undated] + only_undated)
+
+        # sorting by build time used to fail if only some builds of a NEVRA had one
+        self.assertIn(dated.pk, selected)
+        self.assertNotIn(undated.pk, selected)
+        # ties are broken by pk rather than by the order the database returns the builds in
+        self.assertEqual(
+            selected & {pkg.pk for pkg in only_undated}, {min(pkg.pk for pkg in only_undated)}
+        )
+
+
+class TestPackageMetadataFragments(SimpleTestCase):
+    """Test pre-rendered package metadata."""
+
+    def make_package(self):
+        """Create a createrepo_c package."""
+        pkg = cr.Package()
+        pkg.name = "foo"
+        pkg.epoch = "0"
+        pkg.version = "1.0"
+        pkg.release = "1"
+        pkg.arch = "noarch"
+        pkg.summary = '<location href="@@PULP_LOCATION_HREF@@"/>'
+        pkg.time_build = 1
+        pkg.time_file = 2
+        pkg.files = [("", "/usr/bin/", "foo")]
+        pkg.changelogs = [("Someone <someone@example.com>", 1, "- initial")]
+        return pkg
+
+    def test_render_matches_createrepo_c(self):
+        """Rendered fragments are identical to the XML createrepo_c generates."""
+        fragments = PackageMetadataFragments.from_createrepo_c(1, self.make_package())
+
+        rendered = PackageMetadataFragments.render(
+            (fragments.primary, fragments.filelists, fragments.other),
+            "sha256",
+            "abcd",
+            "Packages/f/foo&bar.rpm",
+            3,
+        )
+
+        expected = self.make_package()
+        expected.checksum_type = "sha256"
+        expected.pkgId = "abcd"
+        expected.location_href = "Packages/f/foo&bar.rpm"
+        expected.time_file = 3
+        self.assertEqual(rendered, cr.xml_dump(expected))
+
+
+class TestPackageReference(SimpleTestCase):
+    """Test referring to existing packages parsed from primary.xml only."""
+
+    def test_reference_matches_full_package(self):
+        """The reference has the natural key and download data of the complete package."""
+        pkg = cr.Package()
+        pkg.name = "foo"
+        pkg.version = "1.0"
+        pkg.release = "1"
+        pkg.arch = "noarch"
+        pkg.pkgId = "abcd"
+        pkg.checksum_type = "sha256"
+        pkg.location_href = "Packages/f/foo-1.0-1.noarch.rpm"
+        pkg.size_package = 1024
+
+        reference = Package.createrepo_to_reference_dict(pkg)
+        package = Package.createrepo_to_dict(pkg)
+
+        for field in Package.natural_key_fields():
+            if field != "_pulp_domain":
+                self.assertEqual(reference[field], package[field])
+        for field, value in reference.items():
+            self.assertEqual(value, package[field])
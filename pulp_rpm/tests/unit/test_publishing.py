@@ -0,0 +1,407 @@
+import glob
+import gzip
+import io
+import os
+import tempfile
+import uuid
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+import createrepo_c as cr
+from django.core.exceptions import ObjectDoesNotExist
+from django.test import TransactionTestCase
+
+from pulpcore.plugin.models import Content, ContentArtifact
+
+from pulp_rpm.app.models import Package, RpmPublication, RpmRepository
+from pulp_rpm.app.tasks.publishing import (
+    PublicationData,
+    PublishedArtifactWriter,
+    compress_packages_in_parallel,
+    generate_metadata,
+    get_repodata_digest,
+    select_packages,
+    splice_packages,
+)
+
+
+def make_package(pkgid, name=None):
+    """Create a createrepo_c package with just enough data to identify it."""
+    pkg = cr.Package()
+    pkg.pkgId = pkgid
+    pkg.name = name or pkgid
+    return pkg
+
+
+class TestSplicePackages(TestCase):
+    """Test merging previously published package metadata with added packages."""
+
+    def render(self, pk, package):
+        package.name = "rendered"
+        return package
+
+    def test_splice_added_and_removed(self):
+        """Added packages are rendered, removed ones dropped and unchanged ones reused."""
+        previous = [make_package("a"), make_package("b"), make_package("c")]
+        spliced = splice_packages(
+            [1, 4, 3],
+            {4: make_package("d")},
+            {1: "a", 3: "c"},
+            previous,
+            self.render,
+        )
+        result = [(pkg.pkgId, pkg.name) for pkg in spliced]
+        self.assertEqual(result, [("a", "a"), ("d", "rendered"), ("c", "c")])
+
+    def test_splice_out_of_order(self):
+        """Unchanged packages are found even if the previous metadata is ordered differently."""
+        previous = [make_package("b"), make_package("a")]
+        spliced = splice_packages([1, 2], {}, {1: "a", 2: "b"}, previous, self.render)
+        self.assertEqual([pkg.pkgId for pkg in spliced], ["a", "b"])
+
+    def test_splice_skips_excluded(self):
+        """Packages which are neither added nor expected are not published."""
+        previous = [make_package("a")]
+        spliced = splice_packages([1, 2], {}, {1: "a"}, previous, self.render)
+        self.assertEqual([pkg.pkgId for pkg in spliced], ["a"])
+
+    def load_packages(self, pks):
+        self.loaded.append(list(pks))
+        return {pk: make_package(f"db-{pk}") for pk in pks}
+
+    def test_splice_missing_loaded_in_batches(self):
+        """Packages missing from the previous metadata are loaded at once, keeping the order."""
+        self.loaded = []
+        spliced = splice_packages(
+            [1, 2, 3, 4],
+            {2: make_package("b")},
+            {1: "a", 3: "c", 4: "d"},
+            [make_package("x")],
+            self.render,
+            self.load_packages,
+        )
+        result = [(pkg.pkgId, pkg.name) for pkg in spliced]
+        self.assertEqual(
+            result,
+            [("db-1", "rendered"), ("b", "rendered"), ("db-3", "rendered"), ("db-4", "rendered")],
+        )
+        self.assertEqual(self.loaded, [[1, 3, 4]])
+
+    @mock.patch("pulp_rpm.app.tasks.publishing.SPLICE_BATCH_SIZE", 2)
+    def test_splice_buffer_limited(self):
+        """Once too much of the previous metadata is out of order, the rest is loaded instead."""
+        self.loaded = []
+        previous = [make_package(pkgid) for pkgid in "edcba"]
+        spliced = splice_packages(
+            [1, 2, 3, 4, 5],
+            {},
+            {1: "a", 2: "b", 3: "c", 4: "d", 5: "e"},
+            previous,
+            self.render,
+            self.load_packages,
+        )
+        result = [pkg.pkgId for pkg in spliced]
+        self.assertEqual(result, ["db-1", "db-2", "db-3", "db-4", "db-5"])
+        self.assertEqual(self.loaded, [[1, 2], [3, 4], [5]])
+
+
+class TestRepodataDigest(TestCase):
+    """Test the digest identifying the repodata generated for a content set."""
+
+    def test_options_order_irrelevant(self):
+        """The digest doesn't depend on the order of the options."""
+        first = get_repodata_digest([1, 2], {"layout": "flat", "checksum_type": "sha256"})
+        second = get_repodata_digest([1, 2], {"checksum_type": "sha256", "layout": "flat"})
+        self.assertEqual(first, second)
+
+    def test_content_and_options_change_digest(self):
+        """Different content or different options produce a different digest."""
+        options = {"checksum_type": "sha256"}
+        digest = get_repodata_digest([1, 2], options)
+        self.assertNotEqual(digest, get_repodata_digest([1, 3], options))
+        self.assertNotEqual(digest, get_repodata_digest([1, 2], {"checksum_type": "sha512"}))
+        self.assertNotEqual(digest, get_repodata_digest([12], options))
+
+    def test_package_checksums_change_digest(self):
+        """The checksums packages are published with are part of the digest."""
+        options = {"checksum_type": "sha256", "package_checksum_type": "sha512"}
+        # the package isn't downloaded yet, so its built-in checksum is published
+        built_in = get_repodata_digest([1, 2], options, {1: ("sha256", "abc")})
+        # once its artifact is downloaded, the checksum of the requested type is published
+        downloaded = get_repodata_digest([1, 2], options, {1: ("sha512", "def")})
+        self.assertNotEqual(built_in, downloaded)
+        self.assertEqual(built_in, get_repodata_digest([1, 2], options, {1: ("sha256", "abc")}))
+
+
+class TestCompressPackagesInParallel(TestCase):
+    """Test writing the package metadata in separate processes."""
+
+    def write_repository(self, path, parallel):
+        """Write a repository with a few packages and return the contents of its metadata."""
+        packages = [make_package(f"pkg{i}") for i in range(3)]
+        for pkg in packages:
+            pkg.files = [("", "/usr/bin/", pkg.name)]
+            pkg.changelogs = [("Someone", 1, "- change")]
+        with cr.RepositoryWriter(path, compression=cr.GZ) as writer:
+            writer.set_num_of_pkgs(len(packages))
+            if parallel:
+                compress_packages_in_parallel(writer, cr.GZ, len(packages))
+            for pkg in packages:
+                for name, chunk in zip(("primary", "filelists", "other"), cr.xml_dump(pkg)):
+                    writer.working_metadata_files[name].writer.add_chunk(chunk)
+
+        contents = {}
+        for record in writer.repomd.records:
+            decompressed = os.path.join(path, record.type)
+            cr.decompress_file(
+                os.path.join(path, record.location_href), decompressed, cr.AUTO_DETECT_COMPRESSION
+            )
+            with open(decompressed) as f:
+                contents[record.type] = (f.read(), record.checksum_open, record.size_open)
+        return contents
+
+    def test_same_metadata(self):
+        """The metadata is identical to the metadata written by the RepositoryWriter itself."""
+        with tempfile.TemporaryDirectory() as serial, tempfile.TemporaryDirectory() as parallel:
+            expected = self.write_repository(serial, parallel=False)
+            self.assertEqual(set(expected), {"primary", "filelists", "other"})
+            self.assertEqual(self.write_repository(parallel, parallel=True), expected)
+
+
+class FakeProgressReport:
+    """A progress report counting what it was increased by."""
+
+    def __init__(self):
+        self.done = 0
+
+    def increase_by(self, count):
+        self.done += count
+
+
+class TestPublishedArtifactWriter(TestCase):
+    """Test creating PublishedArtifacts in batches."""
+
+    @mock.patch("pulp_rpm.app.tasks.publishing.PublishedArtifact")
+    def test_batches(self, published_artifact):
+        """PublishedArtifacts are created in batches of bounded size, and the rest at the end."""
+        progress_report = FakeProgressReport()
+        with PublishedArtifactWriter("publication", progress_report, batch_size=2) as writer:
+            for i in range(5):
+                writer.add(f"Packages/{i}.rpm", i)
+            self.assertEqual(progress_report.done, 4)
+
+        batches = [call.args[0] for call in published_artifact.objects.bulk_create.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(progress_report.done, 5)
+        published_artifact.assert_called_with(
+            relative_path="Packages/4.rpm", publication="publication", content_artifact_id=4
+        )
+
+    @mock.patch("pulp_rpm.app.tasks.publishing.PublishedArtifact")
+    def test_no_flush_on_error(self, published_artifact):
+        """The last batch isn't created if publishing fails."""
+        with self.assertRaises(RuntimeError):
+            with PublishedArtifactWriter("publication") as writer:
+                writer.add("Packages/a.rpm", 1)
+                raise RuntimeError()
+        published_artifact.objects.bulk_create.assert_not_called()
+
+
+class FakeArtifactFile:
+    """An artifact file in storage which may not be on the local filesystem."""
+
+    def __init__(self, path):
+        self._path = path
+        self.file = io.BytesIO(b"metadata")
+
+    @property
+    def path(self):
+        if self._path is None:
+            raise NotImplementedError("This backend doesn't support absolute paths.")
+        return self._path
+
+
+class TestPrepareMetadataFiles(TestCase):
+    """Test placing the synced metadata files in the working directory."""
+
+    def make_metadata_file(self, artifact_path):
+        """Create a fake RepoMetadataFile whose artifact is stored at a path."""
+        content_artifact = SimpleNamespace(
+            artifact=SimpleNamespace(file=FakeArtifactFile(artifact_path)),
+            relative_path="repodata/abcd-productid.gz",
+        )
+        return SimpleNamespace(
+            unsupported_metadata_type=False,
+            checksum="abcd",
+            data_type="productid",
+            contentartifact_set=SimpleNamespace(get=lambda: content_artifact),
+        )
+
+    def prepare_metadata_files(self, metadata_file, folder):
+        with mock.patch("pulp_rpm.app.tasks.publishing.RepoMetadataFile") as repo_metadata_file:
+            repo_metadata_file.objects.filter.return_value.prefetch_related.return_value = [
+                metadata_file
+            ]
+            return PublicationData(None, None).prepare_metadata_files([], folder)
+
+    def test_linked_on_filesystem(self):
+        """Files on the local filesystem are linked to."""
+        with tempfile.TemporaryDirectory() as folder:
+            artifact_path = os.path.join(folder, "artifact")
+            with open(artifact_path, "wb") as artifact:
+                artifact.write(b"metadata")
+
+            records = self.prepare_metadata_files(self.make_metadata_file(artifact_path), folder)
+
+            path = os.path.join(folder, "productid.gz")
+            self.assertEqual(records, [("productid", path)])
+            self.assertEqual(os.readlink(path), artifact_path)
+
+    def test_copied_from_other_storage(self):
+        """Files in storage without local paths are copied."""
+        with tempfile.TemporaryDirectory() as folder:
+            records = self.prepare_metadata_files(self.make_metadata_file(None), folder)
+
+            path = os.path.join(folder, "productid.gz")
+            self.assertEqual(records, [("productid", path)])
+            self.assertFalse(os.path.islink(path))
+            with open(path, "rb") as metadata:
+                self.assertEqual(metadata.read(), b"metadata")
+
+
+class FakeWriter:
+    """A PublishedArtifactWriter recording the published paths."""
+
+    def __init__(self):
+        self.published = {}
+
+    def add(self, relative_path, content_artifact_pk):
+        self.published[relative_path] = content_artifact_pk
+
+
+class TestSelectPackages(TransactionTestCase):
+    """Test picking the packages to publish once for both the files and the metadata."""
+
+    def make_package(self, pkgid, time_build, relative_path):
+        """Create a package of the same NEVRA with a content artifact."""
+        pkg = make_package(pkgid * 64, "foo")
+        pkg.epoch = "0"
+        pkg.version = "1.0"
+        pkg.release = "1"
+        pkg.arch = "x86_64"
+        pkg.checksum_type = "sha256"
+        pkg.location_href = relative_path
+        package = Package(**Package.createrepo_to_dict(pkg))
+        package.time_build = time_build
+        package.save()
+        content_artifact = ContentArtifact.objects.create(
+            content=package, relative_path=relative_path, artifact=None
+        )
+        return package, content_artifact
+
+    def test_same_packages_published(self):
+        """The files of the packages not picked for the metadata aren't published either."""
+        old, _ = self.make_package("a", 1, "foo-1.0-1.x86_64.rpm")
+        latest, latest_content_artifact = self.make_package("b", 3, "foo-1.0-1.x86_64.rpm")
+        undated, _ = self.make_package("c", None, "other/foo-1.0-1.x86_64.rpm")
+        renamed, _ = self.make_package("d", 2, "foo-renamed.rpm")
+        content = Content.objects.filter(pk__in=[old.pk, latest.pk, undated.pk, renamed.pk])
+
+        total_packages, pkg_pks_to_ignore = select_packages(content)
+
+        self.assertEqual(total_packages, 1)
+        self.assertEqual(pkg_pks_to_ignore, {old.pk, undated.pk, renamed.pk})
+
+        writer = FakeWriter()
+        with mock.patch("pulp_rpm.app.tasks.publishing.publish_other_artifacts"):
+            PublicationData(None, None).publish_artifacts(
+                content, writer, pkg_pks_to_ignore=pkg_pks_to_ignore
+            )
+        self.assertEqual(
+            writer.published, {"Packages/f/foo-1.0-1.x86_64.rpm": latest_content_artifact.pk}
+        )
+
+
+class TestGenerateMetadataInWorkers(TransactionTestCase):
+    """Test generating the metadata of sub-repos in worker processes."""
+
+    # the worker processes only see committed data
+    serialized_rollback = True
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+        self.version = self.make_repository_version("main", ["main"])
+        self.sub_repo_versions = {
+            "BaseOS": self.make_repository_version("baseos", ["bash", "glibc"]),
+            "AppStream": self.make_repository_version("appstream", ["python3"]),
+        }
+
+    def make_repository_version(self, name, package_names):
+        """Create a repository version with some packages."""
+        packages = []
+        for package_name in package_names:
+            pkg = make_package(f"{package_name:0<64}", package_name)
+            pkg.epoch = "0"
+            pkg.version = "1.0"
+            pkg.release = "1"
+            pkg.arch = "x86_64"
+            pkg.checksum_type = "sha256"
+            pkg.location_href = f"{package_name}-1.0-1.x86_64.rpm"
+            pkg.files = [("", "/usr/bin/", package_name)]
+            package = Package(**Package.createrepo_to_dict(pkg))
+            package.save()
+            packages.append(package.pk)
+        repository = RpmRepository.objects.create(name=name, user_hidden=True)
+        with repository.new_version() as version:
+            version.add_content(Package.objects.filter(pk__in=packages))
+        return repository.latest_version()
+
+    def generate(self, sub_repo_workers, sub_repo_versions=None):
+        """Generate the metadata in a directory of its own and read the package metadata."""
+        os.chdir(tempfile.mkdtemp(dir=self.tmp_dir.name))
+        publication = RpmPublication(
+            repository_version=self.version,
+            checksum_type="sha256",
+            metadata_checksum_type="sha256",
+            package_checksum_type="sha256",
+        )
+        publication.save()
+        # the packages are selected by generate_repo_metadata() itself
+        publication_data = SimpleNamespace(repomdrecords=[], sub_repos=[], package_selection=None)
+        for name, version in (sub_repo_versions or self.sub_repo_versions).items():
+            os.mkdir(name)
+            publication_data.sub_repos.append((name, None))
+            setattr(publication_data, f"{name}_version", version)
+            setattr(publication_data, f"{name}_content", getattr(version, "content", None))
+            setattr(publication_data, f"{name}_repomdrecords", [])
+            setattr(publication_data, f"{name}_package_selection", None)
+
+        generate_metadata(publication, publication_data, {}, sub_repo_workers=sub_repo_workers)
+
+        metadata = {}
+        for path in glob.glob("**/repodata/*.xml.gz", recursive=True):
+            # the file names contain the checksums of the compressed files, which differ
+            directory, file_name = os.path.split(path)
+            with gzip.open(path, "rt") as metadata_file:
+                metadata[(directory, file_name.split("-", 1)[-1])] = metadata_file.read()
+        return metadata
+
+    def test_same_as_serial(self):
+        """The metadata is the same as the one generated without worker processes."""
+        serial = self.generate(0)
+        parallel = self.generate(2)
+
+        self.assertIn(("BaseOS/repodata", "primary.xml.gz"), serial)
+        self.assertEqual(parallel, serial)
+
+    def test_worker_failure(self):
+        """Errors of the worker processes are raised in the task."""
+        sub_repo_versions = {
+            "BaseOS": self.sub_repo_versions["BaseOS"],
+            "Missing": SimpleNamespace(pk=uuid.uuid4()),
+        }
+        with self.assertRaises(ObjectDoesNotExist):
+            self.generate(2, sub_repo_versions)
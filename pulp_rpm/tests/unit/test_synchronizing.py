@@ -0,0 +1,486 @@
+import asyncio
+import contextvars
+import datetime
+import gzip
+import os
+import tempfile
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import createrepo_c as cr
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase
+
+from pulp_rpm.app.models import (
+    Package,
+    UpdateCollection,
+    UpdateCollectionPackage,
+    UpdateRecord,
+    UpdateReference,
+)
+from pulp_rpm.app.tasks.synchronizing import (
+    MirroringIndex,
+    PackedPackageFields,
+    ProgressCounter,
+    RpmContentSaver,
+    RpmFirstStage,
+    aget_repomd_file,
+    get_existing_update_records,
+    probe_mirrors,
+    run_with_event_loop,
+    sync_repos,
+)
+
+variable = contextvars.ContextVar("variable", default=None)
+
+
+class FakeProgressReport:
+    """A progress report recording its updates."""
+
+    def __init__(self):
+        self.done = 0
+        self.suffix = None
+        self.updates = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def aincrease_by(self, count):
+        self.done += count
+        self.updates.append(count)
+
+
+class TestRunWithEventLoop(SimpleTestCase):
+    """Test running sync pipelines in worker threads."""
+
+    def test_event_loop_and_context(self):
+        """The function can run an event loop and sees the context of the caller."""
+
+        async def get_variable():
+            return variable.get()
+
+        def run():
+            return asyncio.get_event_loop().run_until_complete(get_variable())
+
+        variable.set("value")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, run_with_event_loop, run)
+                for _ in range(2)
+            ]
+            self.assertEqual([future.result() for future in futures], ["value", "value"])
+
+
+class TestSyncRepos(SimpleTestCase):
+    """Test syncing the repositories of a distribution tree."""
+
+    repos_to_sync = {"BaseOS": "baseos", "AppStream": "appstream", "": "primary"}
+
+    def sync_repos(self, sub_repo_workers, failing=None):
+        """Sync fake repositories and record the order they were synced in."""
+        synced = []
+
+        def sync_repo(directory, repo_config):
+            if directory == failing:
+                raise ValueError(directory)
+            synced.append(directory)
+            return repo_config
+
+        try:
+            # in a thread of its own, like the sync task, which has an event loop
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                results = executor.submit(
+                    run_with_event_loop, sync_repos, sync_repo, self.repos_to_sync, sub_repo_workers
+                ).result()
+        finally:
+            self.synced = synced
+        return results
+
+    def test_primary_last(self):
+        """The primary repository is synced once all sub-repos are synced."""
+        for sub_repo_workers in (0, 2):
+            with self.subTest(sub_repo_workers=sub_repo_workers):
+                results = self.sync_repos(sub_repo_workers)
+
+                self.assertEqual(results, self.repos_to_sync)
+                self.assertEqual(set(self.synced[:2]), {"BaseOS", "AppStream"})
+                self.assertEqual(self.synced[2], "")
+
+    def test_failing_sub_repo(self):
+        """The primary repository isn't synced if syncing a sub-repo fails."""
+        for sub_repo_workers in (0, 1, 2):
+            with self.subTest(sub_repo_workers=sub_repo_workers):
+                with self.assertRaises(ValueError):
+                    self.sync_repos(sub_repo_workers, failing="BaseOS")
+
+                self.assertNotIn("", self.synced)
+
+
+class TestParsePackages(SimpleTestCase):
+    """Test decompressing primary.xml once for both parsing passes."""
+
+    def test_decompressed_once(self):
+        """Both passes are given the decompressed primary.xml, which is removed afterwards."""
+        with tempfile.TemporaryDirectory() as working_dir:
+            primary_xml_path = os.path.join(working_dir, "primary.xml.gz")
+            primary_xml = cr.PrimaryXmlFile(primary_xml_path, cr.GZ_COMPRESSION)
+            primary_xml.set_num_of_pkgs(2)
+            for name in ("foo", "bar"):
+                pkg = cr.Package()
+                pkg.name = name
+                pkg.pkgId = name * 16
+                pkg.checksum_type = "sha256"
+                primary_xml.add_pkg(pkg)
+            primary_xml.close()
+            parsed = []
+
+            async def parse_decompressed_packages(path, filelists_xml, other_xml, modulemd_list):
+                self.assertEqual(cr.detect_compression(path), cr.NO_COMPRESSION)
+                cr.xml_parse_primary(
+                    path, pkgcb=lambda pkg: parsed.append(pkg.name), do_files=False
+                )
+                parsed.append(os.path.dirname(path))
+
+            first_stage = SimpleNamespace(parse_decompressed_packages=parse_decompressed_packages)
+            cwd = os.getcwd()
+            os.chdir(working_dir)
+            try:
+                asyncio.run(
+                    RpmFirstStage.parse_packages(
+                        first_stage, SimpleNamespace(path=primary_xml_path), None, None
+                    )
+                )
+            finally:
+                os.chdir(cwd)
+
+            self.assertEqual(parsed[:2], ["foo", "bar"])
+            self.assertFalse(os.path.exists(os.path.join(working_dir, parsed[2])))
+
+
+class TestProgressCounter(SimpleTestCase):
+    """Test updating progress reports in batches."""
+
+    def test_batches(self):
+        """The progress report is updated every batch and with the remaining items on exit."""
+        progress_report = FakeProgressReport()
+
+        async def count():
+            async with ProgressCounter(progress_report, batch_size=10, interval=60) as counter:
+                for _ in range(25):
+                    await counter.aincrement()
+
+        asyncio.run(count())
+        self.assertEqual(progress_report.updates, [10, 10, 5])
+        self.assertEqual(progress_report.done, 25)
+        self.assertTrue(progress_report.suffix.endswith("/s"))
+
+
+class FakeRemote:
+    """A remote recording the URLs it downloads."""
+
+    def __init__(self):
+        self.urls = []
+
+    def get_downloader(self, url):
+        remote = self
+
+        class Downloader:
+            async def run(self):
+                remote.urls.append(url)
+                return url
+
+        return Downloader()
+
+
+class TestGetRepomdFile(SimpleTestCase):
+    """Test downloading repomd.xml files."""
+
+    def test_downloaded_once(self):
+        """Each repomd.xml is only downloaded once, regardless of query strings."""
+        remote = FakeRemote()
+        repomd_results = {}
+
+        async def download():
+            return [
+                await aget_repomd_file(remote, url, repomd_results)
+                for url in (
+                    "http://example.com/repo/",
+                    "http://example.com/repo/?param",
+                    "http://example.com/repo/BaseOS/",
+                )
+            ]
+
+        results = asyncio.run(download())
+        self.assertEqual(
+            remote.urls,
+            [
+                "http://example.com/repo/repodata/repomd.xml",
+                "http://example.com/repo/BaseOS/repodata/repomd.xml",
+            ],
+        )
+        self.assertEqual(results[0], results[1])
+
+
+class SlowRemote:
+    """A remote with mirrors of different latencies, some of which are broken."""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.completed = []
+
+    def get_downloader(self, url):
+        remote = self
+        mirror = url.split("/")[2]
+
+        class Downloader:
+            async def run(self):
+                await asyncio.sleep(remote.delays[mirror])
+                if mirror.startswith("broken"):
+                    raise FileNotFoundError(url)
+                remote.completed.append(mirror)
+                return url
+
+        return Downloader()
+
+
+class TestProbeMirrors(SimpleTestCase):
+    """Test choosing a mirror from a mirrorlist."""
+
+    def test_fastest_working_mirror(self):
+        """The fastest working mirror is chosen and the slower ones aren't waited for."""
+        remote = SlowRemote({"slow": 10, "broken": 0, "fast": 0.01})
+        mirror_urls = [f"http://{mirror}/repo/" for mirror in ("slow", "broken", "fast")]
+
+        mirror_url = asyncio.run(probe_mirrors(remote, mirror_urls))
+        self.assertEqual(mirror_url, "http://fast/repo/")
+        self.assertEqual(remote.completed, ["fast"])
+
+    def test_no_working_mirror(self):
+        """None is returned if none of the mirrors works."""
+        remote = SlowRemote({"broken": 0})
+        self.assertIsNone(asyncio.run(probe_mirrors(remote, ["http://broken/repo/"])))
+
+
+class TestMirroringIndex(SimpleTestCase):
+    """Test the index of metadata files and packages used for mirroring."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+
+    def test_index(self):
+        """Entries are kept per repository and packages can have several locations."""
+        repo = SimpleNamespace(pk="repo")
+        sub_repo = SimpleNamespace(pk="sub_repo")
+
+        with MirroringIndex() as index:
+            index.add_metadata_file(repo, "/tmp/a", "repodata/repomd.xml")
+            index.add_metadata_file(repo, "/tmp/b", "repodata/repomd.xml")
+            index.add_metadata_file(sub_repo, "/tmp/c", "repodata/repomd.xml")
+            index.add_package(repo, "abc", "Packages/a.rpm")
+            index.add_package(repo, "abc", "Packages/a.rpm")
+            index.add_package(repo, "abc", "other/a.rpm")
+            index.add_package(sub_repo, "def", "Packages/d.rpm")
+
+            self.assertEqual(index.metadata_files(repo), {"repodata/repomd.xml": "/tmp/b"})
+            self.assertEqual(index.metadata_files(sub_repo), {"repodata/repomd.xml": "/tmp/c"})
+            locations = index.location_hrefs(repo, ["abc", "def"])
+            self.assertEqual(locations["abc"], {"Packages/a.rpm", "other/a.rpm"})
+            self.assertEqual(locations["def"], set())
+
+        self.assertEqual(os.listdir("."), [])
+
+
+class TestPutPackage(TestCase):
+    """Test passing packages down the sync pipeline."""
+
+    def test_modular_packages(self):
+        """Packages listed by modulemds are marked without referencing the modulemds."""
+        stage = RpmFirstStage(
+            SimpleNamespace(url="http://example.com/repo/"),
+            None,
+            deferred_download=True,
+            mirror_metadata=False,
+        )
+        stage.modular_nevras = {"foo-0:1.0-1.x86_64"}
+        dcs = []
+
+        async def put(dc):
+            dcs.append(dc)
+
+        stage.put = put
+        for name in ("foo", "bar"):
+            package = Package(
+                name=name,
+                epoch="0",
+                version="1.0",
+                release="1",
+                arch="x86_64",
+                pkgId=name,
+                checksum_type="sha256",
+                location_href=f"Packages/{name}-1.0-1.x86_64.rpm",
+                size_package=1,
+            )
+            asyncio.run(stage.put_package(package, None))
+
+        self.assertTrue(dcs[0].content.is_modular)
+        self.assertEqual(dcs[0].extra_data, {"modular": True})
+        self.assertFalse(dcs[1].content.is_modular)
+        self.assertEqual(dcs[1].extra_data, {})
+
+
+class TestPackedPackageFields(SimpleTestCase):
+    """Test packing the bulky fields of packages during sync."""
+
+    def test_unpack(self):
+        """The packed fields are set on the package as they were."""
+        fields = {
+            "description": "A package",
+            "files": [["", "/usr/bin/", "foo"]],
+            "requires": [["glibc", None, None, None, None, False]],
+        }
+        package = SimpleNamespace(description=None, files=None, requires=None)
+
+        PackedPackageFields(fields).unpack_into(package)
+
+        self.assertEqual(package.description, "A package")
+        self.assertEqual(package.files, fields["files"])
+        self.assertEqual(package.requires, fields["requires"])
+
+
+class TestExistingAdvisories(TestCase):
+    """Test skipping advisories which already exist."""
+
+    def make_update(self):
+        """Create a createrepo_c update record with a collection and a reference."""
+        update = cr.UpdateRecord()
+        update.id = "TEST-1"
+        update.title = "Title"
+        collection = cr.UpdateCollection()
+        package = cr.UpdateCollectionPackage()
+        package.name = "package"
+        package.filename = "package.rpm"
+        collection.append(package)
+        update.append_collection(collection)
+        reference = cr.UpdateReference()
+        reference.href = "https://example.com/1"
+        reference.id = "1"
+        reference.type = "bugzilla"
+        update.append_reference(reference)
+        return update
+
+    def test_get_existing_update_records(self):
+        """Only advisories with the digests are returned, and they are touched."""
+        existing = UpdateRecord(id="TEST-1", digest="a" * 64)
+        existing.save()
+        long_ago = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        UpdateRecord.objects.filter(pk=existing.pk).update(timestamp_of_interest=long_ago)
+
+        update_records = get_existing_update_records(["a" * 64, "b" * 64])
+
+        self.assertEqual(update_records, {"a" * 64: existing})
+        self.assertFalse(update_records["a" * 64].has_collections)
+        self.assertFalse(update_records["a" * 64].has_references)
+        existing.refresh_from_db()
+        self.assertGreater(existing.timestamp_of_interest, long_ago)
+
+    def test_new_update_record(self):
+        """The relations of new advisories are built, and missing collection names filled in."""
+        dc = RpmFirstStage.update_record_to_declarative_content(self.make_update(), "a" * 64)
+
+        self.assertEqual(dc.content.id, "TEST-1")
+        self.assertEqual(dc.content.digest, "a" * 64)
+        ((collection, packages),) = dc.extra_data["collections"].items()
+        self.assertTrue(collection.name.startswith("collection-autofill-"))
+        self.assertEqual([package.filename for package in packages], ["package.rpm"])
+        references = dc.extra_data["references"]
+        self.assertEqual([reference.href for reference in references], ["https://example.com/1"])
+
+    def test_relations_saved_for_new_only(self):
+        """The relations are saved for new advisories, those of existing ones are kept."""
+        new = RpmFirstStage.update_record_to_declarative_content(self.make_update(), "a" * 64)
+        new.content.save()
+        existing = RpmFirstStage.update_record_to_declarative_content(self.make_update(), "b" * 64)
+        existing.content.save()
+        RpmContentSaver()._post_save([existing])
+        # as if the advisory had been parsed again
+        existing.extra_data = RpmFirstStage.update_record_to_declarative_content(
+            self.make_update(), "b" * 64
+        ).extra_data
+
+        RpmContentSaver()._post_save([new, existing, None])
+
+        for dc in (new, existing):
+            self.assertEqual(UpdateCollection.objects.filter(update_record=dc.content).count(), 1)
+            self.assertEqual(UpdateReference.objects.filter(update_record=dc.content).count(), 1)
+
+    def sync_advisories(self, updateinfo_xml_path):
+        """Parse the advisories and save them, as the sync pipeline would."""
+        declarative_contents = []
+
+        async def put(dc):
+            declarative_contents.append(dc)
+
+        first_stage = SimpleNamespace(
+            put=put,
+            update_record_to_declarative_content=RpmFirstStage.update_record_to_declarative_content,
+        )
+        with mock.patch(
+            "pulp_rpm.app.tasks.synchronizing.ProgressReport",
+            lambda **kwargs: FakeProgressReport(),
+        ):
+            async_to_sync(RpmFirstStage.parse_advisories)(
+                first_stage, SimpleNamespace(path=updateinfo_xml_path)
+            )
+
+        for dc in declarative_contents:
+            if dc.content._state.adding:
+                # QueryExistingContents and ContentSaver
+                existing = UpdateRecord.objects.filter(digest=dc.content.digest).first()
+                if existing:
+                    dc.content = existing
+                else:
+                    dc.content.save()
+        RpmContentSaver()._post_save(declarative_contents)
+        return declarative_contents
+
+    def test_sync_over_missing_collections(self):
+        """The missing relations of advisories which weren't saved completely are saved."""
+        update = self.make_update()
+        uinfo = cr.UpdateInfo()
+        uinfo.append(update)
+        with tempfile.TemporaryDirectory() as working_dir:
+            cwd = os.getcwd()
+            os.chdir(working_dir)
+            self.addCleanup(os.chdir, cwd)
+            updateinfo_xml_path = os.path.join(working_dir, "updateinfo.xml.gz")
+            with gzip.open(updateinfo_xml_path, "wt") as updateinfo_xml:
+                updateinfo_xml.write(uinfo.xml_dump())
+
+            self.sync_advisories(updateinfo_xml_path)
+            update_record = UpdateRecord.objects.get(id="TEST-1")
+            update_record.collections.all().delete()
+
+            self.sync_advisories(updateinfo_xml_path)
+            self.assertEqual(update_record.collections.count(), 1)
+            self.assertEqual(update_record.references.count(), 1)
+            self.assertEqual(
+                UpdateCollectionPackage.objects.filter(
+                    update_collection__update_record=update_record
+                ).count(),
+                1,
+            )
+
+            # complete advisories are passed on as they are
+            (dc,) = self.sync_advisories(updateinfo_xml_path)
+            self.assertEqual(dc.content, update_record)
+            self.assertEqual(dc.extra_data, {})
+            self.assertEqual(update_record.collections.count(), 1)
+            self.assertEqual(update_record.references.count(), 1)